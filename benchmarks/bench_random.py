@@ -0,0 +1,248 @@
+import os
+import sys
+import time
+import argparse
+import statistics
+import tracemalloc
+from random import Random
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import utils  # noqa: E402
+
+# Minimum accepted quality of an order. Every song must appear exactly once,
+# the songs with less plays must come first, i.e. a positive rank
+# correlation between the position and the number of plays, and the songs of
+# an artist must be as far apart as they can be, check 'achievable_gap'.
+MIN_COVERAGE = 1.0
+MIN_SPEARMAN = 0.05
+MAX_SPACING_MISSES = 0.05
+
+
+def make_library(number_songs, number_artists, seed):
+    '''
+    Builds a synthetic library of 'number_songs' songs. A few artists have
+    most of the songs, like in a real library, and the number of plays
+    decreases for most of the songs.
+
+    Parameters
+    ----------
+    number_songs : int
+        Number of songs of the library
+    number_artists : int
+        Number of different artists of the library
+    seed : int
+        Seed used to build the library
+
+    Returns
+    -------
+    dict
+        Saved songs in the format of 'download_saved_songs'
+    '''
+    random_generator = Random(seed)
+    artist_weights = [1/(rank + 1) for rank in range(number_artists)]
+    artists = random_generator.choices(range(number_artists), artist_weights,
+                                       k=number_songs)
+    return {
+        'id%d' % (i, ): {
+            'name': 'Song %d' % (i, ),
+            'artists': {'artist%d' % (artists[i], ): 'Artist %d' % (artists[i], )},
+            'album': 'Album %d' % (i // 10, ),
+            'album_id': 'album%d' % (i // 10, ),
+            'uri': 'spotify:track:id%d' % (i, ),
+            'no_of_plays': int(random_generator.expovariate(0.5))
+        }
+        for i in range(number_songs)
+    }
+
+
+def ranks(values):
+    '''
+    Ranks of 'values' starting at 1. Ties get the mean of their ranks.
+    '''
+    order = sorted(range(len(values)), key=lambda i: values[i])
+    value_ranks = [0.0]*len(values)
+    start = 0
+    while start < len(order):
+        end = start
+        while end + 1 < len(order) and \
+                values[order[end + 1]] == values[order[start]]:
+            end += 1
+        mean_rank = (start + end)/2 + 1
+        for position in range(start, end + 1):
+            value_ranks[order[position]] = mean_rank
+        start = end + 1
+    return value_ranks
+
+
+def spearman(x, y):
+    '''
+    Spearman rank correlation of 'x' and 'y'.
+    '''
+    rank_x = ranks(x)
+    rank_y = ranks(y)
+    mean_x = statistics.mean(rank_x)
+    mean_y = statistics.mean(rank_y)
+    covariance = sum((a - mean_x)*(b - mean_y) for a, b in zip(rank_x, rank_y))
+    deviation_x = sum((a - mean_x)**2 for a in rank_x)**0.5
+    deviation_y = sum((b - mean_y)**2 for b in rank_y)**0.5
+    if deviation_x == 0 or deviation_y == 0:
+        return 0.0
+    return covariance/(deviation_x*deviation_y)
+
+
+def achievable_gap(number_songs, artist_songs, repeat_artist):
+    '''
+    Largest gap that all the songs of an artist with 'artist_songs' songs
+    can have in an order of 'number_songs' songs, at most 'repeat_artist' + 1.
+    '''
+    return min(repeat_artist + 1, number_songs//artist_songs)
+
+
+def artist_gaps(songs_dictionary, randomized_ids):
+    '''
+    Number of songs between two consecutive songs of the same artist.
+
+    Returns
+    -------
+    list
+        Tuples (artist, gap)
+    '''
+    last_position = {}
+    gaps = []
+    for position, id_song in enumerate(randomized_ids):
+        for artist in songs_dictionary[id_song]['artists']:
+            if artist in last_position:
+                gaps.append((artist, position - last_position[artist]))
+            last_position[artist] = position
+    return gaps
+
+
+def order_quality(songs_dictionary, randomized_ids, repeat_artist):
+    '''
+    Quality metrics of an order returned by 'random_all_songs'.
+
+    Returns
+    -------
+    dict
+        'coverage': fraction of the library in the order,
+        'duplicates': songs that appear more than once,
+        'spearman': rank correlation of position and number of plays,
+        'gap_p10' and 'gap_median': percentiles of the artist gaps,
+        'close_repeats': fraction of artist gaps <= 'repeat_artist',
+        'spacing_misses': fraction of artist gaps below 'achievable_gap'
+    '''
+    unique_ids = set(randomized_ids) & set(songs_dictionary)
+    plays = [songs_dictionary[id_song]['no_of_plays']
+             for id_song in randomized_ids]
+    artist_songs = {}
+    for song in songs_dictionary.values():
+        for artist in song['artists']:
+            artist_songs[artist] = artist_songs.get(artist, 0) + 1
+    gaps_by_artist = artist_gaps(songs_dictionary, randomized_ids)
+    spacing_misses = len([
+        gap for artist, gap in gaps_by_artist
+        if gap < achievable_gap(len(songs_dictionary), artist_songs[artist],
+                                repeat_artist)])
+    gaps = sorted(gap for _, gap in gaps_by_artist)
+    if len(gaps) == 0:
+        gaps = [len(randomized_ids)]
+    return {
+        'coverage': len(unique_ids)/len(songs_dictionary),
+        'duplicates': len(randomized_ids) - len(set(randomized_ids)),
+        'spearman': spearman(list(range(len(randomized_ids))), plays),
+        'gap_p10': gaps[len(gaps)//10],
+        'gap_median': statistics.median(gaps),
+        'close_repeats': len([gap for gap in gaps if gap <= repeat_artist]) /
+        len(gaps),
+        'spacing_misses': spacing_misses/len(gaps)
+    }
+
+
+def measure_size(number_songs, number_artists, repeat_artist, seeds):
+    '''
+    Randomizes a library of 'number_songs' once per seed and returns the
+    median time and quality of the runs and the peak memory of the first one.
+    '''
+    songs_dictionary = make_library(number_songs, number_artists, seed=0)
+    times = []
+    qualities = []
+    for seed in seeds:
+        start_time = time.perf_counter()
+        randomized_ids = utils.random_all_songs(songs_dictionary,
+                                                repeat_artist=repeat_artist,
+                                                seed=seed)
+        times.append(time.perf_counter() - start_time)
+        qualities.append(order_quality(songs_dictionary, randomized_ids,
+                                       repeat_artist))
+
+    # The tracing slows down the function, it is measured apart
+    tracemalloc.start()
+    utils.random_all_songs(songs_dictionary, repeat_artist=repeat_artist,
+                           seed=seeds[0])
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    summary = {metric: statistics.median(quality[metric]
+                                         for quality in qualities)
+               for metric in qualities[0]}
+    # A single bad seed is enough to fail
+    summary['coverage'] = min(quality['coverage'] for quality in qualities)
+    summary['duplicates'] = max(quality['duplicates'] for quality in qualities)
+    summary['seconds'] = statistics.median(times)
+    summary['peak_mb'] = peak_memory/1e6
+    return summary
+
+
+def parse_args(args=sys.argv[1:]):
+    parser = argparse.ArgumentParser(
+                description='Speed and quality of the shuffle random_all_songs.',
+                formatter_class=argparse.ArgumentDefaultsHelpFormatter
+            )
+    parser.add_argument(
+        "--sizes", type=int, nargs='+', default=[500, 2000, 5000],
+        help="Number of songs of the measured libraries."
+    )
+    parser.add_argument(
+        "--number_artists", type=int, default=300,
+        help="Number of artists of the measured libraries."
+    )
+    parser.add_argument(
+        "--repeat_artist", type=int, default=20,
+        help="Parameter 'repeat_artist' of random_all_songs."
+    )
+    parser.add_argument(
+        "--seeds", type=int, nargs='+', default=[0, 1, 2],
+        help="Seeds of the measured runs. The median is reported."
+    )
+    return parser.parse_args(args)
+
+
+def main():
+    args = parse_args()
+    failed = []
+    columns = ('songs', 'seconds', 'peak MB', 'spearman', 'gap p10',
+               'gap median', 'close rep', 'misses', 'coverage', 'dups')
+    print('%7s %9s %9s %9s %9s %10s %9s %9s %9s %5s' % columns)
+    for number_songs in args.sizes:
+        summary = measure_size(number_songs, args.number_artists,
+                               args.repeat_artist, args.seeds)
+        status = 'ok'
+        if summary['coverage'] < MIN_COVERAGE or summary['duplicates'] > 0 or \
+                summary['spearman'] < MIN_SPEARMAN or \
+                summary['spacing_misses'] > MAX_SPACING_MISSES:
+            status = 'BAD'
+            failed.append(number_songs)
+        print('%7d %9.3f %9.2f %9.3f %9d %10.1f %9.3f %9.3f %9.3f %5d  %s' % (
+                number_songs, summary['seconds'], summary['peak_mb'],
+                summary['spearman'], summary['gap_p10'], summary['gap_median'],
+                summary['close_repeats'], summary['spacing_misses'],
+                summary['coverage'], summary['duplicates'], status))
+
+    if len(failed) > 0:
+        print('Bad randomization for sizes: %s' % (
+                ', '.join(str(size) for size in failed), ))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
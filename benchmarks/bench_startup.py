@@ -0,0 +1,231 @@
+import os
+import sys
+import time
+import json
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+# Path to the script whose startup is measured
+SCRIPT_PATH = os.path.join(os.path.dirname(os.path.dirname(
+                            os.path.realpath(__file__))), 'spotify_helper.py')
+
+# Maximum median cold-start time (ms) accepted for every action. The time is
+# the whole run of the script, with every request refused by a proxy that
+# does not exist, so no request leaves the machine.
+# play_saved_songs is measured until its first song is in the queue instead,
+# check 'FAKE_SPOTIFY'.
+MAX_STARTUP_MS = {
+    'help': 200,
+    'use_daemon': 200,
+    'get_recently_played_songs': 400,
+    'download_saved_songs': 400,
+    'compare_saved_songs': 400,
+    'play_saved_songs': 250,
+}
+
+# Runs the script (first argument) answering its requests locally: the songs
+# are always added to the queue and every other request fails. The time at
+# which the first song is added is written to stdout.
+FAKE_SPOTIFY = '''
+import os
+import sys
+import time
+import runpy
+
+sys.argv = sys.argv[1:]
+sys.path.insert(0, os.path.dirname(os.path.realpath(sys.argv[0])))
+import spotify_api
+
+
+class FakeResponse(object):
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.content = b''
+        self.headers = {}
+
+    def json(self):
+        return {}
+
+
+def send_request(method, url, **kwargs):
+    if method == 'post' and url.endswith('/me/player/queue'):
+        if not getattr(send_request, 'queued', False):
+            send_request.queued = True
+            print('first_queued %f' % (time.time(), ), flush=True)
+        return FakeResponse(204)
+    return FakeResponse(503)
+
+
+spotify_api.send_request = send_request
+runpy.run_path(sys.argv[0], run_name='__main__')
+'''
+
+
+def prepare_files(tmp_dir, number_songs):
+    '''
+    Writes a Spotify environment with a valid token and a library of
+    'number_songs' songs so that the actions don't need to refresh anything
+    before their first request.
+
+    Parameters
+    ----------
+    tmp_dir : string
+        Directory in which the files are written
+    number_songs : int
+        Number of songs of the library
+
+    Returns
+    -------
+    dict
+        Paths of the written files
+    '''
+    env_file = os.path.join(tmp_dir, 'spotify_env.json')
+    results_dir = os.path.join(tmp_dir, 'results')
+    os.makedirs(results_dir)
+    spotify_env = {
+        'user_code': 'code',
+        'redirect_uri': 'https://localhost',
+        'client_id': 'id',
+        'client_secret': 'secret',
+        'access_token': 'token',
+        'refresh_token': 'refresh',
+        'access_token_expires_at': time.time() + 3600,
+        'saved_songs_updated_at': time.strftime('%d-%m-%Y')
+    }
+    with open(env_file, 'w') as f:
+        json.dump(spotify_env, f)
+
+    saved_songs = {
+        'id%d' % (i, ): {
+            'name': 'Song %d' % (i, ),
+            'artists': {'artist%d' % (i % 500, ): 'Artist %d' % (i % 500, )},
+            'album': 'Album %d' % (i // 10, ),
+            'album_id': 'album%d' % (i // 10, ),
+            'uri': 'spotify:track:id%d' % (i, ),
+            'no_of_plays': i % 7
+        }
+        for i in range(number_songs)
+    }
+    with open(os.path.join(results_dir, 'all_my_songs.json'), 'w') as f:
+        json.dump(saved_songs, f)
+
+    return {
+        'env_file': env_file,
+        'results_dir': results_dir,
+        'log_file': os.path.join(tmp_dir, 'bench.log'),
+        'socket_path': os.path.join(tmp_dir, 'missing.sock')
+    }
+
+
+def action_args(action, files):
+    '''
+    Command line arguments to run 'action' with the prepared files.
+    '''
+    if action == 'help':
+        return ['-h']
+    args = ['--spotify_env_file', files['env_file'],
+            '--results_dir', files['results_dir'],
+            '--log_file', files['log_file'],
+            '--log_level', 'CRITICAL']
+    if action == 'use_daemon':
+        return args + ['-a', 'play_saved_songs', '--use_daemon',
+                       '--socket_path', files['socket_path']]
+    if action == 'play_saved_songs':
+        args += ['--not_wait_songs_to_play']
+    return args + ['-a', action]
+
+
+def measure_action(action, files, repeat, importtime=False):
+    '''
+    Runs the script 'repeat' times and returns the wall times in ms. For
+    play_saved_songs the time is until the first song is in the queue.
+    If 'importtime' is set the output of -X importtime of the last run
+    is printed.
+    '''
+    environ = dict(os.environ)
+    # Every request fails right away instead of reaching Spotify
+    environ['HTTPS_PROXY'] = 'http://127.0.0.1:9'
+    command = [sys.executable]
+    if importtime:
+        command += ['-X', 'importtime']
+    if action == 'play_saved_songs':
+        command += ['-c', FAKE_SPOTIFY]
+    command += [SCRIPT_PATH] + action_args(action, files)
+
+    times = []
+    for _ in range(repeat):
+        start_time = time.time()
+        completed = subprocess.run(command, env=environ,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+        end_time = time.time()
+        if completed.returncode != 0:
+            raise RuntimeError('The script crashed running %s:\n%s' % (
+                                action, completed.stderr.decode()))
+        if action == 'play_saved_songs':
+            queued = [line.split()[1]
+                      for line in completed.stdout.decode().splitlines()
+                      if line.startswith('first_queued ')]
+            if len(queued) == 0:
+                raise RuntimeError('No song was queued running %s:\n%s' % (
+                                    action, completed.stderr.decode()))
+            end_time = float(queued[0])
+        times.append((end_time - start_time)*1000)
+    if importtime:
+        lines = [line for line in completed.stderr.decode().splitlines()
+                 if line.startswith('import time:')]
+        print('\n'.join(lines))
+    return times
+
+
+def parse_args(args=sys.argv[1:]):
+    parser = argparse.ArgumentParser(
+                description='Cold-start time of every action of the script.',
+                formatter_class=argparse.ArgumentDefaultsHelpFormatter
+            )
+    parser.add_argument(
+        "--actions", type=str, nargs='+', default=list(MAX_STARTUP_MS),
+        choices=list(MAX_STARTUP_MS), help="Actions to measure."
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=5,
+        help="Number of runs of every action. The median is reported."
+    )
+    parser.add_argument(
+        "--number_songs", type=int, default=5000,
+        help="Number of songs of the library used by the actions."
+    )
+    parser.add_argument(
+        "--importtime", action='store_true',
+        help="Print the -X importtime profile of every action."
+    )
+    return parser.parse_args(args)
+
+
+def main():
+    args = parse_args()
+    failed = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        files = prepare_files(tmp_dir, args.number_songs)
+        print('%-28s %10s %10s %10s' % ('action', 'median ms', 'min ms',
+                                        'max ms'))
+        for action in args.actions:
+            times = measure_action(action, files, args.repeat,
+                                   importtime=args.importtime)
+            median = statistics.median(times)
+            status = 'ok' if median <= MAX_STARTUP_MS[action] else 'SLOW'
+            if status != 'ok':
+                failed.append(action)
+            print('%-28s %10.1f %10.1f %10.1f  %s (max %d)' % (
+                    action, median, min(times), max(times), status,
+                    MAX_STARTUP_MS[action]))
+
+    if len(failed) > 0:
+        print('Startup too slow for: %s' % (', '.join(failed), ))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
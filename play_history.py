@@ -0,0 +1,191 @@
+import os
+import heapq
+import datetime
+import logging
+
+# The plays are stored by track and time, and every play also has the week
+# (its Monday). The plays of every artist in every week and the last play of
+# every song are kept up to date by triggers when a play is stored, so the
+# statistics read a few rows instead of all the plays.
+# N.B. The artists of a song must be stored before its plays
+HISTORY_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS plays (
+    track_id TEXT NOT NULL,
+    played_at TEXT NOT NULL,
+    week TEXT NOT NULL,
+    PRIMARY KEY (track_id, played_at)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS plays_played_at ON plays (played_at);
+CREATE TABLE IF NOT EXISTS track_artists (
+    track_id TEXT NOT NULL,
+    artist_id TEXT NOT NULL,
+    PRIMARY KEY (track_id, artist_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS artists (
+    artist_id TEXT PRIMARY KEY,
+    name TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS artist_weeks (
+    week TEXT NOT NULL,
+    artist_id TEXT NOT NULL,
+    number_plays INTEGER NOT NULL,
+    PRIMARY KEY (week, artist_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS last_plays (
+    track_id TEXT PRIMARY KEY,
+    played_at TEXT NOT NULL
+) WITHOUT ROWID;
+CREATE TRIGGER IF NOT EXISTS plays_summary AFTER INSERT ON plays
+BEGIN
+    INSERT INTO artist_weeks
+        SELECT NEW.week, artist_id, 1 FROM track_artists
+        WHERE track_id = NEW.track_id
+        ON CONFLICT (week, artist_id)
+        DO UPDATE SET number_plays = number_plays + 1;
+    INSERT INTO last_plays VALUES (NEW.track_id, NEW.played_at)
+        ON CONFLICT (track_id)
+        DO UPDATE SET played_at = MAX(played_at, excluded.played_at);
+END;
+'''
+
+
+def open_history(history_file):
+    '''
+    Opens the play history, creating it if it does not exist.
+
+    Parameters
+    ----------
+    history_file : string
+        Path to the SQLite file with the play history
+
+    Returns
+    -------
+    sqlite3.Connection
+        Connection to the play history
+    '''
+    # Imported here, only the actions that use the history need it
+    import sqlite3
+
+    directory = os.path.dirname(history_file)
+    if directory != '':
+        os.makedirs(directory, exist_ok=True)
+    connection = sqlite3.connect(history_file)
+    connection.executescript(HISTORY_SCHEMA)
+    return connection
+
+
+def week_of(played_at):
+    '''
+    Monday of the week of a play, e.g. '2024-01-29' for
+    '2024-02-01T10:00:00.000Z'.
+    '''
+    day = datetime.date.fromisoformat(played_at[:10])
+    return (day - datetime.timedelta(days=day.weekday())).isoformat()
+
+
+def record_plays(history_file, plays):
+    '''
+    Stores plays in the history. A play already stored (same song and time)
+    is not stored twice.
+
+    Parameters
+    ----------
+    history_file : string
+        Path to the SQLite file with the play history
+    plays : list
+        Tuples (id of the song, time it played as returned by Spotify,
+        artists of the song as a dictionary id: name)
+
+    Returns
+    -------
+    int
+        Number of new plays stored
+    '''
+    logger = logging.getLogger('spotify')
+    if len(plays) == 0:
+        return 0
+    connection = open_history(history_file)
+    try:
+        with connection:
+            connection.executemany(
+                'INSERT OR IGNORE INTO track_artists VALUES (?, ?)',
+                [(id_song, artist_id)
+                 for id_song, _, artists in plays for artist_id in artists])
+            connection.executemany(
+                'INSERT OR REPLACE INTO artists VALUES (?, ?)',
+                [(artist_id, artist_name)
+                 for _, _, artists in plays
+                 for artist_id, artist_name in artists.items()])
+            # The plays already stored are ignored and not counted
+            number_new = connection.executemany(
+                'INSERT OR IGNORE INTO plays VALUES (?, ?, ?)',
+                [(id_song, played_at, week_of(played_at))
+                 for id_song, played_at, _ in plays]).rowcount
+    finally:
+        connection.close()
+    logger.debug('Stored %d new plays in the history' % (number_new, ))
+    return number_new
+
+
+def plays_per_artist_per_week(connection, since=None):
+    '''
+    Number of plays of every artist in every week.
+
+    Parameters
+    ----------
+    connection : sqlite3.Connection
+        Connection to the play history
+    since : string
+        Only the weeks starting on or after this date, e.g. '2024-01-29'.
+        If None all the weeks
+
+    Returns
+    -------
+    list
+        Tuples (week, artist name, number of plays), newest week first and
+        the artists with more plays first
+    '''
+    return connection.execute(
+        'SELECT artist_weeks.week, artists.name, artist_weeks.number_plays '
+        'FROM artist_weeks '
+        'JOIN artists ON artists.artist_id = artist_weeks.artist_id '
+        'WHERE artist_weeks.week >= ? '
+        'ORDER BY artist_weeks.week DESC, artist_weeks.number_plays DESC, '
+        'artists.name',
+        ('' if since is None else since, )).fetchall()
+
+
+def last_plays(connection):
+    '''
+    Time of the last play of every song in the history.
+
+    Returns
+    -------
+    dict
+        The keys are the ids of the songs
+    '''
+    return dict(connection.execute('SELECT track_id, played_at FROM last_plays'))
+
+
+def never_played(saved_songs, last_played):
+    '''
+    Ids of the saved songs that are not in the history. 'last_played' is the
+    result of 'last_plays'.
+    '''
+    return [id_song for id_song in saved_songs if id_song not in last_played]
+
+
+def longest_unplayed(saved_songs, last_played, number_songs):
+    '''
+    The 'number_songs' saved songs that played the longest time ago. The
+    songs that never played are not included, check 'never_played'.
+
+    Returns
+    -------
+    list
+        Tuples (id of the song, time of its last play), oldest first
+    '''
+    played = ((last_played[id_song], id_song) for id_song in saved_songs
+              if id_song in last_played)
+    return [(id_song, played_at)
+            for played_at, id_song in heapq.nsmallest(number_songs, played)]
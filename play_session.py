@@ -0,0 +1,237 @@
+import os
+import json
+import datetime
+import logging
+
+# Events that move forward the cursor of the planned order
+CURSOR_EVENTS = ('queued', 'error', 'skipped')
+
+
+def start_checkpoint(checkpoint_file, ids_to_play, num_play_songs):
+    '''
+    Creates the checkpoint of a play session. The checkpoint is a JSON lines
+    file: the first line is the planned order of the session and every
+    following line is an event appended with 'append_checkpoint'.
+
+    Parameters
+    ----------
+    checkpoint_file : string
+        Path to the checkpoint of the session
+    ids_to_play : list
+        Randomized ids of the songs planned for the session
+    num_play_songs : int
+        Number of songs to be sent to the queue in the session
+    '''
+    logger = logging.getLogger('spotify')
+    plan = {
+        'created_at': str(datetime.datetime.now()),
+        'num_play_songs': num_play_songs,
+        'ids_to_play': ids_to_play
+    }
+    os.makedirs(os.path.dirname(checkpoint_file), exist_ok=True)
+    with open(checkpoint_file, 'w') as f:
+        f.write(json.dumps(plan) + '\n')
+    logger.info('Session checkpoint created: %s' % (checkpoint_file, ))
+
+
+def append_checkpoint(checkpoint_file, event, song_ids):
+    '''
+    Appends to the checkpoint what happened with some songs of the session.
+    Only the new events are written, the plan is never written again.
+
+    Parameters
+    ----------
+    checkpoint_file : string
+        Path to the checkpoint of the session
+    event : string
+        One of: 'queued', 'error', 'skipped' (the song was not in the library),
+        'dropped' (the song was queued but the device lost it) or 'played'
+    song_ids : list
+        Ids of the songs of the event
+    '''
+    if len(song_ids) == 0:
+        return
+    with open(checkpoint_file, 'a') as f:
+        for song_id in song_ids:
+            f.write(json.dumps({'event': event, 'id': song_id}) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def load_checkpoint(checkpoint_file):
+    '''
+    Rebuilds the state of an interrupted play session from its checkpoint.
+
+    Parameters
+    ----------
+    checkpoint_file : string
+        Path to the checkpoint of the session
+
+    Returns
+    -------
+    dict
+        State of the session with the keys: 'ids_to_play', 'num_play_songs',
+        'cursor' (position in 'ids_to_play' of the next song to send),
+        'number_queued', 'programmed_songs' (queued songs that have not been
+        detected to play) and 'error_songs'.
+        None if there is no checkpoint.
+    '''
+    logger = logging.getLogger('spotify')
+    if not os.path.isfile(checkpoint_file):
+        return None
+
+    with open(checkpoint_file, 'r') as f:
+        lines = f.readlines()
+    plan = json.loads(lines[0])
+
+    cursor = 0
+    number_queued = 0
+    programmed_songs = []
+    error_songs = []
+    played_songs = set()
+    for line in lines[1:]:
+        try:
+            event = json.loads(line)
+        except ValueError:
+            # The session was killed while writing this line
+            logger.warning('Ignoring broken line in checkpoint: %s' % (line, ))
+            continue
+        if event['event'] in CURSOR_EVENTS:
+            cursor += 1
+        if event['event'] == 'queued':
+            number_queued += 1
+            programmed_songs.append(event['id'])
+        elif event['event'] == 'error':
+            error_songs.append(event['id'])
+        elif event['event'] == 'dropped' and event['id'] in programmed_songs:
+            number_queued -= 1
+            programmed_songs.remove(event['id'])
+            error_songs.append(event['id'])
+        elif event['event'] == 'played':
+            played_songs.add(event['id'])
+
+    programmed_songs = [song_id for song_id in programmed_songs
+                        if song_id not in played_songs]
+    logger.info('Session checkpoint loaded: %s. Sent: %d/%d. Pending: %d' % (
+                    checkpoint_file, number_queued, plan['num_play_songs'],
+                    len(programmed_songs)))
+    return {
+        'ids_to_play': plan['ids_to_play'],
+        'num_play_songs': plan['num_play_songs'],
+        'cursor': cursor,
+        'number_queued': number_queued,
+        'programmed_songs': programmed_songs,
+        'error_songs': error_songs
+    }
+
+
+def remove_checkpoint(checkpoint_file):
+    '''
+    Removes the checkpoint of a session that finished.
+
+    Parameters
+    ----------
+    checkpoint_file : string
+        Path to the checkpoint of the session
+    '''
+    logger = logging.getLogger('spotify')
+    if os.path.isfile(checkpoint_file):
+        os.remove(checkpoint_file)
+        logger.info('Session finished. Checkpoint removed: %s' % (
+                        checkpoint_file, ))
+
+
+def write_plan(plan_file, ids_to_play, repeat_artist):
+    '''
+    Stores the random order of the next play session so that the session can
+    start sending songs without randomizing the library first.
+
+    Parameters
+    ----------
+    plan_file : string
+        Path to the plan of the next session
+    ids_to_play : list
+        Randomized ids of all the songs of the library
+    repeat_artist : int
+        Parameter 'repeat_artist' used to randomize the songs
+    '''
+    logger = logging.getLogger('spotify')
+    plan = {
+        'created_at': str(datetime.datetime.now()),
+        'repeat_artist': repeat_artist,
+        'ids_to_play': ids_to_play
+    }
+    os.makedirs(os.path.dirname(plan_file), exist_ok=True)
+    # Write to a temporary file so a session never reads half a plan
+    tmp_file = plan_file + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(plan, f, separators=(',', ':'))
+    os.replace(tmp_file, plan_file)
+    logger.info('Plan of the next session stored: %s' % (plan_file, ))
+
+
+def load_plan(plan_file, saved_songs, repeat_artist):
+    '''
+    Reads the plan of the next session and checks that it can be used with
+    the current library: it must have been randomized with the same
+    'repeat_artist' and contain all the songs of the library. The songs that
+    were removed from the library since the plan was made are dropped.
+
+    Parameters
+    ----------
+    plan_file : string
+        Path to the plan of the next session
+    saved_songs : dict
+        Dictionary of saved songs that we have in our Spotify library
+    repeat_artist : int
+        Parameter 'repeat_artist' of the session
+
+    Returns
+    -------
+    list
+        Randomized ids of the songs to play. None if there is no plan or it
+        cannot be used
+    '''
+    logger = logging.getLogger('spotify')
+    if not os.path.isfile(plan_file):
+        return None
+
+    try:
+        with open(plan_file, 'r') as f:
+            plan = json.load(f)
+    except ValueError:
+        logger.warning('Ignoring broken plan: %s' % (plan_file, ))
+        return None
+
+    if plan['repeat_artist'] != repeat_artist:
+        logger.info('The plan was made with repeat_artist %s. Not using it.'
+                    % (plan['repeat_artist'], ))
+        return None
+
+    planned_ids = set(plan['ids_to_play'])
+    number_new_songs = len([id_song for id_song in saved_songs
+                            if id_song not in planned_ids])
+    if number_new_songs > 0:
+        logger.info('%d songs of the library are not in the plan. Not using it.'
+                    % (number_new_songs, ))
+        return None
+
+    ids_to_play = [id_song for id_song in plan['ids_to_play']
+                   if id_song in saved_songs]
+    logger.info('Plan of %s loaded. Songs: %d' % (plan['created_at'],
+                                                  len(ids_to_play)))
+    return ids_to_play
+
+
+def remove_plan(plan_file):
+    '''
+    Removes the plan of the next session once a session used it, so that the
+    same order is not played twice.
+
+    Parameters
+    ----------
+    plan_file : string
+        Path to the plan of the next session
+    '''
+    if os.path.isfile(plan_file):
+        os.remove(plan_file)
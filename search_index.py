@@ -0,0 +1,351 @@
+import os
+import re
+import shlex
+import logging
+import utils
+
+# Version of the format of the index file. An index with another version is
+# built again
+INDEX_FORMAT_VERSION = 1
+
+# Fields that can be used in a filter, e.g. 'artist:queen'. A word without
+# field matches any of them
+SEARCH_FIELDS = ('name', 'artist', 'album', 'id')
+
+# Words of the names of the songs, artists and albums
+TOKEN_PATTERN = re.compile(r'\w+')
+
+
+def tokenize(text):
+    '''
+    Splits 'text' in lowercase words.
+
+    Parameters
+    ----------
+    text : string
+        Name of a song, artist or album
+
+    Returns
+    -------
+    list
+        The words of the text
+    '''
+    return TOKEN_PATTERN.findall(text.casefold())
+
+
+def song_keys(id_song, song):
+    '''
+    Keys of the index under which a song is found. The names are indexed by
+    word, e.g. 'artist:queen', and the ids as they are, e.g. 'artist_id:<id>'.
+
+    Parameters
+    ----------
+    id_song : string
+        Id of the song
+    song : dict
+        A song of the saved songs
+
+    Returns
+    -------
+    set
+        The keys of the song
+    '''
+    keys = {'id:%s' % (id_song, ), 'album_id:%s' % (song['album_id'], )}
+    keys.update('name:%s' % (token, ) for token in tokenize(song['name']))
+    keys.update('album:%s' % (token, ) for token in tokenize(song['album']))
+    for artist_id, artist_name in song['artists'].items():
+        keys.add('artist_id:%s' % (artist_id, ))
+        keys.update('artist:%s' % (token, ) for token in tokenize(artist_name))
+    return keys
+
+
+def add_songs(index, saved_songs, song_ids):
+    '''
+    Adds to the index the songs 'song_ids' of 'saved_songs'.
+    '''
+    postings = index['postings']
+    for id_song in song_ids:
+        for key in song_keys(id_song, saved_songs[id_song]):
+            postings.setdefault(key, set()).add(id_song)
+
+
+def remove_songs(index, saved_songs, song_ids):
+    '''
+    Removes from the index the songs 'song_ids', whose metadata is taken from
+    'saved_songs'.
+    '''
+    postings = index['postings']
+    for id_song in song_ids:
+        for key in song_keys(id_song, saved_songs[id_song]):
+            posting = postings.get(key)
+            if posting is None:
+                continue
+            posting.discard(id_song)
+            if len(posting) == 0:
+                del postings[key]
+
+
+def build_index(saved_songs):
+    '''
+    Builds the inverted index of the saved songs: for every word of the names
+    of the songs, artists and albums, and for every id, the ids of the songs
+    that have it.
+
+    Parameters
+    ----------
+    saved_songs : dict
+        Saved songs. The keys of this dictionary are the ids of the songs.
+
+    Returns
+    -------
+    dict
+        The index. The key 'postings' has the ids of the songs of every key
+    '''
+    index = {'format_version': INDEX_FORMAT_VERSION, 'postings': {}}
+    add_songs(index, saved_songs, saved_songs.keys())
+    return index
+
+
+def update_index(index, last_saved_songs, new_saved_songs):
+    '''
+    Updates the index with the differences between two versions of the saved
+    songs, only the songs that changed are indexed again.
+
+    Parameters
+    ----------
+    index : dict
+        Index of 'last_saved_songs'
+    last_saved_songs : dict
+        Saved songs in our library before the last update
+    new_saved_songs : dict
+        Saved songs in our library after the last update
+
+    Returns
+    -------
+    int
+        Number of songs that changed in the index
+    '''
+    differences = utils.diff_saved_songs(last_saved_songs=last_saved_songs,
+                                         new_saved_songs=new_saved_songs)
+    removed = differences['removed'] + list(differences['relinked']) + \
+        differences['metadata_changed']
+    added = differences['added'] + list(differences['relinked'].values()) + \
+        differences['metadata_changed']
+    remove_songs(index, last_saved_songs, removed)
+    add_songs(index, new_saved_songs, added)
+    return len(removed) + len(added)
+
+
+def write_index(file, index):
+    '''
+    Writes the index to a JSON file.
+
+    Parameters
+    ----------
+    file : string
+        The path to store the JSON file
+    index : dict
+        Index built by 'build_index'
+    '''
+    utils.write_json_file(file, {
+        'format_version': index['format_version'],
+        'postings': {key: sorted(posting)
+                     for key, posting in index['postings'].items()}
+    }, compact=True)
+
+
+def read_index(file):
+    '''
+    Reads an index written by 'write_index'.
+
+    Parameters
+    ----------
+    file : string
+        The path to the JSON file with the index
+
+    Returns
+    -------
+    dict
+        The index. None if there is no index or it has another format version
+    '''
+    if not os.path.isfile(file):
+        return None
+    stored_index = utils.open_json_file(file)
+    if stored_index.get('format_version') != INDEX_FORMAT_VERSION:
+        return None
+    return {
+        'format_version': stored_index['format_version'],
+        'postings': {key: set(posting)
+                     for key, posting in stored_index['postings'].items()}
+    }
+
+
+def load_index(file, saved_songs):
+    '''
+    Reads the index of the saved songs. If there is no index it is built and
+    written to 'file'.
+
+    Parameters
+    ----------
+    file : string
+        The path to the JSON file with the index
+    saved_songs : dict
+        Saved songs. The keys of this dictionary are the ids of the songs.
+
+    Returns
+    -------
+    dict
+        The index
+    '''
+    logger = logging.getLogger('spotify')
+    index = read_index(file)
+    if index is None:
+        logger.info('Building the search index: %s' % (file, ))
+        index = build_index(saved_songs)
+        write_index(file, index)
+    return index
+
+
+def sync_index(file, last_saved_songs, new_saved_songs):
+    '''
+    Updates the stored index after a sync of the saved songs. Nothing is done
+    if the index was never built.
+
+    Parameters
+    ----------
+    file : string
+        The path to the JSON file with the index
+    last_saved_songs : dict
+        Saved songs in our library before the sync
+    new_saved_songs : dict
+        Saved songs in our library after the sync
+    '''
+    logger = logging.getLogger('spotify')
+    index = read_index(file)
+    if index is None:
+        return
+    number_changes = update_index(index, last_saved_songs, new_saved_songs)
+    if number_changes > 0:
+        write_index(file, index)
+    logger.info('Search index updated. Changes: %d' % (number_changes, ))
+
+
+def union(sets):
+    '''
+    Union of 'sets'. The postings of the index are returned without a copy
+    when there is only one, so the result must not be modified.
+    '''
+    sets = [song_ids for song_ids in sets if len(song_ids) > 0]
+    if len(sets) == 0:
+        return set()
+    if len(sets) == 1:
+        return sets[0]
+    return sets[0].union(*sets[1:])
+
+
+def match_term(index, field, value):
+    '''
+    Ids of the songs that match one term of a filter, e.g. 'artist:queen'.
+    All the words of 'value' must match. An id matches as it is.
+    The result must not be modified, check 'union'.
+    '''
+    postings = index['postings']
+    fields = SEARCH_FIELDS if field is None else (field, )
+    words = tokenize(value)
+    matches = []
+    for search_field in fields:
+        if search_field == 'id':
+            matches.append(postings.get('id:%s' % (value, ), set()))
+            continue
+        if search_field != 'name':
+            matches.append(postings.get('%s_id:%s' % (search_field, value),
+                                        set()))
+        if len(words) == 0:
+            continue
+        # The shortest posting first so the intersection is small
+        word_postings = sorted((postings.get('%s:%s' % (search_field, word),
+                                             set())
+                                for word in words), key=len)
+        if len(word_postings) == 1:
+            matches.append(word_postings[0])
+        else:
+            matches.append(set.intersection(*word_postings))
+    return union(matches)
+
+
+def split_filter(expression):
+    '''
+    Splits a filter expression in its terms, check 'search'. The values with
+    spaces are quoted, e.g. 'album:"a night at the opera"'. If the expression
+    is not valid, e.g. a quote is not closed, a ValueError is raised.
+
+    Parameters
+    ----------
+    expression : string
+        The filter expression
+
+    Returns
+    -------
+    list
+        The terms of the expression
+    '''
+    try:
+        return shlex.split(expression)
+    except ValueError as error:
+        raise ValueError('Invalid filter %s: %s. Values with spaces go between'
+                         ' closed quotes, e.g. album:"a night at the opera"' % (
+                            expression, str(error).lower()))
+
+
+def search(index, expression):
+    '''
+    Ids of the songs that match a filter expression. The expression is a list
+    of terms separated by spaces that must all match:
+    - 'field:value' where field is one of SEARCH_FIELDS. The value can be an
+      id or words, e.g. 'artist:queen' or 'album:"a night at the opera"'
+    - 'field:value1,value2' matches any of the values
+    - 'value' matches any field
+    - '-term' excludes the songs matching the term
+    An expression that is not valid raises a ValueError, check 'split_filter'.
+
+    Parameters
+    ----------
+    index : dict
+        Index built by 'build_index'
+    expression : string
+        The filter expression
+
+    Returns
+    -------
+    set
+        Ids of the songs that match
+    '''
+    included = []
+    excluded = []
+    for term in split_filter(expression):
+        exclude = term.startswith('-')
+        if exclude:
+            term = term[1:]
+        field, separator, values = term.partition(':')
+        if separator == '' or field not in SEARCH_FIELDS:
+            field, values = None, term
+        song_ids = union([match_term(index, field, value)
+                          for value in values.split(',')])
+        if exclude:
+            excluded.append(song_ids)
+        else:
+            included.append(song_ids)
+
+    if len(included) > 0:
+        # The smallest set first, every intersection is at most its size
+        included.sort(key=len)
+        song_ids = set(included[0]).intersection(*included[1:])
+    elif len(excluded) > 0:
+        # Only exclusions, all the other songs match
+        song_ids = {key[len('id:'):] for key in index['postings']
+                    if key.startswith('id:')}
+    else:
+        song_ids = set()
+    for excluded_ids in excluded:
+        song_ids = song_ids - excluded_ids
+    return song_ids
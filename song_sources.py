@@ -0,0 +1,206 @@
+import os
+import logging
+import utils
+import spotify_api
+
+# Sources of songs that can be shuffled together, e.g. 'playlist:<id>'
+LIKED_SONGS = 'liked'
+SOURCE_KINDS = ('playlist', 'album')
+
+
+def parse_source(source):
+    '''
+    Splits a source given as 'kind:id', e.g. 'playlist:<id>'. A Spotify URI
+    ('spotify:playlist:<id>') is also accepted.
+
+    Parameters
+    ----------
+    source : string
+        The source of songs
+
+    Returns
+    -------
+    tuple
+        The kind of source and its id
+    '''
+    if source.startswith('spotify:'):
+        source = source[len('spotify:'):]
+    kind, separator, source_id = source.partition(':')
+    if separator == '' or kind not in SOURCE_KINDS or source_id == '':
+        raise ValueError('Unknown source of songs: %s. Use %s or one of %s '
+                         'followed by :id' % (source, LIKED_SONGS,
+                                              ', '.join(SOURCE_KINDS)))
+    return kind, source_id
+
+
+def source_cache_path(sources_dir, kind, source_id):
+    '''
+    Path to the file where the songs of a source are cached.
+    '''
+    return os.path.join(sources_dir, '%s_%s.json' % (kind, source_id))
+
+
+def load_source(spotify_env, sources_dir, source):
+    '''
+    Gets the songs of a playlist or album. The songs are cached in
+    'sources_dir' with the version of the source (the snapshot id of a
+    playlist or the ETag of an album) and only requested again when the
+    version changes.
+
+    Parameters
+    ----------
+    spotify_env : dict
+        Dictionary containing own Spotify keys, tokens, etc.
+    sources_dir : string
+        Folder where the songs of every source are cached
+    source : string
+        The source, e.g. 'playlist:<id>'
+
+    Returns
+    -------
+    dict
+        The songs of the source in the format of the saved songs
+    '''
+    logger = logging.getLogger('spotify')
+    kind, source_id = parse_source(source)
+    cache_path = source_cache_path(sources_dir, kind, source_id)
+    cached = None
+    if os.path.isfile(cache_path):
+        cached = utils.open_json_file(cache_path)
+    cached_version = None if cached is None else cached['version']
+
+    songs = None
+    if kind == 'playlist':
+        version = spotify_api.get_playlist_snapshot(spotify_env, source_id)
+        if version != cached_version:
+            songs = spotify_api.get_playlist_tracks(spotify_env, source_id)
+    else:
+        songs, version = spotify_api.get_album_tracks(spotify_env, source_id,
+                                                      etag=cached_version)
+
+    if songs is None:
+        logger.info('Using the cached songs of %s' % (source, ))
+        return utils.unpack_library(cached['songs'])
+
+    utils.write_json_file(cache_path, {
+        'source': source,
+        'version': version,
+        'songs': utils.pack_library(songs)
+    }, compact=True)
+    return songs
+
+
+def load_source_plays(file):
+    '''
+    Reads the number of plays of the songs of the sources that are not in
+    the saved songs. Empty if the file does not exist.
+    '''
+    if not os.path.isfile(file):
+        return {}
+    return utils.open_json_file(file)
+
+
+def write_source_plays(file, pool_songs, saved_songs):
+    '''
+    Writes the number of plays of the songs of 'pool_songs' that are not in
+    'saved_songs'. The plays of the saved songs are stored with them.
+    '''
+    utils.write_json_file(file, {
+        id_song: song['no_of_plays']
+        for id_song, song in pool_songs.items()
+        if id_song not in saved_songs
+    }, compact=True)
+
+
+def merge_sources(saved_songs, sources_songs, source_plays):
+    '''
+    Merges the songs of several sources in a single pool without duplicates.
+    A song that is also a saved song is the same dictionary in both, so its
+    plays are counted in the saved songs. The rest get their plays from
+    'source_plays'.
+
+    Parameters
+    ----------
+    saved_songs : dict
+        Saved songs of our library. They are only used to share the number
+        of plays, they are not added to the pool
+    sources_songs : list
+        The songs of every source, in order of preference
+    source_plays : dict
+        Number of plays of the songs that are not saved songs
+
+    Returns
+    -------
+    dict
+        The songs of all the sources. The keys are the ids of the songs.
+    '''
+    pool_songs = {}
+    for songs in sources_songs:
+        for id_song, song in songs.items():
+            if id_song in pool_songs:
+                continue
+            saved_song = saved_songs.get(id_song)
+            if saved_song is not None:
+                pool_songs[id_song] = saved_song
+            else:
+                song['no_of_plays'] = source_plays.get(id_song, 0)
+                pool_songs[id_song] = song
+    return pool_songs
+
+
+def load_song_pool(spotify_env, sources, saved_songs, sources_dir,
+                   source_plays_file, max_workers=4):
+    '''
+    Gets the songs of all the 'sources' at the same time, 'max_workers'
+    sources at a time, and merges them in a single pool with
+    'merge_sources'.
+
+    Parameters
+    ----------
+    spotify_env : dict
+        Dictionary containing own Spotify keys, tokens, etc.
+    sources : list
+        Sources of songs, e.g. ['liked', 'playlist:<id>', 'album:<id>']
+    saved_songs : dict
+        Saved songs of our library
+    sources_dir : string
+        Folder where the songs of every source are cached
+    source_plays_file : string
+        Path to the JSON file with the plays of the songs that are not saved
+        songs
+    max_workers : int
+        Maximum number of sources requested at the same time
+
+    Returns
+    -------
+    dict
+        The songs of all the sources. The keys are the ids of the songs.
+    '''
+    import concurrent.futures
+
+    logger = logging.getLogger('spotify')
+    other_sources = [source for source in sources if source != LIKED_SONGS]
+    # Fail before any request if a source is not valid
+    for source in other_sources:
+        parse_source(source)
+
+    sources_songs = []
+    if LIKED_SONGS in sources:
+        sources_songs.append(saved_songs)
+    if len(other_sources) > 0:
+        # The token is refreshed once and not by every thread
+        spotify_api.refresh_access_token(spotify_env)
+        os.makedirs(sources_dir, exist_ok=True)
+
+        def get_source(source):
+            return load_source(spotify_env, sources_dir, source)
+
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=max_workers) as pool:
+            sources_songs += pool.map(get_source, other_sources)
+
+    pool_songs = merge_sources(saved_songs, sources_songs,
+                               load_source_plays(source_plays_file))
+    logger.info('Songs in the pool of %d sources: %d' % (len(sources),
+                                                          len(pool_songs)))
+    return pool_songs
@@ -1,7 +1,102 @@
 import logging
-import requests
 import json
+import time
 import base64
+import threading
+import utils
+
+# Seconds before the expiration of the token in which it is already renewed
+TOKEN_EXPIRY_MARGIN = 60
+
+# One session shared by every request (and thread) of the process so that
+# the connections to Spotify are reused. Created with 'configure_session'
+_session = None
+_session_lock = threading.Lock()
+# Request budget of the account handled by the current thread
+_thread_state = threading.local()
+
+# Responses of get_recently_played reused for a short time
+_recently_played_cache = utils.TTLCache(ttl=30)
+
+# Maximum number of ids per request of audio features and the features kept
+AUDIO_FEATURES_BATCH = 100
+# Maximum number of upcoming songs returned by the queue of the device
+QUEUE_VIEW_SIZE = 20
+AUDIO_FEATURES = ['tempo', 'energy', 'danceability', 'valence']
+
+
+def configure_session(pool_size=10):
+    '''
+    Creates the session shared by all the requests to Spotify.
+
+    Parameters
+    ----------
+    pool_size : int
+        Maximum number of connections kept open per host. It should be at
+        least the number of threads sending requests at the same time.
+
+    Returns
+    -------
+    requests.Session
+        The shared session
+    '''
+    # Importing requests is the slowest part of the startup of the script.
+    # It is only imported when the first request is sent
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    global _session
+    with _session_lock:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size)
+        session.mount('https://', adapter)
+        _session = session
+    return session
+
+
+def set_request_budget(requests_per_second):
+    '''
+    Limits the requests sent by the current thread. Used to give each account
+    its own budget when several accounts are handled at the same time.
+
+    Parameters
+    ----------
+    requests_per_second : float
+        Maximum requests per second. If None the requests are not limited.
+    '''
+    if requests_per_second is None:
+        _thread_state.limiter = None
+    else:
+        _thread_state.limiter = utils.RateLimiter(requests_per_second)
+
+
+def send_request(method, url, **kwargs):
+    '''
+    Sends a request to Spotify through the shared session, waiting first for
+    the request budget of the current thread if there is one.
+
+    Parameters
+    ----------
+    method : string
+        HTTP method of the request, e.g. 'get'
+    url : string
+        URL of the request
+    kwargs : dict
+        Parameters passed to requests, e.g. headers, params, data
+
+    Returns
+    -------
+    requests.Response
+        Response of Spotify
+    '''
+    limiter = getattr(_thread_state, 'limiter', None)
+    if limiter is not None:
+        limiter.acquire()
+    session = _session
+    if session is None:
+        session = configure_session()
+    return session.request(method, url, **kwargs)
 
 
 def security_get_token(spotify_env):
@@ -43,7 +138,7 @@ def security_get_token(spotify_env):
                   'Payload: %s\n') % (url,
                                       json.dumps(headers, indent=1),
                                       json.dumps(payload, indent=1)))
-    response = requests.post(url, headers=headers, data=payload)
+    response = send_request('post', url, headers=headers, data=payload)
     if response.status_code == 200:
         response_dic = response.json()
         # Renewing the 'access_token'
@@ -51,6 +146,8 @@ def security_get_token(spotify_env):
         # we don't return anything
         spotify_env['access_token'] = response_dic['access_token']
         spotify_env['refresh_token'] = response_dic['refresh_token']
+        spotify_env['access_token_expires_at'] = (time.time() +
+                                                  response_dic['expires_in'])
         logger.debug(json.dumps(response_dic, indent=1))
         logger.info('Spotify token obtained')
     else:
@@ -94,20 +191,103 @@ def security_refresh_token(spotify_env):
                   'Payload: %s\n') % (url,
                                       json.dumps(headers, indent=1),
                                       json.dumps(payload, indent=1)))
-    response = requests.post(url, headers=headers, data=payload)
+    response = send_request('post', url, headers=headers, data=payload)
     if response.status_code == 200:
         response_dic = response.json()
         # Renewing the 'access_token'
         # Using the fact that the dictionaries are immutable
         # we don't return anything
         spotify_env['access_token'] = response_dic['access_token']
+        spotify_env['access_token_expires_at'] = (time.time() +
+                                                  response_dic['expires_in'])
         logger.info('Spotify token renewed')
     else:
         logger.error(response.content)
         raise ValueError('Something went wrong with refresing the token!')
 
 
-def get_saved_tracks(spotify_env):
+def refresh_access_token(spotify_env):
+    '''
+    Makes sure that the 'access_token' in 'spotify_env' can be used.
+    The token is only renewed when it is about to expire, so that processes
+    making several requests (or keeping the token in memory) don't pay a
+    refresh for every request.
+
+    Parameters
+    ----------
+    spotify_env : dict
+        Dictionary containing own Spotify keys, tokens, etc.
+    '''
+    logger = logging.getLogger('spotify')
+    expires_at = spotify_env.get('access_token_expires_at', 0)
+    if 'access_token' in spotify_env and \
+            time.time() < expires_at - TOKEN_EXPIRY_MARGIN:
+        logger.debug('Access token still valid. Not refreshing')
+        return
+
+    try:
+        security_refresh_token(spotify_env)
+    except (ValueError, KeyError):
+        logger.info('Could not refresh access token. Try to get new one')
+        # Maybe we havent exchanged the user_code. Try to exchange for tokens
+        security_get_token(spotify_env)
+
+
+def get_library_state(spotify_env):
+    '''
+    Gets with a single request of one song the number of saved songs in my
+    library and when the newest one was added. If they didn't change since
+    the last download, the library didn't change either (except songs
+    relinked by Spotify).
+    Reference: https://developer.spotify.com/documentation/web-api/reference/#category-library
+
+    Parameters
+    ----------
+    spotify_env : dict
+        Dictionary containing own Spotify keys, tokens, etc.
+
+    Returns
+    -------
+    dict
+        The keys 'total' and 'newest_added_at' (None if the library is empty)
+    '''
+    logger = logging.getLogger('spotify')
+    logger.debug('Checking the state of the library')
+
+    # Refresh the access token before doing anything
+    refresh_access_token(spotify_env)
+
+    # Building the request
+    url = "https://api.spotify.com/v1/me/tracks"
+    headers = {
+      'Authorization': 'Bearer %s' % (spotify_env['access_token'], )
+    }
+    payload = {
+        'limit': 1
+    }
+    logger.debug(('Sending the request..\n'
+                  'URL: %s\n'
+                  'Headers: %s\n'
+                  'Query params: %s') % (url,
+                                         json.dumps(headers, indent=1),
+                                         json.dumps(payload, indent=1)))
+    response = send_request('get', url, headers=headers, params=payload)
+    if response.status_code != 200:
+        logger.error(response.content)
+        raise ValueError('Something went wrong checking the library')
+
+    response_dic = response.json()
+    newest_added_at = None
+    # The songs come sorted by the date they were added, newest first
+    if len(response_dic['items']) > 0:
+        newest_added_at = response_dic['items'][0]['added_at']
+    return {
+        'total': response_dic['total'],
+        'newest_added_at': newest_added_at
+    }
+
+
+def get_saved_tracks(spotify_env, added_after=None):
     '''
     Gets all the saved songs in my library
     Reference: https://developer.spotify.com/documentation/web-api/reference/#category-library
@@ -116,6 +296,9 @@ def get_saved_tracks(spotify_env):
     ----------
     spotify_env : dict
         Dictionary containing own Spotify keys, tokens, etc.
+    added_after : str
+        If given, only the songs added after this date (as returned by
+        'get_library_state') are requested
 
     Returns
     -------
@@ -125,13 +308,8 @@ def get_saved_tracks(spotify_env):
     logger = logging.getLogger('spotify')
     logger.info('Getting saved tracks')
 
-    try:
-        # Refresh the access token before doing anything
-        security_refresh_token(spotify_env)
-    except ValueError:
-        logger.info('Could not refresh access token. Try to get new one')
-        # Maybe we havent exchanged the user_code. Try to exchange for tokens
-        security_refresh_token(spotify_env)
+    # Refresh the access token before doing anything
+    refresh_access_token(spotify_env)
 
     # Building the request
     url = "https://api.spotify.com/v1/me/tracks"
@@ -149,7 +327,7 @@ def get_saved_tracks(spotify_env):
                       'URL: %s\n'
                       'Headers: %s') % (url,
                                         json.dumps(headers, indent=1)))
-        response = requests.get(url, headers=headers)
+        response = send_request('get', url, headers=headers)
         if response.status_code == 200:
             response_dic = response.json()
         else:
@@ -161,27 +339,316 @@ def get_saved_tracks(spotify_env):
         # Append this chunk to what we already have
         tracks += response_dic['items']
 
+        # The songs come newest first. The rest were added before
+        if added_after is not None and len(tracks) > 0 and \
+                tracks[-1]['added_at'] <= added_after:
+            tracks = [track for track in tracks
+                      if track['added_at'] > added_after]
+            break
+
     # Only get the data relevant to us
     total_tracks = 0
     summary_of_tracks = {}
     for track in tracks:
-        track_summary = {
-            'name': track['track']['name'],
-            'artists': {artist['id']: artist['name']
-                        for artist in track['track']['artists']},
-            'album': track['track']['album']['name'],
-            'album_id': track['track']['album']['id'],
-            'uri': track['track']['uri'],
-            'no_of_plays': 0
-        }
         track_id = track['track']['id']
-        summary_of_tracks[track_id] = track_summary
+        summary_of_tracks[track_id] = summarize_track(track['track'])
         total_tracks += 1
     logger.info('Finished getting saved tracks. Total: %d' % (total_tracks, ))
 
     return summary_of_tracks
 
 
+def summarize_track(track, album=None):
+    '''
+    Keeps only the data of a track relevant to us, in the format of the saved
+    songs.
+
+    Parameters
+    ----------
+    track : dict
+        Track object returned by Spotify
+    album : dict
+        Album of the track. Needed for the tracks of an album, which come
+        without it
+
+    Returns
+    -------
+    dict
+        Summary of the track
+    '''
+    if album is None:
+        album = track['album']
+    return {
+        'name': track['name'],
+        'artists': {artist['id']: artist['name']
+                    for artist in track['artists']},
+        'album': album['name'],
+        'album_id': album['id'],
+        'uri': track['uri'],
+        'duration_ms': track['duration_ms'],
+        'no_of_plays': 0
+    }
+
+
+def get_paged_items(url, headers, payload=None):
+    '''
+    Gets all the items of a paged response of Spotify, following the url to
+    the next chunk until there is none.
+
+    Parameters
+    ----------
+    url : string
+        URL of the first chunk
+    headers : dict
+        Headers of the requests
+    payload : dict
+        Query params of the first request. The urls of the next chunks
+        already have them
+
+    Returns
+    -------
+    list
+        The items of all the chunks
+    '''
+    logger = logging.getLogger('spotify')
+    items = []
+    while url is not None:
+        logger.debug(('Sending the request..\n'
+                      'URL: %s\n'
+                      'Query params: %s') % (url,
+                                             json.dumps(payload, indent=1)))
+        response = send_request('get', url, headers=headers, params=payload)
+        if response.status_code != 200:
+            logger.error(response.content)
+            raise ValueError('Something went wrong with the songs request')
+        response_dic = response.json()
+        url = response_dic['next']
+        payload = None
+        items += response_dic['items']
+    return items
+
+
+def get_playlist_snapshot(spotify_env, playlist_id):
+    '''
+    Gets the snapshot id of a playlist. It changes every time the playlist
+    changes, so the songs only need to be requested again when it does.
+    Reference: https://developer.spotify.com/documentation/web-api/reference/#category-playlists
+
+    Parameters
+    ----------
+    spotify_env : dict
+        Dictionary containing own Spotify keys, tokens, etc.
+    playlist_id : string
+        Id of the playlist
+
+    Returns
+    -------
+    string
+        The snapshot id
+    '''
+    logger = logging.getLogger('spotify')
+
+    # Refresh the access token before doing anything
+    refresh_access_token(spotify_env)
+
+    url = 'https://api.spotify.com/v1/playlists/%s' % (playlist_id, )
+    headers = {
+      'Authorization': 'Bearer %s' % (spotify_env['access_token'], )
+    }
+    payload = {
+        'fields': 'snapshot_id'
+    }
+    logger.debug(('Sending the request..\n'
+                  'URL: %s\n'
+                  'Query params: %s') % (url, json.dumps(payload, indent=1)))
+    response = send_request('get', url, headers=headers, params=payload)
+    if response.status_code != 200:
+        logger.error(response.content)
+        raise ValueError('Something went wrong checking the playlist %s' % (
+                            playlist_id, ))
+    return response.json()['snapshot_id']
+
+
+def get_playlist_tracks(spotify_env, playlist_id):
+    '''
+    Gets all the songs of a playlist. Local files and podcast episodes are
+    left out, they can't be queued by id.
+    Reference: https://developer.spotify.com/documentation/web-api/reference/#category-playlists
+
+    Parameters
+    ----------
+    spotify_env : dict
+        Dictionary containing own Spotify keys, tokens, etc.
+    playlist_id : string
+        Id of the playlist
+
+    Returns
+    -------
+    dict
+        Songs of the playlist in the format of 'get_saved_tracks'
+    '''
+    logger = logging.getLogger('spotify')
+    logger.info('Getting the songs of the playlist %s' % (playlist_id, ))
+
+    # Refresh the access token before doing anything
+    refresh_access_token(spotify_env)
+
+    url = 'https://api.spotify.com/v1/playlists/%s/tracks' % (playlist_id, )
+    headers = {
+      'Authorization': 'Bearer %s' % (spotify_env['access_token'], )
+    }
+    payload = {
+        'limit': 100,
+        'fields': ('next,items(track(type,id,name,uri,duration_ms,'
+                   'artists(id,name),album(id,name)))')
+    }
+    summary_of_tracks = {}
+    for item in get_paged_items(url, headers, payload):
+        track = item['track']
+        if track is None or track.get('type') != 'track' or \
+                track['id'] is None:
+            continue
+        summary_of_tracks[track['id']] = summarize_track(track)
+    logger.info('Songs of the playlist %s: %d' % (playlist_id,
+                                                  len(summary_of_tracks)))
+    return summary_of_tracks
+
+
+def get_album_tracks(spotify_env, album_id, etag=None):
+    '''
+    Gets all the songs of an album. If 'etag' is given the request is
+    conditional, and nothing is returned when the album didn't change.
+    Reference: https://developer.spotify.com/documentation/web-api/reference/#category-albums
+
+    Parameters
+    ----------
+    spotify_env : dict
+        Dictionary containing own Spotify keys, tokens, etc.
+    album_id : string
+        Id of the album
+    etag : string
+        ETag of the last response for this album
+
+    Returns
+    -------
+    tuple
+        The songs of the album in the format of 'get_saved_tracks' and the
+        ETag of the response. The songs are None if the album didn't change
+    '''
+    logger = logging.getLogger('spotify')
+    logger.info('Getting the songs of the album %s' % (album_id, ))
+
+    # Refresh the access token before doing anything
+    refresh_access_token(spotify_env)
+
+    url = 'https://api.spotify.com/v1/albums/%s' % (album_id, )
+    headers = {
+      'Authorization': 'Bearer %s' % (spotify_env['access_token'], )
+    }
+    album_headers = dict(headers)
+    if etag is not None:
+        album_headers['If-None-Match'] = etag
+    logger.debug(('Sending the request..\n'
+                  'URL: %s\n'
+                  'Headers: %s') % (url, json.dumps(album_headers, indent=1)))
+    response = send_request('get', url, headers=album_headers)
+    if response.status_code == 304:
+        logger.info('The album %s did not change' % (album_id, ))
+        return None, etag
+    if response.status_code != 200:
+        logger.error(response.content)
+        raise ValueError('Something went wrong getting the album %s' % (
+                            album_id, ))
+
+    album = response.json()
+    # The first chunk of songs comes with the album
+    tracks = album['tracks']['items']
+    if album['tracks']['next'] is not None:
+        tracks += get_paged_items(album['tracks']['next'], headers)
+    summary_of_tracks = {track['id']: summarize_track(track, album=album)
+                         for track in tracks}
+    logger.info('Songs of the album %s: %d' % (album_id,
+                                               len(summary_of_tracks)))
+    return summary_of_tracks, response.headers.get('ETag')
+
+
+def get_audio_features(spotify_env, track_ids, max_workers=4):
+    '''
+    Gets the audio features (tempo, energy, etc.) of several tracks.
+    The API accepts at most AUDIO_FEATURES_BATCH ids per request, the batches
+    are requested at the same time by 'max_workers' threads.
+    Reference: https://developer.spotify.com/documentation/web-api/reference/#category-tracks
+
+    Parameters
+    ----------
+    spotify_env : dict
+        Dictionary containing own Spotify keys, tokens, etc.
+    track_ids : list
+        Ids of the tracks
+    max_workers : int
+        Maximum number of requests sent at the same time
+
+    Returns
+    -------
+    dict
+        Audio features relevant to us. The keys are the ids of the tracks.
+        The tracks without audio features are None.
+    '''
+    import concurrent.futures
+
+    logger = logging.getLogger('spotify')
+    logger.info('Getting audio features of %d tracks' % (len(track_ids), ))
+    if len(track_ids) == 0:
+        return {}
+
+    # Refresh the access token before doing anything
+    refresh_access_token(spotify_env)
+
+    url = "https://api.spotify.com/v1/audio-features"
+    headers = {
+      'Authorization': 'Bearer %s' % (spotify_env['access_token'], )
+    }
+
+    # The threads of the pool share the request budget of this thread
+    limiter = getattr(_thread_state, 'limiter', None)
+
+    def get_batch(batch_ids):
+        _thread_state.limiter = limiter
+        payload = {
+            'ids': ','.join(batch_ids)
+        }
+        logger.debug(('Sending the request..\n'
+                      'URL: %s\n'
+                      'Query params: %s\n') % (url,
+                                               json.dumps(payload, indent=1)))
+        response = send_request('get', url, headers=headers, params=payload)
+        if response.status_code != 200:
+            logger.error(response.content)
+            raise ValueError('Something went wrong getting audio features')
+        # The features come in the order of the ids
+        return zip(batch_ids, response.json()['audio_features'])
+
+    batches = [track_ids[i:i + AUDIO_FEATURES_BATCH]
+               for i in range(0, len(track_ids), AUDIO_FEATURES_BATCH)]
+    audio_features = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as pool:
+        for batch_features in pool.map(get_batch, batches):
+            for track_id, features in batch_features:
+                # Spotify returns null for the tracks without features
+                if features is None:
+                    audio_features[track_id] = None
+                    continue
+                audio_features[track_id] = {
+                    feature: features.get(feature)
+                    for feature in AUDIO_FEATURES
+                }
+    logger.info('Got audio features of %d tracks' % (
+                    sum(features is not None
+                        for features in audio_features.values()), ))
+
+    return audio_features
+
+
 def add_song_to_queue(spotify_env, uri_song):
     '''
     Add a song to the queue of the active device.
@@ -201,13 +668,8 @@ def add_song_to_queue(spotify_env, uri_song):
     logger = logging.getLogger('spotify')
     logger.info('Adding song to queue. URI: %s' % (uri_song, ))
 
-    try:
-        # Refresh the access token before doing anything
-        security_refresh_token(spotify_env)
-    except ValueError:
-        logger.info('Could not refresh access token. Try to get new one')
-        # Maybe we havent exchanged the user_code. Try to exchange for tokens
-        security_refresh_token(spotify_env)
+    # Refresh the access token before doing anything
+    refresh_access_token(spotify_env)
 
     # Building the request
     url = "https://api.spotify.com/v1/me/player/queue"
@@ -223,7 +685,7 @@ def add_song_to_queue(spotify_env, uri_song):
                   'Query params: %s\n') % (url,
                                            json.dumps(headers, indent=1),
                                            json.dumps(payload, indent=1)))
-    response = requests.post(url, headers=headers, params=payload)
+    response = send_request('post', url, headers=headers, params=payload)
 
     if response.status_code != 204:
         logger.error(response.content)
@@ -232,11 +694,133 @@ def add_song_to_queue(spotify_env, uri_song):
 
     logger.debug(response.content)
     logger.info('Song added to the queue. URI: %s' % (uri_song, ))
+    # The history may change now that something new is going to play
+    _recently_played_cache.invalidate()
+
+
+def get_currently_playing(spotify_env):
+    '''
+    Gets the song that is playing in the active device.
+    Reference: https://developer.spotify.com/documentation/web-api/reference/#category-player
+
+    Parameters
+    ----------
+    spotify_env : dict
+        Dictionary containing own Spotify keys, tokens, etc.
+
+    Returns
+    -------
+    dict
+        The keys: 'id' and 'uri' of the song (None if what plays is not a
+        song, e.g. an ad), 'is_playing', 'progress_ms' and 'duration_ms'.
+        None if nothing is playing
+    '''
+    logger = logging.getLogger('spotify')
+    logger.debug('Checking currently playing song')
+
+    # Refresh the access token before doing anything
+    refresh_access_token(spotify_env)
+
+    # Building the request
+    url = "https://api.spotify.com/v1/me/player/currently-playing"
+    headers = {
+      'Authorization': 'Bearer %s' % (spotify_env['access_token'], ),
+      "Accept": "application/json"
+    }
+    logger.debug(('Sending the request..\n'
+                  'URL: %s\n'
+                  'Headers: %s') % (url,
+                                    json.dumps(headers, indent=1)))
+    response = send_request('get', url, headers=headers)
+
+    # There is no active device
+    if response.status_code == 204:
+        return None
+    if response.status_code != 200:
+        logger.error(response.content)
+        raise ValueError('Something went wrong getting currently playing song')
+
+    response_dic = response.json()
+    item = response_dic.get('item')
+    if item is None:
+        item = {}
+    return {
+        'id': item.get('id'),
+        'uri': item.get('uri'),
+        'is_playing': response_dic.get('is_playing', False),
+        'progress_ms': response_dic.get('progress_ms') or 0,
+        'duration_ms': item.get('duration_ms') or 0
+    }
+
+
+def get_queue(spotify_env):
+    '''
+    Gets the queue of the active device with a single request: the song
+    playing and the next songs (at most QUEUE_VIEW_SIZE).
+    Reference: https://developer.spotify.com/documentation/web-api/reference/#category-player
+
+    Parameters
+    ----------
+    spotify_env : dict
+        Dictionary containing own Spotify keys, tokens, etc.
+
+    Returns
+    -------
+    dict
+        The keys: 'currently_playing', the uri of the song playing (None if
+        nothing plays), and 'queue', the uris of the next songs in order
+    '''
+    logger = logging.getLogger('spotify')
+    logger.debug('Checking the queue of the device')
+
+    # Refresh the access token before doing anything
+    refresh_access_token(spotify_env)
+
+    # Building the request
+    url = "https://api.spotify.com/v1/me/player/queue"
+    headers = {
+      'Authorization': 'Bearer %s' % (spotify_env['access_token'], ),
+      "Accept": "application/json"
+    }
+    logger.debug(('Sending the request..\n'
+                  'URL: %s\n'
+                  'Headers: %s') % (url,
+                                    json.dumps(headers, indent=1)))
+    response = send_request('get', url, headers=headers)
+    if response.status_code != 200:
+        logger.error(response.content)
+        raise ValueError('Something went wrong getting the queue')
+
+    response_dic = response.json()
+    currently_playing = response_dic.get('currently_playing') or {}
+    return {
+        'currently_playing': currently_playing.get('uri'),
+        'queue': [item['uri'] for item in response_dic.get('queue') or []
+                  if item is not None]
+    }
+
+
+def set_recently_played_ttl(seconds):
+    '''
+    Sets during how many seconds a response of 'get_recently_played' is
+    reused by the next calls. Sending a song to the queue always forgets
+    the cached responses.
+
+    Parameters
+    ----------
+    seconds : float
+        Seconds during which a response is reused. If <= 0 it is not reused
+    '''
+    _recently_played_cache.ttl = seconds
+    _recently_played_cache.invalidate()
 
 
 def get_recently_played(spotify_env, number_songs):
     '''
     Gets all the songs that have recently played from Spotify history.
+    Calls arriving within the window of 'set_recently_played_ttl' reuse the
+    last response and calls arriving while a request is being sent wait for
+    its response, so neither the token nor the history are requested again.
     Reference: https://developer.spotify.com/documentation/web-api/reference/#category-player
 
     Parameters
@@ -251,16 +835,37 @@ def get_recently_played(spotify_env, number_songs):
     dict
         The songs that have recently played
     '''
+    # Every account has its own history
+    key = (spotify_env.get('refresh_token'), number_songs)
+    return _recently_played_cache.get(
+                key,
+                lambda: fetch_recently_played(spotify_env, number_songs)
+            )
+
+
+def fetch_recently_played(spotify_env, number_songs):
+    '''
+    Requests the songs that have recently played from Spotify history without
+    using the cache. Check 'get_recently_played'.
+
+    Parameters
+    ----------
+    spotify_env : dict
+        Dictionary containing own Spotify keys, tokens, etc.
+    number_songs : int
+        Number of songs to look back in history. Max: 50
+
+    Returns
+    -------
+    dict
+        The songs that have recently played. The keys are the ids of the
+        songs and 'played_at' has every time the song played, newest first.
+    '''
     logger = logging.getLogger('spotify')
     logger.info('Checking recently played songs')
 
-    try:
-        # Refresh the access token before doing anything
-        security_refresh_token(spotify_env)
-    except ValueError:
-        logger.info('Could not refresh access token. Try to get new one')
-        # Maybe we havent exchanged the user_code. Try to exchange for tokens
-        security_refresh_token(spotify_env)
+    # Refresh the access token before doing anything
+    refresh_access_token(spotify_env)
 
     if number_songs > 50:
         number_get_songs = 50
@@ -283,7 +888,7 @@ def get_recently_played(spotify_env, number_songs):
                   'Query params: %s') % (url,
                                          json.dumps(headers, indent=1),
                                          json.dumps(payload, indent=1)))
-    response = requests.get(url, headers=headers, params=payload)
+    response = send_request('get', url, headers=headers, params=payload)
 
     if response.status_code != 200:
         logger.error(response.content)
@@ -300,7 +905,7 @@ def get_recently_played(spotify_env, number_songs):
                       'URL: %s\n'
                       'Headers: %s') % (url,
                                         json.dumps(headers, indent=1)))
-        response = requests.get(url, headers=headers)
+        response = send_request('get', url, headers=headers)
         if response.status_code == 200:
             response_dic = response.json()
         else:
@@ -315,15 +920,20 @@ def get_recently_played(spotify_env, number_songs):
     total_tracks = 0
     summary_of_tracks = {}
     for track in played_songs:
+        track_id = track['track']['id']
+        # A song that played several times keeps the time of every play
+        if track_id in summary_of_tracks:
+            summary_of_tracks[track_id]['played_at'].append(track['played_at'])
+            continue
         track_summary = {
             'name': track['track']['name'],
-            'artists': ["%s. ID: %s" % (artist['name'], artist['id'])
-                        for artist in track['track']['artists']],
+            'artists': {artist['id']: artist['name']
+                        for artist in track['track']['artists']},
             'album': track['track']['album']['name'],
             'album_id': track['track']['album']['id'],
-            'uri': track['track']['uri']
+            'uri': track['track']['uri'],
+            'played_at': [track['played_at']]
         }
-        track_id = track['track']['id']
         summary_of_tracks[track_id] = track_summary
         total_tracks += 1
     logger.info('Got %d recently played tracks.' % (total_tracks, ))
@@ -0,0 +1,176 @@
+import os
+import time
+import glob
+import datetime
+import logging
+import concurrent.futures
+import utils
+import spotify_api
+import spotify_helper
+
+# Actions that can run for several accounts without a human listening
+BATCH_ACTIONS = ['download_saved_songs',
+                 'compare_saved_songs',
+                 'get_recently_played_songs']
+
+
+def find_env_files(batch_env):
+    '''
+    Gets the Spotify environment files of the accounts of a batch.
+
+    Parameters
+    ----------
+    batch_env : list
+        Paths to JSON files with the keys of an account or to directories
+        containing those JSON files
+
+    Returns
+    -------
+    list
+        Sorted paths to the JSON files of every account. Two files with the
+        same name, e.g. in different directories, are not accepted
+    '''
+    env_files = []
+    for path in batch_env:
+        if os.path.isdir(path):
+            env_files += glob.glob(os.path.join(path, '*.json'))
+        elif os.path.isfile(path):
+            env_files.append(path)
+        else:
+            raise NameError('The specified file was not found! %s' % (path, ))
+    # The same account twice would write the same files at the same time
+    env_files = sorted(set(os.path.realpath(env_file) for env_file in env_files))
+    # So would two accounts with the same results directory
+    accounts = {}
+    for env_file in env_files:
+        accounts.setdefault(account_name(env_file), []).append(env_file)
+    repeated = [paths for paths in accounts.values() if len(paths) > 1]
+    if len(repeated) > 0:
+        raise ValueError('Accounts with the same name would share their '
+                         'results. Rename the JSON files: %s' % (
+                            '; '.join(', '.join(paths) for paths in repeated), ))
+    return env_files
+
+
+def account_name(spotify_env_file):
+    '''
+    Name of the account of a Spotify environment file, the name of the file
+    without extension. It is also the name of its results directory.
+    '''
+    return os.path.splitext(os.path.basename(spotify_env_file))[0]
+
+
+def run_account(action, spotify_env_file, results_dir, all_songs_file,
+                requests_per_second):
+    '''
+    Runs the action for one account of the batch. The results of the account
+    are stored in its own directory 'results_dir/<name of the env file>'.
+
+    Parameters
+    ----------
+    action : str
+        Command to perform for the account
+    spotify_env_file : str
+        JSON file containing the Spotify keys, tokens, etc. of the account
+    results_dir : str
+        Name of the folder in which the results dir of the account is created
+    all_songs_file : str
+        Name of the JSON file with the saved songs in the library
+    requests_per_second : float
+        Maximum requests per second sent for this account
+
+    Returns
+    -------
+    dict
+        Summary of the run of the account
+    '''
+    logger = logging.getLogger('spotify')
+    account = account_name(spotify_env_file)
+    account_results_dir = os.path.join(results_dir, account)
+    logger.info('Batch: starting %s for account %s' % (action, account))
+
+    start_time = time.time()
+    spotify_api.set_request_budget(requests_per_second)
+    spotify_env = utils.open_json_file(spotify_env_file)
+    loaded_spotify_env = dict(spotify_env)
+    try:
+        spotify_helper.run_action(action=action,
+                                  spotify_env=spotify_env,
+                                  results_dir=account_results_dir,
+                                  all_songs_file=all_songs_file,
+                                  refresh_time=None)
+    finally:
+        # The thread is reused by other accounts
+        spotify_api.set_request_budget(None)
+        # Writes again the Spotify environment only if the token changed
+        if spotify_env != loaded_spotify_env:
+            utils.write_json_file(spotify_env_file, spotify_env)
+
+    elapsed_delta = datetime.timedelta(seconds=time.time() - start_time)
+    logger.info('Batch: finished account %s in %s' % (account, elapsed_delta))
+    return {'account': account, 'elapsed_time': str(elapsed_delta)}
+
+
+def run_batch(action, batch_env, results_dir, all_songs_file, batch_workers,
+              requests_per_second):
+    '''
+    Runs the same action for several accounts at the same time on a bounded
+    pool of workers. All the workers share the connections to Spotify while
+    every account keeps its own request budget and results directory.
+
+    Parameters
+    ----------
+    action : str
+        Command to perform for every account. One of BATCH_ACTIONS
+    batch_env : list
+        Paths to JSON files with the keys of an account or to directories
+        containing those JSON files
+    results_dir : str
+        Name of the folder in which the results dir of every account is created
+    all_songs_file : str
+        Name of the JSON file with the saved songs in the library
+    batch_workers : int
+        Maximum number of accounts handled at the same time
+    requests_per_second : float
+        Maximum requests per second sent for each account
+
+    Returns
+    -------
+    list
+        Summary of the run of every account. The accounts that failed
+        have the key 'error'
+    '''
+    logger = logging.getLogger('spotify')
+    if action not in BATCH_ACTIONS:
+        raise ValueError('Action %s cannot run in batch. Available: %s' % (
+                            action, BATCH_ACTIONS))
+
+    env_files = find_env_files(batch_env)
+    logger.info('Batch: running %s for %d accounts with %d workers' % (
+                    action, len(env_files), batch_workers))
+    spotify_api.configure_session(pool_size=batch_workers)
+
+    summaries = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=batch_workers) as pool:
+        futures = {
+            pool.submit(run_account,
+                        action=action,
+                        spotify_env_file=env_file,
+                        results_dir=results_dir,
+                        all_songs_file=all_songs_file,
+                        requests_per_second=requests_per_second): env_file
+            for env_file in env_files
+        }
+        for future in concurrent.futures.as_completed(futures):
+            env_file = futures[future]
+            try:
+                summaries.append(future.result())
+            except Exception as e:
+                # One account failing should not stop the others
+                logger.exception('Batch: error with account %s' % (env_file, ))
+                summaries.append({'account': env_file, 'error': str(e)})
+
+    number_errors = len([summary for summary in summaries if 'error' in summary])
+    logger.info('Batch: finished. Accounts: %d. With errors: %d' % (
+                    len(summaries), number_errors))
+    return summaries
@@ -0,0 +1,563 @@
+import os
+import time
+import json
+import socket
+import logging
+import threading
+import socketserver
+import utils
+import play_session
+import spotify_helper
+
+
+def load_daemon_state(spotify_env, spotify_env_file, results_dir,
+                      all_songs_file, refresh_time, repeat_artist=20,
+                      plan_file=None, history_file=None):
+    '''
+    Loads once the state that the daemon keeps in memory: the Spotify
+    environment (keys and tokens) and the saved songs of our library.
+
+    Parameters
+    ----------
+    spotify_env : dict
+        Dictionary containing own Spotify keys, tokens, etc.
+    spotify_env_file : string
+        JSON file where 'spotify_env' is persisted
+    results_dir : string
+        Name of the folder where the JSON all_songs_file is stored
+    all_songs_file : string
+        Name of the JSON file with the saved songs in our library
+    refresh_time : int
+        Accepted number of days since the last update of the saved songs
+    repeat_artist : int
+        Parameter 'repeat_artist' of the plan of the next session
+    plan_file : string
+        Name of the JSON file with the plan of the next session. If None
+        no plan is made
+    history_file : string
+        Name of the SQLite file where the detected plays are stored. If None
+        they are only counted
+
+    Returns
+    -------
+    dict
+        State of the daemon
+    '''
+    # A refresh of the token while loading must also be persisted
+    loaded_env = dict(spotify_env)
+    saved_songs, artist_index = spotify_helper.load_saved_songs(
+                                    all_songs_file=all_songs_file,
+                                    results_dir=results_dir,
+                                    spotify_env=spotify_env,
+                                    refresh_time=refresh_time,
+                                    with_artist_index=True
+                                )
+    if artist_index is None:
+        artist_index = utils.build_artist_index(saved_songs)
+    daemon_state = {
+        'spotify_env_file': spotify_env_file,
+        'spotify_env': spotify_env,
+        'results_dir': results_dir,
+        'all_songs_file': all_songs_file,
+        'saved_songs': saved_songs,
+        # Songs of every artist, used by the shuffle
+        'artist_index': artist_index,
+        'repeat_artist': repeat_artist,
+        'plan_file': plan_file,
+        'history_file': history_file,
+        # Songs sent to the queue that have not been detected to play
+        'programmed_songs': [],
+        # Sent songs to look for in the queue of the device. The number of
+        # retries is given by every play request
+        'queue_check': spotify_helper.start_queue_check(queue_retries=0),
+        # Flags to only write to disk what changed
+        'songs_dirty': False,
+        # While a sync runs only the sync writes the saved songs to disk
+        'syncing': False,
+        'persisted_env': loaded_env,
+        # Every job or request works on the state holding this lock
+        'lock': threading.RLock(),
+        'stop_event': threading.Event()
+    }
+    persist_state(daemon_state)
+    return daemon_state
+
+
+def persist_state(daemon_state):
+    '''
+    Writes to disk the parts of the state that changed since the last write.
+    The saved songs are written only when a sync or new plays changed them and
+    the Spotify environment only when a token was renewed. While a sync is
+    running the saved songs are written when it ends, check 'sync_job'.
+
+    Parameters
+    ----------
+    daemon_state : dict
+        State of the daemon
+    '''
+    if daemon_state['songs_dirty'] and not daemon_state['syncing']:
+        saved_songs_path = os.path.join(daemon_state['results_dir'],
+                                        daemon_state['all_songs_file'])
+        utils.write_library(saved_songs_path, daemon_state['saved_songs'])
+        daemon_state['songs_dirty'] = False
+
+    if daemon_state['persisted_env'] != daemon_state['spotify_env']:
+        utils.write_json_file(daemon_state['spotify_env_file'],
+                              daemon_state['spotify_env'])
+        daemon_state['persisted_env'] = dict(daemon_state['spotify_env'])
+
+
+def sync_job(daemon_state, full=False):
+    '''
+    Brings the saved songs up to date keeping the play counters that are in
+    memory. Unless 'full' is set, the songs are only downloaded if the
+    library changed, check 'sync_saved_songs' at spotify_helper.py.
+    The songs are fetched without holding the lock of the state, so the play
+    requests are not blocked meanwhile. The lock is only taken to swap in the
+    new songs with the plays detected during the fetch.
+
+    Parameters
+    ----------
+    daemon_state : dict
+        State of the daemon
+    full : bool
+        Wether to download all the songs even if the library did not change
+
+    Returns
+    -------
+    dict
+        The saved songs before the sync
+    '''
+    logger = logging.getLogger('spotify')
+    logger.info('Daemon: syncing saved songs')
+    sync_function = spotify_helper.sync_saved_songs
+    if full:
+        sync_function = spotify_helper.download_saved_songs
+    with daemon_state['lock']:
+        last_saved_songs = daemon_state['saved_songs']
+        daemon_state['syncing'] = True
+    saved_songs = last_saved_songs
+    try:
+        saved_songs = sync_function(
+                        all_songs_file=daemon_state['all_songs_file'],
+                        results_dir=daemon_state['results_dir'],
+                        spotify_env=daemon_state['spotify_env'],
+                        saved_songs=last_saved_songs
+                      )
+    finally:
+        with daemon_state['lock']:
+            daemon_state['syncing'] = False
+            if saved_songs is not last_saved_songs:
+                swap_saved_songs(daemon_state, saved_songs)
+    return last_saved_songs
+
+
+def swap_saved_songs(daemon_state, saved_songs):
+    '''
+    Replaces the saved songs of the state by the ones of a sync, that were
+    already written to disk. The plays counted in the state while the sync
+    was running are kept. Must be called holding the lock of the state.
+    '''
+    # The songs were already written to disk with the plays at the start of
+    # the sync
+    songs_dirty = False
+    for id_song, song in daemon_state['saved_songs'].items():
+        new_song = saved_songs.get(id_song)
+        if new_song is not None and \
+                new_song['no_of_plays'] != song['no_of_plays']:
+            new_song['no_of_plays'] = song['no_of_plays']
+            songs_dirty = True
+    daemon_state['saved_songs'] = saved_songs
+    daemon_state['artist_index'] = utils.build_artist_index(saved_songs)
+    daemon_state['songs_dirty'] = songs_dirty
+
+
+def compare_job(daemon_state):
+    '''
+    Syncs the saved songs and writes the differences with the songs that were
+    in memory before the sync. The lock of the state is only held to swap in
+    the new songs, check 'sync_job'.
+
+    Parameters
+    ----------
+    daemon_state : dict
+        State of the daemon
+    '''
+    logger = logging.getLogger('spotify')
+    logger.info('Daemon: comparing saved songs')
+    # The songs relinked by Spotify are only found downloading all of them
+    last_saved_songs = sync_job(daemon_state, full=True)
+    spotify_helper.write_songs_diff(last_saved_songs=last_saved_songs,
+                                    new_saved_songs=daemon_state['saved_songs'],
+                                    results_dir=daemon_state['results_dir'])
+
+
+def plan_job(daemon_state):
+    '''
+    Stores the plan of the next session if there is none or if the saved
+    songs were written after it, e.g. with new plays or songs.
+
+    Parameters
+    ----------
+    daemon_state : dict
+        State of the daemon
+    '''
+    logger = logging.getLogger('spotify')
+    if daemon_state['plan_file'] is None:
+        return
+    plan_path = os.path.join(daemon_state['results_dir'],
+                             daemon_state['plan_file'])
+    saved_songs_path = os.path.join(daemon_state['results_dir'],
+                                    daemon_state['all_songs_file'])
+    if os.path.isfile(plan_path) and os.path.isfile(saved_songs_path) and \
+            os.path.getmtime(plan_path) >= os.path.getmtime(saved_songs_path):
+        logger.debug('Daemon: the plan of the next session is up to date')
+        return
+
+    spotify_helper.plan_next_session(saved_songs=daemon_state['saved_songs'],
+                                     results_dir=daemon_state['results_dir'],
+                                     plan_file=daemon_state['plan_file'],
+                                     repeat_artist=daemon_state['repeat_artist'],
+                                     artist_index=daemon_state['artist_index'])
+
+
+def track_job(daemon_state):
+    '''
+    Checks if the songs sent to the queue by the daemon have already played,
+    and looks for the ones that did not in the queue of the device, check
+    'verify_queue' at spotify_helper.py. The recently played songs are
+    stored in the play history even if the daemon has no songs to track.
+
+    Parameters
+    ----------
+    daemon_state : dict
+        State of the daemon
+
+    Returns
+    -------
+    list
+        Ids of the songs given up because they are not in the queue
+    '''
+    logger = logging.getLogger('spotify')
+    number_programmed = len(daemon_state['programmed_songs'])
+    history_path = None
+    if daemon_state['history_file'] is not None:
+        history_path = os.path.join(daemon_state['results_dir'],
+                                    daemon_state['history_file'])
+    if number_programmed == 0 and history_path is None:
+        logger.debug('Daemon: no programmed songs to track')
+        return []
+
+    daemon_state['programmed_songs'] = spotify_helper.check_recently_played(
+                                        spotify_env=daemon_state['spotify_env'],
+                                        programmed_songs=daemon_state['programmed_songs'],
+                                        saved_songs=daemon_state['saved_songs'],
+                                        history_file=history_path
+                                    )
+    dropped_songs = spotify_helper.verify_queue(
+                        spotify_env=daemon_state['spotify_env'],
+                        saved_songs=daemon_state['saved_songs'],
+                        queue_check=daemon_state['queue_check'],
+                        programmed_songs=daemon_state['programmed_songs'],
+                        force=True
+                    )
+    drop_programmed_songs(daemon_state, dropped_songs)
+    if len(daemon_state['programmed_songs']) != number_programmed:
+        daemon_state['songs_dirty'] = True
+    logger.info('Daemon: %d programmed songs still not played' % (
+                    len(daemon_state['programmed_songs']), ))
+    return dropped_songs
+
+
+def drop_programmed_songs(daemon_state, dropped_songs):
+    '''
+    Stops tracking the songs that are not in the queue of the device.
+    '''
+    if len(dropped_songs) == 0:
+        return
+    dropped = set(dropped_songs)
+    daemon_state['programmed_songs'] = [
+        id_song for id_song in daemon_state['programmed_songs']
+        if id_song not in dropped]
+
+
+def play_request(daemon_state, repeat_artist, num_play_songs, seed=None,
+                 queue_retries=0):
+    '''
+    Sends to the queue songs of the library in a random order using the
+    songs that are already in memory. The order of the plan of the next
+    session is used when it is valid, check 'plan_job'.
+    The sent songs are looked for in the queue of the device right away and
+    then by every 'track_job' until they are seen.
+
+    Parameters
+    ----------
+    daemon_state : dict
+        State of the daemon
+    repeat_artist : int
+        This parameter is used by the randomize function 'random_all_songs'
+    num_play_songs : int
+        Number of songs to be sent to the queue
+    seed : int
+        Seed of the randomize function 'random_all_songs'
+    queue_retries : int
+        Maximum number of times a song missing from the queue is sent again.
+        If 0 the queue is not checked
+
+    Returns
+    -------
+    dict
+        Summary of the songs that were sent to the queue
+    '''
+    saved_songs = daemon_state['saved_songs']
+    ids_to_play = None
+    if daemon_state['plan_file'] is not None and seed is None:
+        plan_path = os.path.join(daemon_state['results_dir'],
+                                 daemon_state['plan_file'])
+        ids_to_play = play_session.load_plan(plan_path, saved_songs,
+                                             repeat_artist)
+        if ids_to_play is not None:
+            play_session.remove_plan(plan_path)
+    if ids_to_play is None:
+        ids_to_play = utils.random_all_songs(
+                        songs_dictionary=saved_songs,
+                        repeat_artist=repeat_artist,
+                        seed=seed,
+                        artist_index=daemon_state['artist_index'])
+    if num_play_songs == -1:
+        num_play_songs = len(ids_to_play)
+
+    queue_check = daemon_state['queue_check']
+    queue_check['queue_retries'] = queue_retries
+    programmed_songs, error_songs, _ = spotify_helper.queue_songs(
+                                        spotify_env=daemon_state['spotify_env'],
+                                        saved_songs=saved_songs,
+                                        ids_to_play=ids_to_play,
+                                        num_play_songs=num_play_songs,
+                                        queue_check=queue_check
+                                    )
+    daemon_state['programmed_songs'] += programmed_songs
+    # The songs that already played are left out before checking the queue
+    dropped_songs = track_job(daemon_state)
+    return {
+        'status': 'ok',
+        'programmed_songs': len(programmed_songs),
+        'error_songs': len(error_songs),
+        'dropped_songs': len(dropped_songs)
+    }
+
+
+def handle_request(daemon_state, request):
+    '''
+    Performs a request received by the daemon through the socket.
+    Available actions:
+    - play_saved_songs
+    - status
+    - stop
+
+    Parameters
+    ----------
+    daemon_state : dict
+        State of the daemon
+    request : dict
+        The request with the key 'action' and its parameters
+
+    Returns
+    -------
+    dict
+        Response to send back to the client
+    '''
+    action = request.get('action')
+    if action == 'play_saved_songs':
+        response = play_request(daemon_state,
+                                repeat_artist=request.get('repeat_artist', 20),
+                                num_play_songs=request.get('num_play_songs', 100),
+                                seed=request.get('seed'),
+                                queue_retries=request.get('queue_retries', 0))
+    elif action == 'status':
+        response = {
+            'status': 'ok',
+            'saved_songs': len(daemon_state['saved_songs']),
+            'programmed_songs': len(daemon_state['programmed_songs'])
+        }
+    elif action == 'stop':
+        daemon_state['stop_event'].set()
+        response = {'status': 'ok'}
+    else:
+        response = {'status': 'error',
+                    'message': 'Unknown action: %s' % (action, )}
+    return response
+
+
+class DaemonRequestHandler(socketserver.StreamRequestHandler):
+    '''
+    Reads one JSON request per line from the socket and answers with one JSON
+    response per line.
+    '''
+
+    def handle(self):
+        logger = logging.getLogger('spotify')
+        daemon_state = self.server.daemon_state
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                logger.info('Daemon: received request %s' % (request, ))
+                with daemon_state['lock']:
+                    response = handle_request(daemon_state, request)
+                    persist_state(daemon_state)
+            except Exception as e:
+                logger.exception('Daemon: error handling request')
+                response = {'status': 'error', 'message': str(e)}
+            self.wfile.write((json.dumps(response) + '\n').encode('utf-8'))
+
+
+def run_scheduler(daemon_state, jobs):
+    '''
+    Runs periodically the jobs until the daemon is stopped.
+
+    Parameters
+    ----------
+    daemon_state : dict
+        State of the daemon
+    jobs : list
+        List of tuples (function, interval in seconds, locked). A job with an
+        interval <= 0 is not run. If 'locked' the job runs holding the lock of
+        the state, otherwise the job takes it itself, e.g. to do the requests
+        to Spotify without blocking the play requests.
+    '''
+    logger = logging.getLogger('spotify')
+    stop_event = daemon_state['stop_event']
+    now = time.monotonic()
+    next_runs = [[now + interval, job, interval, locked]
+                 for job, interval, locked in jobs if interval > 0]
+
+    while not stop_event.is_set() and len(next_runs) > 0:
+        now = time.monotonic()
+        for next_run in next_runs:
+            run_at, job, interval, locked = next_run
+            if run_at > now:
+                continue
+            try:
+                if locked:
+                    with daemon_state['lock']:
+                        job(daemon_state)
+                else:
+                    job(daemon_state)
+                with daemon_state['lock']:
+                    persist_state(daemon_state)
+            except Exception:
+                logger.exception('Daemon: error running job %s' % (job.__name__, ))
+            next_run[0] = time.monotonic() + interval
+
+        wait_time = min(next_run[0] for next_run in next_runs) - \
+            time.monotonic()
+        stop_event.wait(max(wait_time, 0))
+
+
+def run_daemon(spotify_env, spotify_env_file, results_dir, all_songs_file,
+               refresh_time, socket_path, sync_interval, compare_interval,
+               sleep_time, repeat_artist=20, plan_file=None,
+               history_file=None):
+    '''
+    Long-running mode of the script. The library, the token and the play
+    counters are loaded once and kept in memory.
+    A scheduler periodically syncs and compares the saved songs, tracks the
+    songs that were sent to the queue and keeps the plan of the next session
+    up to date. Playback requests are accepted through
+    a local Unix socket, check 'send_daemon_request'.
+
+    Parameters
+    ----------
+    spotify_env : dict
+        Dictionary containing own Spotify keys, tokens, etc.
+    spotify_env_file : string
+        JSON file where 'spotify_env' is persisted
+    results_dir : string
+        Name of the folder where the JSON all_songs_file is stored
+    all_songs_file : string
+        Name of the JSON file with the saved songs in our library
+    refresh_time : int
+        Accepted number of days since the last update of the saved songs
+    socket_path : string
+        Path of the Unix socket in which the daemon listens
+    sync_interval : float
+        Minutes between syncs of the saved songs
+    compare_interval : float
+        Minutes between compares of the saved songs
+    sleep_time : float
+        Minutes between checks of the recently played songs
+    repeat_artist : int
+        Parameter 'repeat_artist' of the plan of the next session
+    plan_file : string
+        Name of the JSON file with the plan of the next session. It is
+        updated every 'sleep_time' minutes if the saved songs changed
+    history_file : string
+        Name of the SQLite file where the detected plays are stored
+    '''
+    logger = logging.getLogger('spotify')
+    daemon_state = load_daemon_state(spotify_env=spotify_env,
+                                     spotify_env_file=spotify_env_file,
+                                     results_dir=results_dir,
+                                     all_songs_file=all_songs_file,
+                                     refresh_time=refresh_time,
+                                     repeat_artist=repeat_artist,
+                                     plan_file=plan_file,
+                                     history_file=history_file)
+
+    # Remove a socket left behind by a daemon that did not stop cleanly
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    server = socketserver.ThreadingUnixStreamServer(socket_path,
+                                                   DaemonRequestHandler)
+    server.daemon_state = daemon_state
+    server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+    server_thread.start()
+    logger.info('Daemon listening at: %s' % (socket_path, ))
+
+    # The syncs only take the lock to swap in the new songs
+    jobs = [
+        (sync_job, sync_interval*60, False),
+        (compare_job, compare_interval*60, False),
+        (track_job, sleep_time*60, True),
+        (plan_job, sleep_time*60, True)
+    ]
+    try:
+        run_scheduler(daemon_state, jobs)
+    except KeyboardInterrupt:
+        logger.info('Interrupting daemon.')
+    finally:
+        server.shutdown()
+        server.server_close()
+        os.remove(socket_path)
+        with daemon_state['lock']:
+            # Last check of the songs that played before exiting
+            try:
+                track_job(daemon_state)
+            finally:
+                persist_state(daemon_state)
+        logger.info('Daemon stopped, bye! :)')
+
+
+def send_daemon_request(socket_path, request):
+    '''
+    Sends a request to a running daemon and waits for its response.
+
+    Parameters
+    ----------
+    socket_path : string
+        Path of the Unix socket in which the daemon listens
+    request : dict
+        The request with the key 'action' and its parameters
+
+    Returns
+    -------
+    dict
+        Response of the daemon
+    '''
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(socket_path)
+        client.sendall((json.dumps(request) + '\n').encode('utf-8'))
+        response = client.makefile('r').readline()
+    if response == '':
+        raise ValueError('The daemon closed the connection without answering')
+    return json.loads(response)
@@ -4,16 +4,79 @@ import time
 import json
 import datetime
 import logging
-import logging.config
 import argparse
+import threading
 import utils
 import spotify_api
+import play_session
+import play_history
+import search_index
+import song_sources
+
+# Options of a play session and their default values, check
+# 'play_saved_songs'. The defaults of the command line are taken from here
+SESSION_DEFAULTS = {
+    'repeat_artist': 20,
+    'num_play_songs': 100,
+    'sleep_time': 5,
+    'not_wait_songs_to_play': True,
+    'resume': False,
+    'session_file': 'play_session.jsonl',
+    'bpm_range': None,
+    'audio_features_file': 'audio_features.json',
+    'lookahead': None,
+    'seed': None,
+    'plan_file': None,
+    'song_filter': None,
+    'index_file': 'search_index.json',
+    'target_minutes': None,
+    'target_tolerance': 2,
+    'sources': None,
+    'sources_dir': 'sources',
+    'source_plays_file': 'source_plays.json',
+    'history_file': 'play_history.db',
+    'queue_retries': 2,
+}
+
+# Options of a play session sent to the daemon with --use_daemon. The daemon
+# has no way to use the rest, check 'play_request' at spotify_daemon.py
+DAEMON_SESSION_OPTIONS = ('repeat_artist', 'seed', 'num_play_songs',
+                          'queue_retries')
+
+# Command line flags of the options with another name
+SESSION_FLAGS = {'song_filter': '--filter'}
+
+
+def session_options(**options):
+    '''
+    Groups the options of a play session. The options that are not given
+    take their value from SESSION_DEFAULTS.
+
+    Parameters
+    ----------
+    options : dict
+        Options of the session by name, check 'play_saved_songs'
+
+    Returns
+    -------
+    argparse.Namespace
+        Object with one attribute for every option in SESSION_DEFAULTS
+    '''
+    unknown = set(options) - set(SESSION_DEFAULTS)
+    if len(unknown) > 0:
+        raise ValueError('Unknown options of the session: %s' % (
+                            ', '.join(sorted(unknown)), ))
+    return argparse.Namespace(**dict(SESSION_DEFAULTS, **options))
 
 
-def download_saved_songs(all_songs_file, results_dir, spotify_env):
+def download_saved_songs(all_songs_file, results_dir, spotify_env,
+                         saved_songs=None, index_file='search_index.json',
+                         library_state=None):
     '''
     Checks the saved songs that we have in our library in Spotify and stores
-    the metadata of the songs in a JSON file 'results_dir/all_songs_file'
+    the metadata of the songs in a JSON file 'results_dir/all_songs_file'.
+    The state of the library (number of songs and date of the newest one) is
+    stored in 'spotify_env', check 'sync_saved_songs'.
 
     Parameters
     ----------
@@ -23,6 +86,15 @@ def download_saved_songs(all_songs_file, results_dir, spotify_env):
         Name of the folder to store a JSON with the saved songs
     spotify_env : dict
         Dictionary containing own Spotify keys, tokens, etc.
+    saved_songs : dict
+        Songs already loaded in memory. If given, the counts of 'no_of_plays'
+        are taken from here instead of reading again 'all_songs_file'
+    index_file : string
+        Name of the JSON file with the search index in 'results_dir'. If it
+        exists only the songs that changed are indexed again
+    library_state : dict
+        State of the library as returned by spotify_api/get_library_state.
+        If None it is requested
 
     Returns
     -------
@@ -33,6 +105,8 @@ def download_saved_songs(all_songs_file, results_dir, spotify_env):
     logger.info('Downloading saved tracks')
 
     # Get all my saved songs
+    if library_state is None:
+        library_state = spotify_api.get_library_state(spotify_env)
     summary_of_songs = spotify_api.get_saved_tracks(spotify_env)
 
     # Creating a directory for the results of the script
@@ -41,28 +115,58 @@ def download_saved_songs(all_songs_file, results_dir, spotify_env):
 
     # Write the results for getting all saved songs
     all_saved_songs_file = os.path.join(results_dir, all_songs_file)
-    if os.path.isfile(all_saved_songs_file):
+    if saved_songs is not None or os.path.isfile(all_saved_songs_file):
         logger.info('File %s exists. Updating' % (all_saved_songs_file, ))
         # Not losing the counts of 'no_of_plays' of the previous stored file
-        all_saved_songs = utils.open_json_file(all_saved_songs_file)
-        for old_song_id, old_song_data in all_saved_songs.items():
+        if saved_songs is None:
+            play_counts = utils.load_play_counts(all_saved_songs_file)
+        else:
+            play_counts = {old_song_id: old_song_data['no_of_plays']
+                           for old_song_id, old_song_data in saved_songs.items()}
+        missing_songs = 0
+        for old_song_id, old_song_plays in play_counts.items():
             if old_song_id in summary_of_songs:
-                summary_of_songs[old_song_id]['no_of_plays'] = old_song_data['no_of_plays']
+                summary_of_songs[old_song_id]['no_of_plays'] = old_song_plays
+            else:
+                missing_songs += 1
+
+        # Songs relinked by Spotify have a new id. Keep their counts as well
+        new_songs = len(summary_of_songs) - (len(play_counts) - missing_songs)
+        if missing_songs > 0 and new_songs > 0:
+            if saved_songs is None:
+                saved_songs = utils.load_library(all_saved_songs_file)
+            differences = utils.diff_saved_songs(last_saved_songs=saved_songs,
+                                                 new_saved_songs=summary_of_songs)
+            for old_song_id, new_song_id in differences['relinked'].items():
+                logger.info('Song relinked: %s -> %s' % (old_song_id,
+                                                         new_song_id))
+                summary_of_songs[new_song_id]['no_of_plays'] = play_counts[old_song_id]
+
+        index_path = os.path.join(results_dir, index_file)
+        if os.path.isfile(index_path):
+            if saved_songs is None:
+                saved_songs = utils.load_library(all_saved_songs_file)
+            search_index.sync_index(index_path,
+                                    last_saved_songs=saved_songs,
+                                    new_saved_songs=summary_of_songs)
     else:
         logger.info('File %s does not exist. Creating' % (all_saved_songs_file, ))
 
     # Updating the last date we downloaded the data
     now_time = datetime.datetime.now()
     spotify_env['saved_songs_updated_at'] = now_time.strftime('%d-%m-%Y')
-    
+    spotify_env['saved_songs_total'] = library_state['total']
+    spotify_env['saved_songs_newest_added_at'] = library_state['newest_added_at']
+
     # Writes the new or updated songs
-    utils.write_json_file(all_saved_songs_file, summary_of_songs)
+    utils.write_library(all_saved_songs_file, summary_of_songs)
 
     logger.info('Downloaded saved tracks at: %s' % (all_saved_songs_file, ))
     return summary_of_songs
 
 
-def compare_saved_songs(all_songs_file, results_dir, spotify_env):
+def compare_saved_songs(all_songs_file, results_dir, spotify_env,
+                        index_file='search_index.json'):
     '''
     Checks for a previous JSON file of saved songs and gets the difference
     between the old one and the current one.
@@ -75,6 +179,8 @@ def compare_saved_songs(all_songs_file, results_dir, spotify_env):
         Name of the folder where the JSON all_songs_file is stored
     spotify_env : dict
         Dictionary containing own Spotify keys, tokens, etc.
+    index_file : string
+        Name of the JSON file with the search index
 
     Returns
     -------
@@ -89,40 +195,98 @@ def compare_saved_songs(all_songs_file, results_dir, spotify_env):
     if not os.path.isfile(last_saved_songs_path):
         logger.info('Cannot do diff. There are no past saved songs')
         return
-    last_saved_songs = utils.open_json_file(last_saved_songs_path)
+    last_saved_songs = utils.load_library(last_saved_songs_path)
 
     logger.debug('Checking for new songs')
     new_saved_songs = download_saved_songs(all_songs_file=all_songs_file,
                                            results_dir=results_dir,
-                                           spotify_env=spotify_env)
+                                           spotify_env=spotify_env,
+                                           saved_songs=last_saved_songs,
+                                           index_file=index_file)
     logger.debug('New songs and last saved songs gotten')
 
-    ids_last_songs = set(last_saved_songs.keys())
-    ids_new_songs = set(new_saved_songs.keys())
+    return write_songs_diff(last_saved_songs=last_saved_songs,
+                            new_saved_songs=new_saved_songs,
+                            results_dir=results_dir)
 
-    # Getting the difference between old songs and new songs
-    ids_not_in_new = ids_last_songs - ids_new_songs
-    logger.debug('IDs lost: %s' % (ids_not_in_new, ))
-    ids_not_in_last = ids_new_songs - ids_last_songs
-    logger.debug('New IDs: %s' % (ids_not_in_last, ))
+
+def write_songs_diff(last_saved_songs, new_saved_songs, results_dir):
+    '''
+    Gets the difference between two versions of our saved songs and writes it
+    to a JSON file in 'results_dir'
+
+    Parameters
+    ----------
+    last_saved_songs : dict
+        Saved songs in our library before the last update
+    new_saved_songs : dict
+        Saved songs in our library after the last update
+    results_dir : string
+        Name of the folder where the diff is written
+
+    Returns
+    -------
+    str
+        Path to the file where the output differences were written
+    '''
+    logger = logging.getLogger('spotify')
+
+    differences = utils.diff_saved_songs(last_saved_songs=last_saved_songs,
+                                         new_saved_songs=new_saved_songs)
+    logger.debug('IDs lost: %s' % (differences['removed'], ))
+    logger.debug('New IDs: %s' % (differences['added'], ))
+    logger.debug('Relinked IDs: %s' % (differences['relinked'], ))
 
     now_time = datetime.datetime.now()
     diff_dict = {
         'checked_time': str(now_time),
         'diff_songs': {
             'lost_songs': {},
-            'new_songs': {}
+            'new_songs': {},
+            'relinked_songs': {},
+            'metadata_changed_songs': {}
         }
     }
     # Writing the differences to the dictionary diff_dict
-    for track_id in ids_not_in_new:
+    for track_id in differences['removed']:
         diff_dict['diff_songs']['lost_songs'][track_id] = last_saved_songs[track_id]
         logger.debug('Adding lost song since last diff: %s' % (track_id, ))
 
-    for track_id in ids_not_in_last:
+    for track_id in differences['added']:
         diff_dict['diff_songs']['new_songs'][track_id] = new_saved_songs[track_id]
         logger.debug('Adding new song since last diff: %s' % (track_id, ))
 
+    # A relinked song is not lost, Spotify only changed its id
+    number_metadata_changed = len(differences['metadata_changed'])
+    for old_track_id, new_track_id in differences['relinked'].items():
+        diff_dict['diff_songs']['relinked_songs'][old_track_id] = {
+            'new_id': new_track_id,
+            'song': new_saved_songs[new_track_id]
+        }
+        logger.debug('Adding relinked song since last diff: %s -> %s' % (
+                        old_track_id, new_track_id))
+        # The relink matches names that only differ in letter case
+        if not utils.same_metadata(last_saved_songs[old_track_id],
+                                   new_saved_songs[new_track_id]):
+            diff_dict['diff_songs']['metadata_changed_songs'][old_track_id] = {
+                'old': last_saved_songs[old_track_id],
+                'new': new_saved_songs[new_track_id],
+                'new_id': new_track_id
+            }
+            number_metadata_changed += 1
+
+    for track_id in differences['metadata_changed']:
+        diff_dict['diff_songs']['metadata_changed_songs'][track_id] = {
+            'old': last_saved_songs[track_id],
+            'new': new_saved_songs[track_id]
+        }
+        logger.debug('Adding song with new metadata since last diff: %s' % (
+                        track_id, ))
+
+    logger.info('Lost: %d. New: %d. Relinked: %d. Metadata changed: %d' % (
+                    len(differences['removed']), len(differences['added']),
+                    len(differences['relinked']), number_metadata_changed))
+
     # Writing the results of the diff
     diff_songs_file = os.path.join(results_dir,
                                    now_time.strftime('diff_songs_%Y-%m-%d-%H:%M.json'))
@@ -134,33 +298,140 @@ def compare_saved_songs(all_songs_file, results_dir, spotify_env):
     return diff_songs_file
 
 
-def play_saved_songs(all_songs_file, results_dir, spotify_env,
-                     refresh_time, repeat_artist, num_play_songs, sleep_time,
-                     not_wait_songs_to_play):
+def enrich_saved_songs(audio_features_file, results_dir, spotify_env,
+                       saved_songs):
     '''
-    Adds to our Spotify queue the saved songs in our library in a random order.
+    Gets the audio features (tempo, energy, etc.) of the saved songs. The
+    features are cached in 'results_dir/audio_features_file' by the id of the
+    song, so only the features of songs that are not in the cache are
+    requested. The songs that Spotify has no features for are cached as None
+    so they are not requested again. The cache also stores the songs sorted
+    by tempo, check 'build_tempo_index' at utils.py.
 
-    First, the function will check if we have a JSON file with our saved songs.
-    If we don't have it then it will create it.
-    If we have it then it will check when it was the last time we updated the
-    JSON file. If it has passed more than 'refresh_time' days then the function
-    will update the JSON file.
+    Parameters
+    ----------
+    audio_features_file : string
+        Name of the JSON file with the cached audio features
+    results_dir : string
+        Name of the folder where the audio_features_file is stored
+    spotify_env : dict
+        Dictionary containing own Spotify keys, tokens, etc.
+    saved_songs : dict
+        Dictionary of saved songs that we have in our Spotify library
 
-    The randomization is done in the function 'random_all_songs' at utils.py.
-    Check that function to check further details.
+    Returns
+    -------
+    dict
+        The cache with the keys 'audio_features' and 'tempo_index'
+    '''
+    logger = logging.getLogger('spotify')
 
-    The function will try to add 'num_play_songs' to the queue. If the value of
-    'num_play_songs' is equal to -1 then it will try to add to the queue all
-    the saved songs in our library.
+    audio_features_path = os.path.join(results_dir, audio_features_file)
+    if os.path.isfile(audio_features_path):
+        features_cache = utils.open_json_file(audio_features_path)
+    else:
+        features_cache = {'audio_features': {}, 'tempo_index': None}
+    audio_features = features_cache['audio_features']
 
-    Finally, the function can wait for all the songs sent to the queue to play.
-    The function will sleep every 'sleep_time' minutes and then query for the
-    recently played songs of Spotify to know if the songs sent to queue
-    actually played. This is done to increment the counter of number of plays
-    that each song has in the JSON file. The counter then can be used so that
-    in the future the  songs with less counts are played first. All of this
-    functionality can be avoided if the flag 'not_wait_songs_to_play' is set
-    to False.
+    new_ids = [id_song for id_song in saved_songs
+               if id_song not in audio_features]
+    logger.info('Songs without audio features: %d' % (len(new_ids), ))
+    if len(new_ids) == 0 and features_cache['tempo_index'] is not None:
+        return features_cache
+
+    audio_features.update(spotify_api.get_audio_features(spotify_env,
+                                                         new_ids))
+    features_cache['tempo_index'] = utils.build_tempo_index(audio_features)
+
+    os.makedirs(results_dir, exist_ok=True)
+    utils.write_json_file(audio_features_path, features_cache)
+    return features_cache
+
+
+def sync_saved_songs(all_songs_file, results_dir, spotify_env, saved_songs,
+                     index_file='search_index.json'):
+    '''
+    Brings the saved songs up to date for the cost of one request. The number
+    of songs in the library and the date of the newest one are compared with
+    the ones stored in 'spotify_env' by the last download:
+    - If they are the same the library did not change and nothing is done
+    - If only new songs were added, only those songs are downloaded
+    - Otherwise (e.g. songs were removed) all the songs are downloaded again
+    Songs relinked by Spotify don't change the state, they are only found by
+    a complete download, check 'download_saved_songs'.
+
+    Parameters
+    ----------
+    all_songs_file : string
+        Name of the JSON file with the saved songs in our library
+    results_dir : string
+        Name of the folder where the JSON all_songs_file is stored
+    spotify_env : dict
+        Dictionary containing own Spotify keys, tokens, etc.
+    saved_songs : dict
+        The saved songs of the last download
+    index_file : string
+        Name of the JSON file with the search index in 'results_dir'
+
+    Returns
+    -------
+    dict
+        Dictionary containing the songs that we have in our library
+    '''
+    logger = logging.getLogger('spotify')
+    library_state = spotify_api.get_library_state(spotify_env)
+    stored_total = spotify_env.get('saved_songs_total')
+    stored_newest = spotify_env.get('saved_songs_newest_added_at')
+    if library_state['total'] == stored_total and \
+            library_state['newest_added_at'] == stored_newest:
+        logger.info('The saved songs did not change.')
+        return saved_songs
+
+    number_new_songs = library_state['total'] - (stored_total or 0)
+    if stored_total is not None and stored_newest is not None and \
+            number_new_songs > 0:
+        new_songs = spotify_api.get_saved_tracks(spotify_env,
+                                                 added_after=stored_newest)
+        # Nothing was removed, the new songs are all the differences
+        if len(new_songs) == number_new_songs:
+            logger.info('New saved songs: %d' % (number_new_songs, ))
+            synced_songs = dict(new_songs)
+            for id_song, song in saved_songs.items():
+                if id_song in synced_songs:
+                    # The song was saved again, keep its number of plays
+                    synced_songs[id_song]['no_of_plays'] = song['no_of_plays']
+                else:
+                    synced_songs[id_song] = song
+
+            index_path = os.path.join(results_dir, index_file)
+            if os.path.isfile(index_path):
+                search_index.sync_index(index_path,
+                                        last_saved_songs=saved_songs,
+                                        new_saved_songs=synced_songs)
+            utils.write_library(os.path.join(results_dir, all_songs_file),
+                                synced_songs)
+            spotify_env['saved_songs_total'] = library_state['total']
+            spotify_env['saved_songs_newest_added_at'] = \
+                library_state['newest_added_at']
+            return synced_songs
+
+    logger.info('The saved songs changed. Downloading all of them.')
+    return download_saved_songs(all_songs_file=all_songs_file,
+                                results_dir=results_dir,
+                                spotify_env=spotify_env,
+                                saved_songs=saved_songs,
+                                index_file=index_file,
+                                library_state=library_state)
+
+
+def load_saved_songs(all_songs_file, results_dir, spotify_env, refresh_time,
+                     index_file='search_index.json', with_artist_index=False):
+    '''
+    Loads the saved songs of our library from 'results_dir/all_songs_file'.
+    If the file does not exist or it has passed more than 'refresh_time' days
+    since the last update, the saved songs are downloaded again. Otherwise
+    they are brought up to date with 'sync_saved_songs'. If Spotify cannot be
+    reached the stored songs are used.
 
     Parameters
     ----------
@@ -168,24 +439,29 @@ def play_saved_songs(all_songs_file, results_dir, spotify_env,
         Name of the JSON file with the saved songs in our library
     results_dir : string
         Name of the folder where the JSON all_songs_file is stored
+    spotify_env : dict
+        Dictionary containing own Spotify keys, tokens, etc.
     refresh_time : int
-        Accepted number of days since the last update of the saved songs
-    repeat_artist : int
-        This parameter is used by the randomize function 'random_all_songs'
-    num_play_songs : int
-        Number of songs to be sent to the queue
-    sleep_time : float
-        Minutes (can be a fraction) that the function waits before querying
-        for new recently played songs
-    not_wait_songs_to_play : boolean
-        Wether to wait or not for the songs sent to the queue to play
+        Accepted number of days since the last complete download of the
+        saved songs. If None they are only downloaded when they change
+    index_file : string
+        Name of the JSON file with the search index in 'results_dir'
+    with_artist_index : bool
+        If set the reverse index of the songs of every artist stored with the
+        songs is also returned, check 'load_library' at utils.py
 
     Returns
     -------
-    None
+    dict
+        Dictionary containing the songs that we have in our library
+    dict
+        Only if 'with_artist_index'. The ids of the songs of every artist as
+        they were stored, the songs synced since then are not in it. None if
+        the songs were downloaded
     '''
     logger = logging.getLogger('spotify')
 
+    artist_index = None
     # Try to get the list of songs in my library
     saved_songs_path = os.path.join(results_dir, all_songs_file)
     # There is no saved songs file, creating one
@@ -193,42 +469,123 @@ def play_saved_songs(all_songs_file, results_dir, spotify_env,
         logger.info('There are no past saved songs. Getting the list.')
         saved_songs = download_saved_songs(all_songs_file=all_songs_file,
                                            results_dir=results_dir,
-                                           spotify_env=spotify_env)
+                                           spotify_env=spotify_env,
+                                           index_file=index_file)
     # Saved songs found
     else:
         logger.debug('Saved songs file exists. Checking update time.')
-        saved_songs = utils.open_json_file(saved_songs_path)
+        saved_songs, artist_index = utils.load_library(saved_songs_path,
+                                                       with_artist_index=True)
         last_update_songs = datetime.datetime.strptime(
                                 spotify_env['saved_songs_updated_at'],
                                 '%d-%m-%Y'
                             )
         now_time = datetime.datetime.now()
-        check_update_songs = last_update_songs + datetime.timedelta(days=refresh_time)
         # Refreshing list of saved songs
-        if now_time > check_update_songs:
+        if refresh_time is not None and \
+                now_time > last_update_songs + datetime.timedelta(days=refresh_time):
             logger.info('Too long since last update of songs. Updating')
             saved_songs = download_saved_songs(
                             all_songs_file=all_songs_file,
                             results_dir=results_dir,
-                            spotify_env=spotify_env
+                            spotify_env=spotify_env,
+                            saved_songs=saved_songs,
+                            index_file=index_file
                         )
+            artist_index = None
+        else:
+            try:
+                saved_songs = sync_saved_songs(all_songs_file=all_songs_file,
+                                               results_dir=results_dir,
+                                               spotify_env=spotify_env,
+                                               saved_songs=saved_songs,
+                                               index_file=index_file)
+            except (ValueError, OSError):
+                logger.exception('Could not check if the saved songs changed.'
+                                 ' Using the stored ones.')
     logger.info('Saved songs gotten')
 
-    # Randomize the order of our saved songs and return the randomized ids
+    if with_artist_index:
+        return saved_songs, artist_index
+    return saved_songs
+
+
+def plan_next_session(saved_songs, results_dir, plan_file, repeat_artist,
+                      artist_index=None):
+    '''
+    Randomizes the saved songs with their current number of plays and stores
+    the order for the next play session, check 'play_saved_songs'.
+
+    Parameters
+    ----------
+    saved_songs : dict
+        Dictionary of saved songs that we have in our Spotify library
+    results_dir : string
+        Name of the folder where the plan is stored
+    plan_file : string
+        Name of the JSON file with the plan of the next session
+    repeat_artist : int
+        This parameter is used by the randomize function 'random_all_songs'
+    artist_index : dict
+        The ids of the songs of every artist, check 'random_all_songs'
+    '''
+    logger = logging.getLogger('spotify')
+    logger.info('Planning the next session')
     ids_to_play = utils.random_all_songs(songs_dictionary=saved_songs,
-                                         repeat_artist=repeat_artist)
+                                         repeat_artist=repeat_artist,
+                                         artist_index=artist_index)
+    play_session.write_plan(os.path.join(results_dir, plan_file), ids_to_play,
+                            repeat_artist)
+
+
+def queue_songs(spotify_env, saved_songs, ids_to_play, num_play_songs,
+                start=0, checkpoint_file=None, queue_check=None):
+    '''
+    Sends to the queue of the active device the songs in 'ids_to_play' in
+    order until 'num_play_songs' were added successfully.
+
+    Parameters
+    ----------
+    spotify_env : dict
+        Dictionary containing own Spotify keys, tokens, etc.
+    saved_songs : dict
+        Dictionary of saved songs that we have in our Spotify library
+    ids_to_play : list
+        Randomized ids of the songs to send to the queue
+    num_play_songs : int
+        Number of songs to be sent to the queue
+    start : int
+        Position in 'ids_to_play' of the first song to send
+    checkpoint_file : string
+        If given, every sent song is recorded in the checkpoint of the session
+    queue_check : dict
+        If given, the sent songs are added to the songs to look for in the
+        queue of the device, check 'verify_queue'
 
-    # Play all the saved songs in our Library
-    if num_play_songs == -1:
-        num_play_songs = len(ids_to_play)
+    Returns
+    -------
+    tuple
+        List of the ids that were sent to the queue, list of the ids that
+        had an error in the API and position in 'ids_to_play' of the next
+        song to send
+    '''
+    logger = logging.getLogger('spotify')
 
     error_songs = []
     programmed_songs = []
-    id_ran = 0
+    id_ran = start
     # Send to the queue the songs in order
     while len(programmed_songs) < num_play_songs and len(ids_to_play) > id_ran:
         # Get the song that must be sent to the queue
         id_song = ids_to_play[id_ran]
+        id_ran += 1
+        # The song was removed from the library since the session was planned
+        if id_song not in saved_songs:
+            logger.warning('Song not in the library anymore: %s' % (id_song, ))
+            if checkpoint_file is not None:
+                play_session.append_checkpoint(checkpoint_file, 'skipped',
+                                               [id_song])
+            continue
         chosen_song = saved_songs[id_song]
 
         # Try to add the song to the queue
@@ -243,6 +600,7 @@ def play_saved_songs(all_songs_file, results_dir, spotify_env,
                                                         ), )
             )
             error_songs.append(id_song)
+            event = 'error'
         else:
             # The song was added successfully
             logger.info(
@@ -250,14 +608,813 @@ def play_saved_songs(all_songs_file, results_dir, spotify_env,
                                                               indent=1), )
             )
             programmed_songs.append(id_song)
+            event = 'queued'
 
-        id_ran += 1
+        if checkpoint_file is not None:
+            play_session.append_checkpoint(checkpoint_file, event, [id_song])
+
+    if queue_check is not None:
+        track_sent_songs(queue_check, saved_songs, programmed_songs)
+
+    return programmed_songs, error_songs, id_ran
+
+
+def start_queue_check(queue_retries, min_interval=0):
+    '''
+    Creates the state of the checks of the queue of the device, check
+    'verify_queue'.
+
+    Parameters
+    ----------
+    queue_retries : int
+        Maximum number of times a song missing from the queue is sent again.
+        If 0 the queue is not checked
+    min_interval : float
+        Minimum number of seconds between two checks that are not forced
+
+    Returns
+    -------
+    dict
+        State of the checks of the queue
+    '''
+    return {
+        'queue_retries': queue_retries,
+        'min_interval': min_interval,
+        # Uris of the songs in the order they were sent. A song sent again
+        # is added again at the end
+        'sent_uris': [],
+        # Ids of the sent songs that were not seen in the queue yet, by uri
+        'pending': {},
+        # Number of times every song was sent again
+        'attempts': {},
+        'checked_at': None
+    }
+
+
+def track_sent_songs(queue_check, saved_songs, sent_songs):
+    '''
+    Adds the songs just sent to the queue to the songs that 'verify_queue'
+    looks for in the queue of the device.
+
+    Parameters
+    ----------
+    queue_check : dict
+        State of the checks of the queue, check 'start_queue_check'
+    saved_songs : dict
+        Dictionary of saved songs that we have in our Spotify library
+    sent_songs : list
+        Ids of the songs sent to the queue, in the order they were sent
+    '''
+    if queue_check['queue_retries'] <= 0:
+        return
+    for id_song in sent_songs:
+        uri = saved_songs[id_song]['uri']
+        queue_check['sent_uris'].append(uri)
+        queue_check['pending'][uri] = id_song
+
+
+def forget_checked_songs(queue_check):
+    '''
+    Removes from the state of the checks of the queue the songs sent before
+    the first pending song. They are not needed to check the pending songs,
+    and a song sent again by a later batch is not mistaken for the old one.
+    '''
+    pending = queue_check['pending']
+    sent_uris = queue_check['sent_uris']
+    positions = {uri: position for position, uri in enumerate(sent_uris)}
+    first_pending = min((positions[uri] for uri in pending),
+                        default=len(sent_uris))
+    del sent_uris[:first_pending]
+    pending_ids = set(pending.values())
+    for id_song in [id_song for id_song in queue_check['attempts']
+                    if id_song not in pending_ids]:
+        del queue_check['attempts'][id_song]
+
+
+def match_queue(sent_uris, visible_uris):
+    '''
+    Finds the sent songs that are in view in the queue of the device. The
+    songs in view are matched in order with the sent songs (longest common
+    subsequence), so a song that is twice in the queue, or that was sent
+    again, is matched with the right send.
+
+    Parameters
+    ----------
+    sent_uris : list
+        Uris of the songs sent to the queue, in the order they were sent
+    visible_uris : list
+        Uris of the playing song and the songs in view of the queue
+
+    Returns
+    -------
+    dict
+        Position in 'sent_uris' of every matched song by its position in
+        'visible_uris'
+    '''
+    # Only the sends of the songs in view can be matched, so the match is
+    # as long as the view and not as the sent songs
+    visible = set(visible_uris)
+    candidates = [position for position, uri in enumerate(sent_uris)
+                  if uri in visible]
+    candidate_uris = [sent_uris[position] for position in candidates]
+
+    # lengths[i][j]: longest match of visible_uris[i:] with candidate_uris[j:]
+    lengths = [[0]*(len(candidate_uris) + 1)
+               for _ in range(len(visible_uris) + 1)]
+    for i in range(len(visible_uris) - 1, -1, -1):
+        for j in range(len(candidate_uris) - 1, -1, -1):
+            if visible_uris[i] == candidate_uris[j]:
+                lengths[i][j] = lengths[i + 1][j + 1] + 1
+            else:
+                lengths[i][j] = max(lengths[i + 1][j], lengths[i][j + 1])
+
+    matched = {}
+    i = j = 0
+    while i < len(visible_uris) and j < len(candidate_uris):
+        if visible_uris[i] == candidate_uris[j]:
+            matched[i] = candidates[j]
+            i += 1
+            j += 1
+        elif lengths[i + 1][j] >= lengths[i][j + 1]:
+            i += 1
+        else:
+            j += 1
+    return matched
+
+
+def find_missing_songs(sent_uris, pending_uris, device_queue):
+    '''
+    Looks for the songs sent to the queue that were not seen yet
+    ('pending_uris') in the queue of the device. The device only shows the
+    playing song and the next QUEUE_VIEW_SIZE songs, so:
+    - the songs playing or in the queue are seen
+    - a song is missing if a song sent after it is seen, or if the whole
+      queue is seen (the view is not full). The pending songs sent before
+      the one playing are also missing: the songs that played are not
+      pending anymore, check 'verify_queue'. Only the song sent right
+      before the one playing is left pending, it may have just played
+    - the rest may be after the view and can't be checked yet
+
+    Parameters
+    ----------
+    sent_uris : list
+        Uris of the songs sent to the queue, in the order they were sent
+    pending_uris : list
+        Uris of the sent songs that were not seen yet
+    device_queue : dict
+        Queue of the device as returned by spotify_api/get_queue
+
+    Returns
+    -------
+    tuple
+        List of the pending uris that were seen and list of the pending uris
+        that are missing, in the order they were sent
+    '''
+    # Position of every pending song. A song sent again is at its last
+    # position
+    positions = {uri: position for position, uri in enumerate(sent_uris)}
+    upcoming = device_queue['queue']
+    view_full = len(upcoming) >= spotify_api.QUEUE_VIEW_SIZE
+
+    matched = match_queue(sent_uris,
+                          [device_queue['currently_playing']] + upcoming)
+    seen = set(sent_uris[position] for position in matched.values())
+    # The playing song is the first of the matched ones
+    first = matched.get(0, -1)
+    if not view_full:
+        last = len(sent_uris)
+    elif len(matched) > 0:
+        last = max(matched.values())
+    else:
+        # Other songs fill the view, nothing can be checked yet
+        last = -1
+
+    seen_uris = []
+    missing_uris = []
+    for uri in sorted(pending_uris, key=positions.get):
+        if uri in seen:
+            seen_uris.append(uri)
+        elif positions[uri] != first - 1 and positions[uri] < last:
+            missing_uris.append(uri)
+    return seen_uris, missing_uris
+
+
+def verify_queue(spotify_env, saved_songs, queue_check, programmed_songs,
+                 checkpoint_file=None, force=False):
+    '''
+    Checks with a single request that the songs sent to the queue are in the
+    queue of the device, and sends again the missing ones, e.g. the songs
+    sent while the device was changing. A song sent again is checked again
+    right away if the whole queue is in view. After 'queue_retries' attempts
+    a song still missing is given up and recorded as 'dropped' in the
+    checkpoint.
+
+    The songs that can't be checked yet because they are after the view of
+    the queue stay pending, and are checked by the next calls as the queue
+    advances. The queue is requested at most once every 'min_interval'
+    seconds unless 'force' is set.
+
+    Parameters
+    ----------
+    spotify_env : dict
+        Dictionary containing own Spotify keys, tokens, etc.
+    saved_songs : dict
+        Dictionary of saved songs that we have in our Spotify library
+    queue_check : dict
+        State of the checks of the queue, check 'start_queue_check'
+    programmed_songs : list
+        Ids of the songs sent to the queue that have not been detected to
+        play, e.g. by 'check_recently_played'. Only these songs are checked,
+        so it must be up to date or the songs that played are sent again
+    checkpoint_file : string
+        If given, the dropped songs are recorded in the checkpoint
+    force : bool
+        If set the queue is checked even if it was checked recently
+
+    Returns
+    -------
+    list
+        Ids of the songs given up because they are not in the queue
+    '''
+    logger = logging.getLogger('spotify')
+    pending = queue_check['pending']
+    # The songs that played are not looked for anymore
+    programmed = set(programmed_songs)
+    for uri in [uri for uri, id_song in pending.items()
+                if id_song not in programmed]:
+        del pending[uri]
+    forget_checked_songs(queue_check)
+    if queue_check['queue_retries'] <= 0 or len(pending) == 0:
+        return []
+    if not force and queue_check['checked_at'] is not None and \
+            time.time() - queue_check['checked_at'] < queue_check['min_interval']:
+        return []
+
+    dropped_songs = []
+    while len(pending) > 0:
+        try:
+            device_queue = spotify_api.get_queue(spotify_env)
+        except (ValueError, OSError):
+            logger.warning('Could not check the queue of the device.')
+            break
+        queue_check['checked_at'] = time.time()
+        seen_uris, missing_uris = find_missing_songs(queue_check['sent_uris'],
+                                                     list(pending),
+                                                     device_queue)
+        for uri in seen_uris:
+            del pending[uri]
+
+        number_sent_again = 0
+        for uri in missing_uris:
+            id_song = pending.pop(uri)
+            attempts = queue_check['attempts'].get(id_song, 0)
+            if attempts >= queue_check['queue_retries'] or \
+                    spotify_api.add_song_to_queue(spotify_env, uri) is not None:
+                dropped_songs.append(id_song)
+                continue
+            # The song sent again is now at the end of the queue
+            queue_check['attempts'][id_song] = attempts + 1
+            queue_check['sent_uris'].append(uri)
+            pending[uri] = id_song
+            number_sent_again += 1
+        if number_sent_again > 0:
+            logger.warning('%d songs were missing from the queue. Sent them '
+                           'again.' % (number_sent_again, ))
+
+        # The songs sent again can only be seen now if the queue is in view
+        if number_sent_again == 0 or \
+                len(device_queue['queue']) >= spotify_api.QUEUE_VIEW_SIZE:
+            break
+
+    forget_checked_songs(queue_check)
+    if len(pending) > 0:
+        logger.info('%d sent songs are not in view of the queue yet. They are '
+                    'checked later.' % (len(pending), ))
+    if len(dropped_songs) == 0:
+        return []
+    logger.error('Songs not in the queue after %d attempts: %d' % (
+                    queue_check['queue_retries'], len(dropped_songs)))
+    if checkpoint_file is not None:
+        play_session.append_checkpoint(checkpoint_file, 'dropped',
+                                       dropped_songs)
+    return dropped_songs
+
+
+def start_pipelined_session(all_songs_file, results_dir, spotify_env,
+                            refresh_time, options, number_to_send,
+                            checkpoint_file, queue_check=None):
+    '''
+    Starts a new play session sending the first songs to the queue while the
+    rest of the startup is still running:
+    - the stored saved songs are randomized by a thread with
+      'iter_random_songs' at utils.py, that gives the songs one by one
+    - the saved songs are brought up to date by another thread with
+      'load_saved_songs'
+    - the songs are sent to the queue as soon as they are chosen, until
+      'number_to_send' were sent or the whole order is ready.
+    Once the order is ready the checkpoint of the session is created with the
+    songs already sent, and the session continues like a resumed one.
+    The time until the first song is in the queue is logged. If the saved
+    songs cannot be brought up to date the stored ones are used.
+
+    Parameters
+    ----------
+    all_songs_file : string
+        Name of the JSON file with the saved songs in our library. It must
+        exist
+    results_dir : string
+        Name of the folder where the JSON all_songs_file is stored
+    spotify_env : dict
+        Dictionary containing own Spotify keys, tokens, etc.
+    refresh_time : int
+        Accepted number of days since the last update of the saved songs
+    options : argparse.Namespace
+        Options of the session, check 'session_options'. Uses 'index_file',
+        'repeat_artist', 'seed', 'plan_file' (if the plan is valid its order
+        is used) and 'num_play_songs' (-1 for all the saved songs)
+    number_to_send : int
+        Maximum number of songs sent while the order is not ready
+    checkpoint_file : string
+        Path to the checkpoint of the session
+    queue_check : dict
+        If given, the songs missing from the queue of the device are sent
+        again, check 'verify_queue'
+
+    Returns
+    -------
+    tuple
+        The up to date saved songs and the state of the session, in the
+        format of 'load_checkpoint' at play_session.py
+    '''
+    import queue
+
+    logger = logging.getLogger('spotify')
+    start_time = time.perf_counter()
+    stored_songs, artist_index = utils.load_library(
+                                    os.path.join(results_dir, all_songs_file),
+                                    with_artist_index=True)
+
+    ids_to_play = None
+    if options.plan_file is not None and options.seed is None:
+        plan_path = os.path.join(results_dir, options.plan_file)
+        ids_to_play = play_session.load_plan(plan_path, stored_songs,
+                                             options.repeat_artist)
+        if ids_to_play is not None:
+            logger.info('Using the planned order of the songs.')
+            play_session.remove_plan(plan_path)
+    if ids_to_play is None:
+        order = utils.iter_random_songs(songs_dictionary=stored_songs,
+                                        repeat_artist=options.repeat_artist,
+                                        seed=options.seed,
+                                        artist_index=artist_index)
+    else:
+        order = iter(ids_to_play)
+
+    # Producer: the songs in order, None when the order is complete
+    order_queue = queue.Queue()
+    chosen_ids = []
+
+    def produce_order():
+        try:
+            for id_song in order:
+                chosen_ids.append(id_song)
+                order_queue.put(id_song)
+        finally:
+            order_queue.put(None)
+
+    # The token is refreshed once and not by every thread
+    spotify_api.refresh_access_token(spotify_env)
+    refreshed = {}
+
+    def refresh_songs():
+        try:
+            refreshed['saved_songs'] = load_saved_songs(
+                                        all_songs_file=all_songs_file,
+                                        results_dir=results_dir,
+                                        spotify_env=spotify_env,
+                                        refresh_time=refresh_time,
+                                        index_file=options.index_file)
+        except Exception:
+            # The songs already sent are from the stored ones
+            logger.exception('Could not bring the saved songs up to date. '
+                             'Using the stored ones.')
+            refreshed['saved_songs'] = stored_songs
+
+    producer = threading.Thread(target=produce_order, daemon=True)
+    refresher = threading.Thread(target=refresh_songs, daemon=True)
+    producer.start()
+    refresher.start()
+
+    # Consumer: send the songs while they are chosen
+    events = []
+    programmed_songs = []
+    error_songs = []
+    try:
+        while len(programmed_songs) < number_to_send:
+            id_song = order_queue.get()
+            if id_song is None:
+                break
+            response = spotify_api.add_song_to_queue(
+                        spotify_env, stored_songs[id_song]['uri'])
+            if response is not None:
+                logger.error('Error adding song to the queue: %s' % (
+                                id_song, ))
+                error_songs.append(id_song)
+                events.append(('error', id_song))
+                continue
+            programmed_songs.append(id_song)
+            events.append(('queued', id_song))
+            if len(programmed_songs) == 1:
+                logger.info('First song queued after %.3f seconds.' % (
+                                time.perf_counter() - start_time, ))
+            # The rest are sent by the session with its checkpoint
+            if not producer.is_alive():
+                break
+    finally:
+        # Even if interrupted, the songs already sent can be resumed. The
+        # saved songs are not left half written
+        producer.join()
+        refresher.join()
+        ids_to_play = chosen_ids
+        num_play_songs = options.num_play_songs
+        if num_play_songs == -1:
+            num_play_songs = len(ids_to_play)
+        play_session.start_checkpoint(checkpoint_file, ids_to_play,
+                                      num_play_songs)
+        for event, id_song in events:
+            play_session.append_checkpoint(checkpoint_file, event, [id_song])
+    if queue_check is not None:
+        track_sent_songs(queue_check, stored_songs, programmed_songs)
+        dropped_songs = verify_queue(spotify_env=spotify_env,
+                                     saved_songs=stored_songs,
+                                     queue_check=queue_check,
+                                     programmed_songs=programmed_songs,
+                                     checkpoint_file=checkpoint_file,
+                                     force=True)
+        programmed_songs = [id_song for id_song in programmed_songs
+                            if id_song not in dropped_songs]
+        error_songs += dropped_songs
+    logger.info('Order of %d songs ready after %.3f seconds. Sent: %d' % (
+                    len(ids_to_play), time.perf_counter() - start_time,
+                    len(programmed_songs)))
+
+    return refreshed['saved_songs'], {
+        'ids_to_play': ids_to_play,
+        'num_play_songs': num_play_songs,
+        'cursor': len(events),
+        'number_queued': len(programmed_songs),
+        'programmed_songs': programmed_songs,
+        'error_songs': error_songs
+    }
+
+
+def play_saved_songs(all_songs_file, results_dir, spotify_env,
+                     refresh_time, options=None):
+    '''
+    Adds to our Spotify queue the saved songs in our library in a random order.
+
+    First, the function will check if we have a JSON file with our saved songs.
+    If we don't have it then it will create it.
+    If we have it then it will check when it was the last time we updated the
+    JSON file. If it has passed more than 'refresh_time' days then the function
+    will update the JSON file. Otherwise it will only download the songs if
+    the library changed, check 'sync_saved_songs'.
+
+    The randomization is done in the function 'random_all_songs' at utils.py.
+    Check that function to check further details.
+
+    The function will try to add 'num_play_songs' to the queue. If the value of
+    'num_play_songs' is equal to -1 then it will try to add to the queue all
+    the saved songs in our library.
+
+    Finally, the function can wait for all the songs sent to the queue to play.
+    The function will sleep every 'sleep_time' minutes and then query for the
+    recently played songs of Spotify to know if the songs sent to queue
+    actually played. This is done to increment the counter of number of plays
+    that each song has in the JSON file. The counter then can be used so that
+    in the future the  songs with less counts are played first. All of this
+    functionality can be avoided if the flag 'not_wait_songs_to_play' is set
+    to False.
+
+    The planned order, the songs sent to the queue and the songs detected to
+    play are recorded in the checkpoint 'results_dir/session_file' while the
+    session runs. If the session is interrupted, setting 'resume' continues
+    sending and tracking songs from where it stopped.
+
+    If 'bpm_range' is given only the songs with a tempo in that range are
+    played, e.g. to keep a pace while running. The tempos are taken from the
+    audio features, check 'enrich_saved_songs'.
+
+    If 'lookahead' is given while waiting for the songs to play, only
+    'lookahead' songs are kept ahead of the playing song in the queue instead
+    of sending all of them at the start. The function checks the playing song
+    when the current one should end and sends the next songs of the random
+    order as the others finish. If the listening stops early the rest of the
+    songs are never sent.
+
+    If 'plan_file' is given, a new session uses the order stored in
+    'results_dir/plan_file' instead of randomizing the library, and the order
+    of the next session is stored there when the session ends, with the new
+    number of plays, check 'plan_next_session'. The plan is not used when
+    playing a 'bpm_range', a 'song_filter' or with a 'seed'.
+
+    If 'target_minutes' is given, instead of 'num_play_songs' songs the
+    session plays the songs that fill 'target_minutes' +- 'target_tolerance',
+    check 'select_by_duration' at utils.py, and the waiting stops when the
+    planned duration ends.
+
+    If 'song_filter' is given only the songs matching the filter expression
+    are played, e.g. 'artist:queen album:opera'. The filter is resolved with
+    the search index, check 'search' at search_index.py.
+
+    If 'sources' is given the songs of those playlists and albums are shuffled
+    together with the saved songs (if 'liked' is one of the sources), check
+    'load_song_pool' at song_sources.py. The songs of every source are cached
+    in 'results_dir/sources_dir' and the plays of the songs that are not saved
+    songs are counted in 'results_dir/source_plays_file'. A session with
+    sources does not use the plan of the next session.
+
+    Parameters
+    ----------
+    all_songs_file : string
+        Name of the JSON file with the saved songs in our library
+    results_dir : string
+        Name of the folder where the JSON all_songs_file is stored
+    refresh_time : int
+        Accepted number of days since the last update of the saved songs
+    options : argparse.Namespace
+        Options of the session, check 'session_options'. If None the
+        defaults in SESSION_DEFAULTS are used. The options are:
+        repeat_artist : int
+            This parameter is used by the randomize function 'random_all_songs'
+        num_play_songs : int
+            Number of songs to be sent to the queue
+        sleep_time : float
+            Minutes (can be a fraction) that the function waits before querying
+            for new recently played songs
+        not_wait_songs_to_play : boolean
+            Wether to wait or not for the songs sent to the queue to play
+        resume : boolean
+            Wether to continue the last interrupted session
+        session_file : string
+            Name of the checkpoint file of the session, stored in 'results_dir'
+        bpm_range : list
+            Minimum and maximum tempo (BPM) of the songs to play. If None all
+            the songs are played
+        audio_features_file : string
+            Name of the JSON file with the cached audio features
+        lookahead : int
+            Maximum number of songs sent to the queue ahead of the playing
+            song. If None all the songs are sent at the start
+        seed : int
+            Seed of the randomize function 'random_all_songs'. The same seed
+            and library give the same order
+        plan_file : string
+            Name of the JSON file with the plan of the next session. If None no
+            plan is used nor stored
+        song_filter : string
+            Filter expression of the songs to play. If None all the songs are
+            played
+        index_file : string
+            Name of the JSON file with the search index
+        target_minutes : float
+            Duration of the session in minutes. If None 'num_play_songs' are
+            sent
+        target_tolerance : float
+            Accepted difference in minutes with 'target_minutes'
+        sources : list
+            Sources of the songs to shuffle, e.g. ['liked', 'playlist:<id>'].
+            If None only the saved songs are played
+        sources_dir : string
+            Name of the folder with the cached songs of the sources
+        source_plays_file : string
+            Name of the JSON file with the plays of the songs of the sources
+            that are not saved songs
+        history_file : string
+            Name of the SQLite file with the play history in 'results_dir'.
+            Every play read from the recently played songs is stored in it,
+            check 'show_play_stats'. If None the plays are only counted
+        queue_retries : int
+            Maximum number of times the songs missing from the queue of the
+            device are sent again, check 'verify_queue'. If 0 the queue of the
+            device is not checked
+
+    Returns
+    -------
+    None
+    '''
+    logger = logging.getLogger('spotify')
+    if options is None:
+        options = session_options()
+    # Changed while the session runs
+    num_play_songs = options.num_play_songs
+    not_wait_songs_to_play = options.not_wait_songs_to_play
+    plan_file = options.plan_file
+    # Fail before sending any song if the filter is not valid
+    if options.song_filter is not None:
+        try:
+            search_index.split_filter(options.song_filter)
+        except ValueError as error:
+            logger.error(error)
+            return
+
+    saved_songs_path = os.path.join(results_dir, all_songs_file)
+    history_path = None
+    if options.history_file is not None:
+        history_path = os.path.join(results_dir, options.history_file)
+    checkpoint_file = os.path.join(results_dir, options.session_file)
+    session = None
+    if options.resume:
+        session = play_session.load_checkpoint(checkpoint_file)
+        if session is None:
+            logger.warning('There is no session to resume. Starting a new one.')
+
+    # Without waiting nobody checks when to send the rest of the songs
+    feed_queue = options.lookahead is not None and not_wait_songs_to_play
+    # While waiting the queue is checked again at most every 'sleep_time'
+    queue_check = start_queue_check(options.queue_retries,
+                                    min_interval=options.sleep_time*60)
+
+    # A new session of all the saved songs sends the first songs while the
+    # library is refreshed and randomized. The rest need them first
+    pipelined = session is None and options.bpm_range is None and \
+        options.song_filter is None and options.target_minutes is None and \
+        options.sources is None and os.path.isfile(saved_songs_path)
+    if pipelined:
+        number_to_send = float('inf') if num_play_songs == -1 \
+            else num_play_songs
+        if feed_queue:
+            number_to_send = min(number_to_send, options.lookahead)
+        saved_songs, session = start_pipelined_session(
+                                all_songs_file=all_songs_file,
+                                results_dir=results_dir,
+                                spotify_env=spotify_env,
+                                refresh_time=refresh_time,
+                                options=options,
+                                number_to_send=number_to_send,
+                                checkpoint_file=checkpoint_file,
+                                queue_check=queue_check
+                            )
+    else:
+        saved_songs, artist_index = load_saved_songs(
+                                        all_songs_file=all_songs_file,
+                                        results_dir=results_dir,
+                                        spotify_env=spotify_env,
+                                        refresh_time=refresh_time,
+                                        index_file=options.index_file,
+                                        with_artist_index=True
+                                    )
+    # From here on 'saved_songs' are the songs of the session. The saved
+    # songs of the library are still written with their plays
+    library_songs = saved_songs
+    source_plays_path = None
+    if options.sources is not None:
+        source_plays_path = os.path.join(results_dir,
+                                         options.source_plays_file)
+        saved_songs = song_sources.load_song_pool(
+                        spotify_env=spotify_env,
+                        sources=options.sources,
+                        saved_songs=library_songs,
+                        sources_dir=os.path.join(results_dir,
+                                                 options.sources_dir),
+                        source_plays_file=source_plays_path
+                      )
+        # The plan is an order of the library, not of this pool
+        plan_file = None
+
+    if session is None:
+        songs_to_shuffle = saved_songs
+        if options.bpm_range is not None:
+            features_cache = enrich_saved_songs(
+                                audio_features_file=(
+                                    options.audio_features_file),
+                                results_dir=results_dir,
+                                spotify_env=spotify_env,
+                                saved_songs=saved_songs
+                            )
+            min_bpm, max_bpm = options.bpm_range
+            ids_in_range = utils.filter_by_tempo(features_cache['tempo_index'],
+                                                 min_bpm=min_bpm,
+                                                 max_bpm=max_bpm)
+            songs_to_shuffle = {id_song: saved_songs[id_song]
+                                for id_song in ids_in_range
+                                if id_song in saved_songs}
+            logger.info('Songs between %s and %s BPM: %d' % (
+                            min_bpm, max_bpm, len(songs_to_shuffle)))
+            if len(songs_to_shuffle) == 0:
+                logger.error('There are no songs in the BPM range.')
+                return
+
+        if options.song_filter is not None:
+            if options.sources is None:
+                index = search_index.load_index(
+                            os.path.join(results_dir, options.index_file),
+                            saved_songs)
+            else:
+                # The stored index only has the saved songs
+                index = search_index.build_index(saved_songs)
+            matching_ids = search_index.search(index, options.song_filter)
+            # Iterate over the songs so the order does not depend on the set
+            songs_to_shuffle = {id_song: song
+                                for id_song, song in songs_to_shuffle.items()
+                                if id_song in matching_ids}
+            logger.info('Songs matching the filter %s: %d' % (
+                            options.song_filter, len(songs_to_shuffle)))
+            if len(songs_to_shuffle) == 0:
+                logger.error('There are no songs matching the filter.')
+                return
+
+        ids_to_play = None
+        if plan_file is not None and options.bpm_range is None and \
+                options.seed is None and options.song_filter is None:
+            plan_path = os.path.join(results_dir, plan_file)
+            ids_to_play = play_session.load_plan(plan_path, saved_songs,
+                                                 options.repeat_artist)
+            if ids_to_play is not None:
+                logger.info('Using the planned order of the songs.')
+                play_session.remove_plan(plan_path)
+        if ids_to_play is None:
+            # Randomize the order of our saved songs and return the randomized ids
+            # The filtered songs are grouped with the index of the library
+            ids_to_play = utils.random_all_songs(
+                            songs_dictionary=songs_to_shuffle,
+                            repeat_artist=options.repeat_artist,
+                            seed=options.seed,
+                            artist_index=artist_index
+                        )
+
+        if options.target_minutes is not None:
+            ids_to_play, planned_ms = utils.select_by_duration(
+                                        songs_dictionary=saved_songs,
+                                        ids_to_play=ids_to_play,
+                                        target_ms=(
+                                            options.target_minutes*60*1000),
+                                        tolerance_ms=(
+                                            options.target_tolerance*60*1000)
+                                    )
+            num_play_songs = len(ids_to_play)
+            logger.info('Selected %d songs for %.1f minutes.' % (
+                            num_play_songs, planned_ms/60000))
+        # Play all the saved songs in our Library
+        elif num_play_songs == -1:
+            num_play_songs = len(ids_to_play)
+
+        play_session.start_checkpoint(checkpoint_file, ids_to_play,
+                                      num_play_songs)
+        session = {
+            'ids_to_play': ids_to_play,
+            'num_play_songs': num_play_songs,
+            'cursor': 0,
+            'number_queued': 0,
+            'programmed_songs': [],
+            'error_songs': []
+        }
+    elif not pipelined:
+        logger.info('Resuming the last session from song %d' % (
+                        session['cursor'], ))
+    num_play_songs = session['num_play_songs']
+    ids_to_play = session['ids_to_play']
+
+    number_to_send = num_play_songs - session['number_queued']
+    if feed_queue:
+        number_to_send = min(number_to_send,
+                             max(options.lookahead -
+                                 len(session['programmed_songs']), 0))
+    new_programmed_songs, new_error_songs, cursor = queue_songs(
+        spotify_env=spotify_env,
+        saved_songs=saved_songs,
+        ids_to_play=ids_to_play,
+        num_play_songs=number_to_send,
+        start=session['cursor'],
+        checkpoint_file=checkpoint_file,
+        queue_check=queue_check
+    )
+    # Songs of the resumed session that are not in the library can't be tracked
+    programmed_songs = [song_id for song_id in session['programmed_songs']
+                        if song_id in saved_songs] + new_programmed_songs
+    error_songs = [song_id for song_id in session['error_songs']
+                   if song_id in saved_songs] + new_error_songs
+    number_sent = session['number_queued'] + len(new_programmed_songs)
+    dropped_songs = verify_queue(spotify_env=spotify_env,
+                                 saved_songs=saved_songs,
+                                 queue_check=queue_check,
+                                 programmed_songs=programmed_songs,
+                                 checkpoint_file=checkpoint_file,
+                                 force=len(new_programmed_songs) > 0)
+    programmed_songs = [song_id for song_id in programmed_songs
+                        if song_id not in dropped_songs]
+    error_songs += dropped_songs
+    number_sent -= len(dropped_songs)
 
     # Check if we sent all the desired number of songs
-    if len(programmed_songs) < num_play_songs:
-        if len(programmed_songs) == 0:
+    if feed_queue and number_sent > 0:
+        logger.info('Sent %d songs. The rest are sent while playing.' % (
+                        number_sent, ))
+    elif number_sent < num_play_songs:
+        if number_sent == 0:
             logger.error('Script could not program any song :(')
             not_wait_songs_to_play = False
+            feed_queue = False
         else:
             logger.warning('Could not program all the songs. Check logs :(')
 
@@ -271,53 +1428,246 @@ def play_saved_songs(all_songs_file, results_dir, spotify_env,
     try:
         if not_wait_songs_to_play:
             logger.info('Waiting for all the programmed songs to play.')
-            sleep_time_seconds = sleep_time*60
-        
+            sleep_time_seconds = options.sleep_time*60
+
+        planned_end = None
+        if options.target_minutes is not None and not_wait_songs_to_play:
+            planned_end = time.time() + session_remaining_ms(
+                spotify_env=spotify_env,
+                saved_songs=saved_songs,
+                programmed_songs=programmed_songs,
+                ids_to_send=ids_to_play[cursor:cursor + num_play_songs -
+                                        number_sent]
+            )/1000
+            logger.info('The session should end at %s' % (
+                datetime.datetime.fromtimestamp(planned_end).strftime(
+                    '%H:%M:%S'), ))
+
+        # Songs of the session in the order they will play, and position
+        # in it of the last song seen playing
+        queued_order = list(programmed_songs)
+        playing_position = -1
+        playing_id = None
+        # Keep 'lookahead' songs ahead of the playing one
+        while feed_queue:
+            playing = spotify_api.get_currently_playing(spotify_env)
+            last_playing_id = playing_id
+            playing_id = None if playing is None else playing['id']
+            if playing_id in queued_order:
+                playing_position = max(playing_position,
+                                       queued_order.index(playing_id))
+
+            # The songs before the playing one have finished
+            if playing_id != last_playing_id:
+                programmed_songs = check_played_in_session(
+                                        spotify_env=spotify_env,
+                                        programmed_songs=programmed_songs,
+                                        saved_songs=saved_songs,
+                                        saved_songs_path=saved_songs_path,
+                                        checkpoint_file=checkpoint_file,
+                                        library_songs=library_songs,
+                                        source_plays_path=source_plays_path,
+                                        history_file=history_path
+                                    )
+
+            new_programmed_songs = []
+            all_sent = number_sent >= num_play_songs or \
+                cursor >= len(ids_to_play)
+            if all_sent:
+                if len(programmed_songs) == 0:
+                    logger.info('All programmed songs have played.')
+                    break
+                # The last song of the session played and something else
+                # is playing now
+                if playing_position == len(queued_order) - 1 and \
+                        playing_id != queued_order[-1]:
+                    logger.info('The songs of the session finished.')
+                    break
+            else:
+                number_ahead = len(queued_order) - playing_position - 1
+                number_to_send = min(options.lookahead - number_ahead,
+                                     num_play_songs - number_sent)
+                if number_to_send > 0:
+                    new_programmed_songs, new_error_songs, cursor = \
+                        queue_songs(spotify_env=spotify_env,
+                                    saved_songs=saved_songs,
+                                    ids_to_play=ids_to_play,
+                                    num_play_songs=number_to_send,
+                                    start=cursor,
+                                    checkpoint_file=checkpoint_file,
+                                    queue_check=queue_check)
+                    queued_order += new_programmed_songs
+                    programmed_songs += new_programmed_songs
+                    error_songs += new_error_songs
+                    number_sent += len(new_programmed_songs)
+
+            # The songs just sent are looked for in the queue right away,
+            # the ones that were not in view every 'sleep_time'
+            dropped_songs = verify_queue(
+                                spotify_env=spotify_env,
+                                saved_songs=saved_songs,
+                                queue_check=queue_check,
+                                programmed_songs=programmed_songs,
+                                checkpoint_file=checkpoint_file,
+                                force=len(new_programmed_songs) > 0)
+            if len(dropped_songs) > 0:
+                programmed_songs = [song_id for song_id in programmed_songs
+                                    if song_id not in dropped_songs]
+                playing_position -= len([
+                    song_id for song_id in queued_order[:playing_position + 1]
+                    if song_id in dropped_songs])
+                queued_order = [song_id for song_id in queued_order
+                                if song_id not in dropped_songs]
+                error_songs += dropped_songs
+                number_sent -= len(dropped_songs)
+
+            if planned_end is not None and time.time() >= planned_end:
+                logger.info('The planned duration of the session ended.')
+                break
+
+            # Check again when the playing song should end
+            wait_seconds = sleep_time_seconds
+            if playing is not None and playing['is_playing']:
+                remaining_seconds = (playing['duration_ms'] -
+                                     playing['progress_ms'])/1000
+                wait_seconds = min(wait_seconds,
+                                   max(remaining_seconds, 0) + 1)
+            if planned_end is not None:
+                wait_seconds = min(wait_seconds, planned_end - time.time())
+            logger.debug('Checking the playing song in %.0f seconds.' % (
+                            wait_seconds, ))
+            time.sleep(wait_seconds)
+
         # Wait for all the songs sent to the queue to play
-        while not_wait_songs_to_play:
-            logger.info('Sleeping for %s minutes.' % (sleep_time, ))
-            time.sleep(sleep_time_seconds)
+        while not_wait_songs_to_play and not feed_queue:
+            wait_seconds = sleep_time_seconds
+            if planned_end is not None:
+                wait_seconds = max(min(wait_seconds,
+                                       planned_end - time.time()), 0)
+            logger.info('Sleeping for %.1f minutes.' % (wait_seconds/60, ))
+            time.sleep(wait_seconds)
 
             # Check the recently played songs
-            programmed_songs = check_recently_played(
+            programmed_songs = check_played_in_session(
                                     spotify_env=spotify_env,
                                     programmed_songs=programmed_songs,
-                                    saved_songs=saved_songs
+                                    saved_songs=saved_songs,
+                                    saved_songs_path=saved_songs_path,
+                                    checkpoint_file=checkpoint_file,
+                                    library_songs=library_songs,
+                                    source_plays_path=source_plays_path,
+                                    history_file=history_path
                                 )
+            # The songs that were after the view of the queue may be in it now
+            dropped_songs = verify_queue(spotify_env=spotify_env,
+                                         saved_songs=saved_songs,
+                                         queue_check=queue_check,
+                                         programmed_songs=programmed_songs,
+                                         checkpoint_file=checkpoint_file,
+                                         force=True)
+            programmed_songs = [song_id for song_id in programmed_songs
+                                if song_id not in dropped_songs]
+            error_songs += dropped_songs
 
             if len(programmed_songs) == 0:
                 logger.info('All programmed songs have played.')
                 break
+            if planned_end is not None and time.time() >= planned_end:
+                logger.info('The planned duration of the session ended.')
+                break
     # Exiting the script
     except KeyboardInterrupt:
         logger.info('Interrupting waiting for songs to play.')
     finally:
         # Try to get all the songs that were played according to Spotify
-        programmed_songs = check_recently_played(
+        programmed_songs = check_played_in_session(
                                 spotify_env=spotify_env,
                                 programmed_songs=programmed_songs,
-                                saved_songs=saved_songs
+                                saved_songs=saved_songs,
+                                saved_songs_path=saved_songs_path,
+                                checkpoint_file=checkpoint_file,
+                                library_songs=library_songs,
+                                source_plays_path=source_plays_path,
+                                history_file=history_path
                             )
         if len(programmed_songs) > 0:
             logger.warning('Some songs were not detected to play.')
         for song_id in programmed_songs:
             logger.warning('%s' % (json.dumps(saved_songs[song_id], indent=1)))
-
-        # Writes the updated songs with the counters before finishing
-        utils.write_json_file(saved_songs_path, saved_songs)
-        logger.info('Finished to write new values to file.')
+        # Not seen in the queue, but not known to be missing either
+        number_unchecked = len([song_id for song_id in
+                                queue_check['pending'].values()
+                                if song_id in programmed_songs])
+        if number_unchecked > 0:
+            logger.warning('Could not check that %d sent songs are in the '
+                           'queue of the device.' % (number_unchecked, ))
+
+        # Keep the checkpoint if there is something left to resume
+        if (number_sent >= num_play_songs or cursor >= len(ids_to_play)) \
+                and len(programmed_songs) == 0:
+            play_session.remove_checkpoint(checkpoint_file)
+        else:
+            logger.info('The session can be continued with --resume')
 
         logger.info(
             '\n\nNumber of songs sent by the script: %d\n'
             'Number of not detected played songs: %d\n'
-            'Number of songs with error in API: %d\n' % (num_play_songs,
+            'Number of songs with error in API: %d\n' % (number_sent,
                                                          len(programmed_songs),
                                                          len(error_songs))
         )
+        # The next session starts right away with the new number of plays.
+        # Without waiting no plays were counted, the order would be the same
+        if plan_file is not None and not_wait_songs_to_play:
+            plan_next_session(saved_songs=saved_songs,
+                              results_dir=results_dir,
+                              plan_file=plan_file,
+                              repeat_artist=options.repeat_artist)
         logger.info('Closing player, bye! :)')
 
 
-def check_recently_played(spotify_env, programmed_songs, saved_songs):
+def session_remaining_ms(spotify_env, saved_songs, programmed_songs,
+                         ids_to_send):
+    '''
+    Estimates how long a play session will still last: what is left of the
+    playing song plus the songs in the queue and the songs still to send.
+
+    Parameters
+    ----------
+    spotify_env : dict
+        Dictionary containing own Spotify keys, tokens, etc.
+    saved_songs : dict
+        Dictionary of saved songs that we have in our Spotify library
+    programmed_songs : list
+        List of song ids that were sent to the queue and have not played
+    ids_to_send : list
+        Ids of the songs of the session that will be sent to the queue
+
+    Returns
+    -------
+    float
+        Milliseconds until the last song of the session ends
+    '''
+    logger = logging.getLogger('spotify')
+    remaining_ms = sum(saved_songs[id_song].get('duration_ms', 0)
+                       for id_song in programmed_songs + ids_to_send
+                       if id_song in saved_songs)
+    try:
+        playing = spotify_api.get_currently_playing(spotify_env)
+    except (ValueError, OSError):
+        logger.warning('Could not get the playing song.')
+        playing = None
+    if playing is not None:
+        if playing['id'] in programmed_songs:
+            # Part of a song of the session already played
+            remaining_ms -= playing['progress_ms']
+        else:
+            remaining_ms += playing['duration_ms'] - playing['progress_ms']
+    return max(remaining_ms, 0)
+
+
+def check_recently_played(spotify_env, programmed_songs, saved_songs,
+                          history_file=None):
     '''
     Checks if the song that were sent to the queue have already played
 
@@ -329,6 +1679,9 @@ def check_recently_played(spotify_env, programmed_songs, saved_songs):
         List of song ids that were sent to the Spotify queue
     saved_songs : dict
         Dictionary of saved songs that we have in our Spotify library
+    history_file : string
+        Path to the play history where the recently played songs are stored,
+        check 'get_recently_played_songs'. If None they are not stored
 
     Returns
     -------
@@ -344,7 +1697,8 @@ def check_recently_played(spotify_env, programmed_songs, saved_songs):
     # Check for the songs that have recently played
     recently_played = get_recently_played_songs(
                         spotify_env=spotify_env,
-                        number_songs=50
+                        number_songs=50,
+                        history_file=history_file
                     )
     # Return logger to appropriate level
     logger.setLevel(orig_log_level)
@@ -373,16 +1727,218 @@ def check_recently_played(spotify_env, programmed_songs, saved_songs):
     return programmed_songs
 
 
-def get_recently_played_songs(spotify_env, number_songs=None):
+def check_played_in_session(spotify_env, programmed_songs, saved_songs,
+                            saved_songs_path, checkpoint_file,
+                            library_songs=None, source_plays_path=None,
+                            history_file=None):
+    '''
+    Checks if the songs sent to the queue in a play session have already
+    played. The new play counters are written right away and the played songs
+    are recorded in the checkpoint of the session, so that an interrupted
+    session does not lose nor count twice any play.
+
+    Parameters
+    ----------
+    spotify_env : dict
+        Dictionary containing own Spotify keys, tokens, etc.
+    programmed_songs : list
+        List of song ids that were sent to the Spotify queue
+    saved_songs : dict
+        Dictionary of saved songs that we have in our Spotify library
+    saved_songs_path : string
+        Path to the JSON file with the saved songs
+    checkpoint_file : string
+        Path to the checkpoint of the session
+    library_songs : dict
+        Saved songs of the library when 'saved_songs' is a pool of several
+        sources, check 'load_song_pool' at song_sources.py. If None
+        'saved_songs' are the saved songs
+    source_plays_path : string
+        Path to the JSON file with the plays of the songs of the pool that are
+        not saved songs
+    history_file : string
+        Path to the play history where the recently played songs are stored
+
+    Returns
+    -------
+    list
+        List of ids of the songs that have not yet played
+    '''
+    logger = logging.getLogger('spotify')
+    before_check = list(programmed_songs)
+    programmed_songs = check_recently_played(spotify_env=spotify_env,
+                                             programmed_songs=programmed_songs,
+                                             saved_songs=saved_songs,
+                                             history_file=history_file)
+    if len(programmed_songs) == len(before_check):
+        return programmed_songs
+
+    not_played = set(programmed_songs)
+    played_songs = [song_id for song_id in before_check
+                    if song_id not in not_played]
+    if library_songs is None:
+        library_songs = saved_songs
+    utils.write_library(saved_songs_path, library_songs)
+    if source_plays_path is not None:
+        song_sources.write_source_plays(source_plays_path, saved_songs,
+                                        library_songs)
+    play_session.append_checkpoint(checkpoint_file, 'played', played_songs)
+    logger.info('Recorded %d new played songs.' % (len(played_songs), ))
+    return programmed_songs
+
+
+def search_saved_songs(all_songs_file, results_dir, spotify_env, refresh_time,
+                       song_filter, index_file='search_index.json'):
+    '''
+    Searches the saved songs that match a filter expression, check 'search'
+    at search_index.py. The search index is built the first time.
+
+    Parameters
+    ----------
+    all_songs_file : string
+        Name of the JSON file with the saved songs in our library
+    results_dir : string
+        Name of the folder where the JSON all_songs_file is stored
+    spotify_env : dict
+        Dictionary containing own Spotify keys, tokens, etc.
+    refresh_time : int
+        Accepted number of days since the last update of the saved songs
+    song_filter : string
+        The filter expression, e.g. 'artist:queen album:opera'
+    index_file : string
+        Name of the JSON file with the search index
+
+    Returns
+    -------
+    list
+        Ids of the songs that match the filter
+    '''
+    logger = logging.getLogger('spotify')
+    if song_filter is None:
+        logger.error('Specify what to search with --filter')
+        return []
+    # Fail before loading the songs if the filter is not valid
+    try:
+        search_index.split_filter(song_filter)
+    except ValueError as error:
+        logger.error(error)
+        return []
+
+    saved_songs = load_saved_songs(all_songs_file=all_songs_file,
+                                   results_dir=results_dir,
+                                   spotify_env=spotify_env,
+                                   refresh_time=refresh_time,
+                                   index_file=index_file)
+    index = search_index.load_index(os.path.join(results_dir, index_file),
+                                    saved_songs)
+    start_time = time.perf_counter()
+    matching_ids = search_index.search(index, song_filter)
+    search_time = time.perf_counter() - start_time
+
+    found_ids = [id_song for id_song in saved_songs if id_song in matching_ids]
+    for id_song in found_ids:
+        song = saved_songs[id_song]
+        logger.info('%s - %s - %s. ID: %s' % (
+                        song['name'], ', '.join(song['artists'].values()),
+                        song['album'], id_song))
+    logger.info('Songs matching %s: %d. Search time: %.3f ms' % (
+                    song_filter, len(found_ids), search_time*1000))
+    return found_ids
+
+
+def show_play_stats(all_songs_file, results_dir, history_file,
+                    number_weeks=4, number_songs=20):
+    '''
+    Logs statistics of the play history without asking Spotify: the plays of
+    every artist in the last 'number_weeks' weeks, the saved songs that never
+    played and the 'number_songs' saved songs that played the longest time
+    ago.
+
+    Parameters
+    ----------
+    all_songs_file : string
+        Name of the JSON file with the saved songs in our library
+    results_dir : string
+        Name of the folder where the JSON all_songs_file is stored
+    history_file : string
+        Name of the SQLite file with the play history in 'results_dir'
+    number_weeks : int
+        Number of weeks of the plays per artist, counting the current one
+    number_songs : int
+        Number of songs listed of the never played and the longest unplayed
+
+    Returns
+    -------
+    dict
+        The statistics: 'artist_weeks', 'never_played' and 'longest_unplayed'
+    '''
+    logger = logging.getLogger('spotify')
+    saved_songs_path = os.path.join(results_dir, all_songs_file)
+    saved_songs = {}
+    if os.path.isfile(saved_songs_path):
+        saved_songs = utils.load_library(saved_songs_path)
+    else:
+        logger.warning('There are no saved songs. Download them first.')
+
+    start_time = time.perf_counter()
+    this_week = play_history.week_of(datetime.date.today().isoformat())
+    since = datetime.date.fromisoformat(this_week) - \
+        datetime.timedelta(weeks=number_weeks - 1)
+    connection = play_history.open_history(os.path.join(results_dir,
+                                                        history_file))
+    try:
+        artist_weeks = play_history.plays_per_artist_per_week(
+                        connection, since=since.isoformat())
+        last_played = play_history.last_plays(connection)
+    finally:
+        connection.close()
+    never_played = play_history.never_played(saved_songs, last_played)
+    longest_unplayed = play_history.longest_unplayed(saved_songs, last_played,
+                                                     number_songs)
+    query_time = time.perf_counter() - start_time
+
+    logger.info('Plays per artist in the last %d weeks:' % (number_weeks, ))
+    for week, artist_name, number_plays in artist_weeks:
+        logger.info('%s  %4d  %s' % (week, number_plays, artist_name))
+
+    def song_text(id_song):
+        song = saved_songs[id_song]
+        return '%s - %s. ID: %s' % (song['name'],
+                                    ', '.join(song['artists'].values()),
+                                    id_song)
+
+    logger.info('Saved songs that never played: %d' % (len(never_played), ))
+    for id_song in never_played[:number_songs]:
+        logger.info(song_text(id_song))
+    logger.info('Saved songs that played the longest time ago:')
+    for id_song, played_at in longest_unplayed:
+        logger.info('%s  %s' % (played_at, song_text(id_song)))
+    logger.info('Songs in the history: %d. Query time: %.3f ms' % (
+                    len(last_played), query_time*1000))
+    return {
+        'artist_weeks': artist_weeks,
+        'never_played': never_played,
+        'longest_unplayed': longest_unplayed
+    }
+
+
+def get_recently_played_songs(spotify_env, number_songs=None,
+                              history_file=None):
     '''
     Gets the song that Spotify has recently played
 
+    Every play is stored in the play history, with all the times a song
+    played, check 'record_plays' at play_history.py. A play that was already
+    stored is not stored again, so the same plays can be read many times.
+
     Parameters
     ----------
     spotify_env : dict
         Dictionary containing own Spotify keys, tokens, etc.
     number_songs : int
         Number of songs to look back in history. Max=50
+    history_file : string
+        Path to the play history. If None the plays are not stored
 
     Returns
     -------
@@ -404,6 +1960,18 @@ def get_recently_played_songs(spotify_env, number_songs=None):
     logger.info('Recently played songs: %s' % (json.dumps(recently_played,
                                                           indent=1)))
 
+    if history_file is not None:
+        # Imported here, only needed to know the errors of the history
+        import sqlite3
+        plays = [(id_song, played_at, song['artists'])
+                 for id_song, song in recently_played.items()
+                 for played_at in song['played_at']]
+        try:
+            play_history.record_plays(history_file, plays)
+        except (sqlite3.Error, OSError):
+            # The songs are still checked without the history
+            logger.exception('Could not store the plays in the history.')
+
     return recently_played
 
 
@@ -429,25 +1997,75 @@ def parse_args(args=sys.argv[1:]):
         choices=["download_saved_songs",
                  'compare_saved_songs',
                  'play_saved_songs',
-                 'get_recently_played_songs'],
+                 'get_recently_played_songs',
+                 'enrich_saved_songs',
+                 'plan_next_session',
+                 'search',
+                 'stats'],
         help="Choose the action to perform by the script."
     )
     parser.add_argument(
         "--all_songs_file", "-sf", type=str, default='all_my_songs.json',
         help="Name of the file to save the saved songs."
     )
+    parser.add_argument(
+        "--audio_features_file", "-af", type=str,
+        default=SESSION_DEFAULTS['audio_features_file'],
+        help="Name of the file to cache the audio features of the songs."
+    )
+    parser.add_argument(
+        "--bpm_range", "-bpm", type=float, nargs=2,
+        default=SESSION_DEFAULTS['bpm_range'],
+        metavar=('MIN_BPM', 'MAX_BPM'),
+        help="Only play the songs with a tempo in this range of BPM."
+    )
     parser.add_argument(
         "--refresh_time", "-rt", type=int, default=7,
-        help=("Check if the saved songs were downloaded at most 'refresh_time'"
-              " days back.")
+        help=("Download all the saved songs again if they were downloaded more"
+              " than 'refresh_time' days back. Before that, they are only"
+              " downloaded when the library changes.")
     )
     parser.add_argument(
-        "--repeat_artist", "-ra", type=int, default=20,
+        "--repeat_artist", "-ra", type=int,
+        default=SESSION_DEFAULTS['repeat_artist'],
         help=("Do not repeat an artist when playing saved "
               "songs in at least 'repeat_artist' songs.")
     )
     parser.add_argument(
-        "--num_play_songs", "-ns", type=int, default=100,
+        "--filter", "-fl", type=str, dest='song_filter',
+        default=SESSION_DEFAULTS['song_filter'],
+        help=("Only play or search the songs matching the filter, e.g."
+              " 'artist:queen album:\"a night at the opera\" -name:live'."
+              " Fields: name, artist, album, id. Terms must all match, values"
+              " separated by commas match any of them and a term starting"
+              " with '-' excludes songs (use --filter=-term).")
+    )
+    parser.add_argument(
+        "--history_file", "-hf", type=str,
+        default=SESSION_DEFAULTS['history_file'],
+        help=("Name of the file in 'results_dir' where every detected play is"
+              " stored. Used by the action stats.")
+    )
+    parser.add_argument(
+        "--index_file", "-if", type=str,
+        default=SESSION_DEFAULTS['index_file'],
+        help="Name of the file in 'results_dir' with the search index."
+    )
+    parser.add_argument(
+        "--plan_file", "-pf", type=str, default=SESSION_DEFAULTS['plan_file'],
+        help=("Name of the file in 'results_dir' with the random order of the"
+              " next session, e.g. next_session.json. If given it is stored"
+              " when a session that waited for its songs ends and used by the"
+              " next one.")
+    )
+    parser.add_argument(
+        "--seed", "-sd", type=int, default=SESSION_DEFAULTS['seed'],
+        help=("Seed of the random order of the songs. The same seed and"
+              " library always give the same order.")
+    )
+    parser.add_argument(
+        "--num_play_songs", "-ns", type=int,
+        default=SESSION_DEFAULTS['num_play_songs'],
         help="Play 'num_play_songs' when playing saved songs."
     )
     parser.add_argument(
@@ -455,10 +2073,97 @@ def parse_args(args=sys.argv[1:]):
         help='If set the script will not wait for programmed songs to play.'
     )
     parser.add_argument(
-        "--sleep_time", "-st", type=float, default=5,
+        '--resume', action='store_true',
+        help=('If set play_saved_songs continues the last interrupted session '
+              'instead of starting a new one.')
+    )
+    parser.add_argument(
+        "--session_file", "-ssf", type=str,
+        default=SESSION_DEFAULTS['session_file'],
+        help=("Name of the checkpoint file of the play session, stored in "
+              "'results_dir'.")
+    )
+    parser.add_argument(
+        "--sleep_time", "-st", type=float,
+        default=SESSION_DEFAULTS['sleep_time'],
         help=("Sleep for 'sleep_time' minutes while waiting "
               "for all programmed songs to play.")
     )
+    parser.add_argument(
+        "--target_minutes", "-tm", type=float,
+        default=SESSION_DEFAULTS['target_minutes'],
+        help=("Instead of 'num_play_songs', play the songs that fill this"
+              " number of minutes and stop waiting when they end.")
+    )
+    parser.add_argument(
+        "--target_tolerance", "-tt", type=float,
+        default=SESSION_DEFAULTS['target_tolerance'],
+        help="Accepted difference in minutes with 'target_minutes'."
+    )
+    parser.add_argument(
+        "--sources", "-so", type=str, nargs='+',
+        default=SESSION_DEFAULTS['sources'],
+        help=("Shuffle together the songs of these sources: 'liked' for the"
+              " saved songs, 'playlist:<id>' and 'album:<id>'. By default"
+              " only the saved songs are played.")
+    )
+    parser.add_argument(
+        "--lookahead", "-la", type=int, default=SESSION_DEFAULTS['lookahead'],
+        help=("Keep only this number of songs ahead of the playing song in the"
+              " queue and send the rest while they play. By default all the"
+              " songs are sent at the start.")
+    )
+    parser.add_argument(
+        "--queue_retries", "-qr", type=int,
+        default=SESSION_DEFAULTS['queue_retries'],
+        help=("After sending songs, check the queue of the device and send"
+              " again the missing songs at most this number of times. 0 to"
+              " not check the queue.")
+    )
+    parser.add_argument(
+        "--recently_played_ttl", "-rpt", type=float, default=30,
+        help=("Seconds during which the recently played songs are reused"
+              " instead of asking Spotify again. 0 to always ask.")
+    )
+    # Arguments for the daemon
+    parser.add_argument(
+        '--daemon', action='store_true',
+        help=('If set the script keeps running with the library in memory, '
+              'syncing and comparing it periodically and accepting play '
+              'requests through a Unix socket.')
+    )
+    parser.add_argument(
+        '--use_daemon', action='store_true',
+        help='If set play_saved_songs is sent to a running daemon.'
+    )
+    parser.add_argument(
+        "--socket_path", "-sp", type=str, default='spotify_helper.sock',
+        help=("Path of the Unix socket of the daemon. The specified path is"
+              " relative to this file.")
+    )
+    parser.add_argument(
+        "--sync_interval", "-si", type=float, default=24*60,
+        help="Minutes between syncs of the saved songs in daemon mode."
+    )
+    parser.add_argument(
+        "--compare_interval", "-ci", type=float, default=7*24*60,
+        help="Minutes between compares of the saved songs in daemon mode."
+    )
+    # Arguments for running several accounts
+    parser.add_argument(
+        "--batch_env", "-be", type=str, nargs='+', default=None,
+        help=("Files or directories with the Spotify keys of several accounts."
+              " The action is performed for all of them at the same time."
+              " The specified paths are relative to this file.")
+    )
+    parser.add_argument(
+        "--batch_workers", "-bw", type=int, default=4,
+        help="Maximum number of accounts handled at the same time in batch."
+    )
+    parser.add_argument(
+        "--requests_per_second", "-rps", type=float, default=5,
+        help="Maximum requests per second sent for each account in batch."
+    )
     parser.add_argument(
         "--results_dir", "-rd", type=str, default='results',
         help=("Name of the directory to store the results. The"
@@ -482,9 +2187,103 @@ def parse_args(args=sys.argv[1:]):
     return parser.parse_args(args)
 
 
+def run_action(action, spotify_env, results_dir, all_songs_file,
+               refresh_time, options=None):
+    '''
+    Performs one of the available actions for the account of 'spotify_env'.
+    Check the function 'spotify_helper' for the description of the parameters.
+
+    Parameters
+    ----------
+    action : str
+        Command to perform by the script
+    spotify_env : dict
+        Dictionary containing own Spotify keys, tokens, etc.
+    results_dir : str
+        Name of the folder to store the results of the action
+    all_songs_file : str
+        Name of the JSON file with the saved songs in our library
+    refresh_time : int
+        Parameter used by actions: play_saved_songs
+    options : argparse.Namespace
+        Options of the play session, check 'session_options'. If None the
+        defaults are used. Besides play_saved_songs, they are used by the
+        actions: download_saved_songs, compare_saved_songs and search
+        (index_file), enrich_saved_songs (audio_features_file),
+        plan_next_session (plan_file, repeat_artist), search (song_filter),
+        stats and get_recently_played_songs (history_file)
+    '''
+    if options is None:
+        options = session_options()
+    if action == 'download_saved_songs':
+        download_saved_songs(all_songs_file=all_songs_file,
+                             results_dir=results_dir,
+                             spotify_env=spotify_env,
+                             index_file=options.index_file)
+    elif action == 'compare_saved_songs':
+        compare_saved_songs(all_songs_file=all_songs_file,
+                            results_dir=results_dir,
+                            spotify_env=spotify_env,
+                            index_file=options.index_file)
+    elif action == 'play_saved_songs':
+        play_saved_songs(all_songs_file=all_songs_file,
+                         results_dir=results_dir,
+                         spotify_env=spotify_env,
+                         refresh_time=refresh_time,
+                         options=options)
+    elif action == 'enrich_saved_songs':
+        saved_songs = load_saved_songs(all_songs_file=all_songs_file,
+                                       results_dir=results_dir,
+                                       spotify_env=spotify_env,
+                                       refresh_time=refresh_time,
+                                       index_file=options.index_file)
+        enrich_saved_songs(audio_features_file=options.audio_features_file,
+                           results_dir=results_dir,
+                           spotify_env=spotify_env,
+                           saved_songs=saved_songs)
+    elif action == 'plan_next_session':
+        if options.plan_file is None:
+            logger = logging.getLogger('spotify')
+            logger.error('Give the name of the plan with --plan_file.')
+            return
+        saved_songs, artist_index = load_saved_songs(
+                                        all_songs_file=all_songs_file,
+                                        results_dir=results_dir,
+                                        spotify_env=spotify_env,
+                                        refresh_time=refresh_time,
+                                        index_file=options.index_file,
+                                        with_artist_index=True
+                                    )
+        plan_next_session(saved_songs=saved_songs,
+                          results_dir=results_dir,
+                          plan_file=options.plan_file,
+                          repeat_artist=options.repeat_artist,
+                          artist_index=artist_index)
+    elif action == 'search':
+        search_saved_songs(all_songs_file=all_songs_file,
+                           results_dir=results_dir,
+                           spotify_env=spotify_env,
+                           refresh_time=refresh_time,
+                           song_filter=options.song_filter,
+                           index_file=options.index_file)
+    elif action == 'stats':
+        show_play_stats(all_songs_file=all_songs_file,
+                        results_dir=results_dir,
+                        history_file=options.history_file)
+    elif action == 'get_recently_played_songs':
+        get_recently_played_songs(spotify_env=spotify_env,
+                                  history_file=os.path.join(
+                                    results_dir, options.history_file))
+    else:
+        logger = logging.getLogger('spotify')
+        logger.error('The selected option is not available')
+
+
 def spotify_helper(action, results_dir, spotify_env_file, refresh_time,
-                   log_level, log_file, all_songs_file, repeat_artist,
-                   not_wait_songs_to_play, num_play_songs, sleep_time):
+                   log_level, log_file, all_songs_file, daemon, use_daemon,
+                   socket_path, sync_interval, compare_interval, batch_env,
+                   batch_workers, requests_per_second, recently_played_ttl,
+                   options):
     '''
     Main function of the script. In this function we decide whcih action
     to perform. Available actions:
@@ -492,8 +2291,16 @@ def spotify_helper(action, results_dir, spotify_env_file, refresh_time,
     - compare_saved_songs
     - play_saved_songs
     - get_recently_played_songs
+    - enrich_saved_songs
+    - plan_next_session
+    - search
+    - stats
     Check their respective functions to know further details and how they work
 
+    If 'daemon' is set the script keeps running instead, check
+    'run_daemon' at spotify_daemon.py. If 'batch_env' is set the action is
+    performed for several accounts, check 'run_batch' at spotify_batch.py.
+
     Parameters
     ----------
     action : str
@@ -512,14 +2319,27 @@ def spotify_helper(action, results_dir, spotify_env_file, refresh_time,
     all_songs_file : str
         Parameter used by actions: download_saved_songs, compare_saved_songs,
         play_saved_songs
-    repeat_artist : str
-        Parameter used by actions: play_saved_songs
-    not_wait_songs_to_play : str
-        Parameter used by actions: play_saved_songs
-    num_play_songs : str
-        Parameter used by actions: play_saved_songs
-    sleep_time : str
-        Parameter used by actions: play_saved_songs
+    daemon : bool
+        Wether to run the script as a long-running daemon
+    use_daemon : bool
+        Wether to send the play_saved_songs action to a running daemon
+    socket_path : str
+        Parameter used by daemon and use_daemon
+    sync_interval : float
+        Parameter used by daemon
+    compare_interval : float
+        Parameter used by daemon
+    batch_env : list
+        Files or directories with the Spotify environment of several accounts
+    batch_workers : int
+        Parameter used by batch_env
+    requests_per_second : float
+        Parameter used by batch_env
+    recently_played_ttl : float
+        Seconds during which the recently played songs are reused
+    options : argparse.Namespace
+        Options of the play session, check 'session_options'. Parameter used
+        by the actions, check 'run_action', and by daemon and use_daemon
 
     Returns
     -------
@@ -528,46 +2348,96 @@ def spotify_helper(action, results_dir, spotify_env_file, refresh_time,
     start_time = time.time()
 
     # Configure the logger
-    utils.configure_logger(log_level, log_file)
+    utils.configure_logger(log_level, log_file, long_running=daemon)
     logger = logging.getLogger('spotify')
     logger.info('Logger ready. Logging to file: %s' % (log_file))
+    spotify_api.set_recently_played_ttl(recently_played_ttl)
 
     # Getting the paths relative to this file
     dir_path = os.path.dirname(os.path.realpath(__file__))
     results_dir = os.path.join(dir_path, results_dir)
     spotify_env_file = os.path.join(dir_path, spotify_env_file)
+    socket_path = os.path.join(dir_path, socket_path)
+
+    # Each account of the batch has its own Spotify environment
+    if batch_env is not None:
+        import spotify_batch
+        batch_env = [os.path.join(dir_path, path) for path in batch_env]
+        try:
+            spotify_batch.run_batch(action=action,
+                                    batch_env=batch_env,
+                                    results_dir=results_dir,
+                                    all_songs_file=all_songs_file,
+                                    batch_workers=batch_workers,
+                                    requests_per_second=requests_per_second)
+        except Exception:
+            logger.exception("Fatal error in batch")
+        return
+
+    # The daemon already has everything loaded. Only send the request
+    if use_daemon and action == 'play_saved_songs':
+        import spotify_daemon
+        # The daemon plays from the whole library with its own files. Fail
+        # instead of ignoring the options that it does not support
+        unsupported = [
+            SESSION_FLAGS.get(name, '--' + name)
+            for name, default in SESSION_DEFAULTS.items()
+            if name not in DAEMON_SESSION_OPTIONS and
+            getattr(options, name) != default
+        ]
+        if len(unsupported) > 0:
+            logger.error('Options not supported with --use_daemon: %s. Run '
+                         'without --use_daemon to use them.'
+                         % (', '.join(unsupported), ))
+            return
+        request = {name: getattr(options, name)
+                   for name in DAEMON_SESSION_OPTIONS}
+        request['action'] = action
+        try:
+            response = spotify_daemon.send_daemon_request(
+                        socket_path=socket_path,
+                        request=request
+                    )
+            logger.info('Response of the daemon: %s' % (response, ))
+        except OSError:
+            logger.exception('Could not reach the daemon at %s. Is it running?'
+                             % (socket_path, ))
+        return
 
     # Get my Spotify credentials and variables
     spotify_env = utils.open_json_file(spotify_env_file)
+    loaded_spotify_env = dict(spotify_env)
 
     # Starting with the actionn
     try:
-        if action == 'download_saved_songs':
-            download_saved_songs(all_songs_file=all_songs_file,
-                                 results_dir=results_dir,
-                                 spotify_env=spotify_env)
-        elif action == 'compare_saved_songs':
-            compare_saved_songs(all_songs_file=all_songs_file,
-                                results_dir=results_dir,
-                                spotify_env=spotify_env)
-        elif action == 'play_saved_songs':
-            play_saved_songs(all_songs_file=all_songs_file,
-                             results_dir=results_dir,
-                             spotify_env=spotify_env,
-                             refresh_time=refresh_time,
-                             repeat_artist=repeat_artist,
-                             num_play_songs=num_play_songs,
-                             sleep_time=sleep_time,
-                             not_wait_songs_to_play=not_wait_songs_to_play)
-        elif action == 'get_recently_played_songs':
-            get_recently_played_songs(spotify_env=spotify_env)
+        if daemon:
+            # Imported here, spotify_daemon depends on this module
+            import spotify_daemon
+            spotify_daemon.run_daemon(spotify_env=spotify_env,
+                                      spotify_env_file=spotify_env_file,
+                                      results_dir=results_dir,
+                                      all_songs_file=all_songs_file,
+                                      refresh_time=refresh_time,
+                                      socket_path=socket_path,
+                                      sync_interval=sync_interval,
+                                      compare_interval=compare_interval,
+                                      sleep_time=options.sleep_time,
+                                      repeat_artist=options.repeat_artist,
+                                      plan_file=options.plan_file,
+                                      history_file=options.history_file)
         else:
-            logger.error('The selected option is not available')
+            run_action(action=action,
+                       spotify_env=spotify_env,
+                       results_dir=results_dir,
+                       all_songs_file=all_songs_file,
+                       refresh_time=refresh_time,
+                       options=options)
     except Exception:
         logger.exception("Fatal error in main loop")
     finally:
-        # Writes again the Spotify environment with the new token.
-        utils.write_json_file(spotify_env_file, spotify_env)
+        # Writes again the Spotify environment if there is a new token.
+        if spotify_env != loaded_spotify_env:
+            utils.write_json_file(spotify_env_file, spotify_env)
 
         elapsed_time = time.time() - start_time
         elapsed_delta = datetime.timedelta(seconds=elapsed_time)
@@ -584,8 +2454,16 @@ if __name__ == "__main__":
         results_dir=args.results_dir,
         all_songs_file=args.all_songs_file,
         refresh_time=args.refresh_time,
-        repeat_artist=args.repeat_artist,
-        num_play_songs=args.num_play_songs,
-        sleep_time=args.sleep_time,
-        not_wait_songs_to_play=args.not_wait_songs_to_play
+        daemon=args.daemon,
+        use_daemon=args.use_daemon,
+        socket_path=args.socket_path,
+        sync_interval=args.sync_interval,
+        compare_interval=args.compare_interval,
+        batch_env=args.batch_env,
+        batch_workers=args.batch_workers,
+        requests_per_second=args.requests_per_second,
+        recently_played_ttl=args.recently_played_ttl,
+        options=session_options(**{name: value
+                                   for name, value in vars(args).items()
+                                   if name in SESSION_DEFAULTS})
     )
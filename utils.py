@@ -1,6 +1,24 @@
+import os
+import heapq
 import logging
 import json
-from random import choices
+import time
+import threading
+from bisect import bisect_left, bisect_right
+from itertools import repeat
+from random import Random
+
+# Version of the normalized format of the saved songs file and the fields of
+# a song that are stored in their own tables, check 'pack_library'
+LIBRARY_FORMAT_VERSION = 2
+LIBRARY_TABLE_FIELDS = ('artists', 'album', 'album_id')
+
+# Maximum difference of duration between the two versions of a relinked song
+RELINK_DURATION_TOLERANCE_MS = 2000
+
+# Size at which the log file is rotated and number of old log files kept
+LOG_MAX_BYTES = 100e6
+LOG_BACKUP_COUNT = 3
 
 
 def open_json_file(file):
@@ -29,7 +47,7 @@ def open_json_file(file):
     return python_dic
 
 
-def write_json_file(file, python_dic):
+def write_json_file(file, python_dic, compact=False):
     '''
     Write a JSON file with a python dictionary
 
@@ -39,28 +57,277 @@ def write_json_file(file, python_dic):
         The path to store the JSON file
     python_dic : dict
         The dictionary to save as JSON
+    compact : bool
+        If set the JSON is written without indentation nor spaces
     '''
     logger = logging.getLogger('spotify')
-    with open(file, 'w') as f:
-        json.dump(python_dic, f, ensure_ascii=False, indent=2)
+    # Written to another file first and then renamed, so an interrupted
+    # write never leaves the file truncated
+    tmp_file = '%s.tmp' % (file, )
+    with open(tmp_file, 'w') as f:
+        if compact:
+            json.dump(python_dic, f, ensure_ascii=False, separators=(',', ':'))
+        else:
+            json.dump(python_dic, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_file, file)
     logger.info('JSON file written: %s' % (file, ))
 
 
-def random_all_songs(songs_dictionary, repeat_artist):
+def pack_library(saved_songs):
+    '''
+    Converts the saved songs into the normalized format in which they are
+    stored. Instead of repeating in every song the names of its artists and
+    album, the artists and albums are stored once in their own tables and the
+    songs reference them by their position in the table. The songs are stored
+    by columns, one list per field with a value for every song:
+    {
+        'format_version': 2,
+        'artists': [[artist_id, artist_name], ...],
+        'artist_groups': [[artist_ref, ...], ...],
+        'albums': [[album_id, album_name], ...],
+        'track_fields': ['name', 'uri', 'no_of_plays', ...],
+        'optional_fields': [fields that some songs don't have],
+        'track_ids': [track_id, ...],
+        'tracks': {
+            'artists': [artist_group_ref, ...],
+            'album': [album_ref, ...],
+            'name': [...], 'uri': [...], 'no_of_plays': [...], ...
+        },
+        'artist_tracks': [[track_ref, ...], ...]
+    }
+    'artist_groups' are the different artists of a song, most songs of an
+    artist share the same group. 'artist_tracks' is the reverse index of the
+    songs of every artist, it is aligned with 'artists' and references the
+    positions in 'track_ids'.
+
+    Parameters
+    ----------
+    saved_songs : dict
+        Songs as returned by spotify_api/get_saved_tracks
+
+    Returns
+    -------
+    dict
+        The songs in the normalized format
+    '''
+    artist_refs = {}
+    artists = []
+    group_refs = {}
+    artist_groups = []
+    album_refs = {}
+    albums = []
+    track_fields = []
+    song_groups = []
+    song_albums = []
+    for song in saved_songs.values():
+        group_key = tuple(song['artists'].items())
+        if group_key not in group_refs:
+            for artist_id, artist_name in group_key:
+                if artist_id not in artist_refs:
+                    artist_refs[artist_id] = len(artists)
+                    artists.append([artist_id, artist_name])
+            group_refs[group_key] = len(artist_groups)
+            artist_groups.append([artist_refs[artist_id]
+                                  for artist_id, _ in group_key])
+        song_groups.append(group_refs[group_key])
+
+        album_key = (song['album_id'], song['album'])
+        if album_key not in album_refs:
+            album_refs[album_key] = len(albums)
+            albums.append([song['album_id'], song['album']])
+        song_albums.append(album_refs[album_key])
+
+        for field in song:
+            if field not in LIBRARY_TABLE_FIELDS and field not in track_fields:
+                track_fields.append(field)
+
+    # The fields are known once every song was seen
+    tracks = {'artists': song_groups, 'album': song_albums}
+    optional_fields = []
+    for field in track_fields:
+        tracks[field] = [song.get(field) for song in saved_songs.values()]
+        if any(field not in song for song in saved_songs.values()):
+            optional_fields.append(field)
+
+    artist_tracks = [[] for _ in artists]
+    for track_ref, group_ref in enumerate(song_groups):
+        for artist_ref in artist_groups[group_ref]:
+            artist_tracks[artist_ref].append(track_ref)
+
+    return {
+        'format_version': LIBRARY_FORMAT_VERSION,
+        'artists': artists,
+        'artist_groups': artist_groups,
+        'albums': albums,
+        'track_fields': track_fields,
+        'optional_fields': sorted(optional_fields),
+        'track_ids': list(saved_songs),
+        'tracks': tracks,
+        'artist_tracks': artist_tracks
+    }
+
+
+def unpack_library(library):
+    '''
+    Converts the normalized format of 'pack_library' back into the saved songs.
+    The songs with the same artists share the same dictionary of artists.
+
+    Parameters
+    ----------
+    library : dict
+        The songs in the normalized format
+
+    Returns
+    -------
+    dict
+        Saved songs. The keys of this dictionary are the ids of the songs.
+    '''
+    artists = library['artists']
+    groups = [{artists[ref][0]: artists[ref][1] for ref in refs}
+              for refs in library['artist_groups']]
+    album_names = [album_name for _, album_name in library['albums']]
+    album_ids = [album_id for album_id, _ in library['albums']]
+    tracks = library['tracks']
+    track_fields = library['track_fields']
+
+    # Every song is built from a row (artists, album, album_id, fields...).
+    # The rows are taken from the columns without a loop in Python
+    song_keys = LIBRARY_TABLE_FIELDS + tuple(track_fields)
+    rows = zip(map(groups.__getitem__, tracks['artists']),
+               map(album_names.__getitem__, tracks['album']),
+               map(album_ids.__getitem__, tracks['album']),
+               *[tracks[field] for field in track_fields])
+    saved_songs = dict(zip(library['track_ids'],
+                           map(dict, map(zip, repeat(song_keys), rows))))
+
+    # Fields that some songs did not have when they were packed
+    for field in library.get('optional_fields', []):
+        for id_song, value in zip(library['track_ids'], tracks[field]):
+            if value is None:
+                del saved_songs[id_song][field]
+    return saved_songs
+
+
+def load_library(file, with_artist_index=False):
+    '''
+    Reads the saved songs stored by 'write_library'. Files written before the
+    normalized format (one dictionary per song) are also accepted.
+
+    Parameters
+    ----------
+    file : string
+        The path to the JSON file with the saved songs
+    with_artist_index : bool
+        If set the reverse index of the songs of every artist is also returned
+
+    Returns
+    -------
+    dict
+        Saved songs. The keys of this dictionary are the ids of the songs.
+    dict
+        Only if 'with_artist_index'. The ids of the songs of every artist,
+        check 'build_artist_index'
+    '''
+    library = open_json_file(file)
+    if library.get('format_version') != LIBRARY_FORMAT_VERSION:
+        # Old format, it is converted when the songs are written again
+        if not with_artist_index:
+            return library
+        return library, build_artist_index(library)
+
+    saved_songs = unpack_library(library)
+    if not with_artist_index:
+        return saved_songs
+    if 'artist_tracks' not in library:
+        # Written before the index was stored
+        return saved_songs, build_artist_index(saved_songs)
+    track_ids = library['track_ids']
+    artist_index = {
+        artist[0]: list(map(track_ids.__getitem__, refs))
+        for artist, refs in zip(library['artists'], library['artist_tracks'])
+    }
+    return saved_songs, artist_index
+
+
+def build_artist_index(saved_songs):
+    '''
+    Reverse index of the songs of every artist, the same that is stored by
+    'write_library'.
+
+    Parameters
+    ----------
+    saved_songs : dict
+        Saved songs. The keys of this dictionary are the ids of the songs.
+
+    Returns
+    -------
+    dict
+        The ids of the songs of every artist, in the order of 'saved_songs'.
+        The keys are the ids of the artists, in the order they first appear
+    '''
+    artist_index = {}
+    for id_song, song in saved_songs.items():
+        for artist in song['artists']:
+            artist_index.setdefault(artist, []).append(id_song)
+    return artist_index
+
+
+def load_play_counts(file):
+    '''
+    Reads only the number of plays of the saved songs stored by
+    'write_library'. It is faster than 'load_library' since the songs are not
+    rebuilt.
+
+    Parameters
+    ----------
+    file : string
+        The path to the JSON file with the saved songs
+
+    Returns
+    -------
+    dict
+        The 'no_of_plays' of every song. The keys are the ids of the songs.
+    '''
+    library = open_json_file(file)
+    if library.get('format_version') != LIBRARY_FORMAT_VERSION:
+        return {id_song: song['no_of_plays'] for id_song, song in library.items()}
+    return dict(zip(library['track_ids'],
+                    library['tracks'].get('no_of_plays', [])))
+
+
+def write_library(file, saved_songs):
+    '''
+    Writes the saved songs in the normalized format of 'pack_library'.
+
+    Parameters
+    ----------
+    file : string
+        The path to store the JSON file
+    saved_songs : dict
+        Saved songs. The keys of this dictionary are the ids of the songs.
+    '''
+    write_json_file(file, pack_library(saved_songs), compact=True)
+
+
+def random_all_songs(songs_dictionary, repeat_artist, seed=None,
+                     artist_index=None):
     '''
     Receives a dictionary of songs ('songs_dictionary')  and returns a list of
     songs randomized (ids of the songs).
-    The randomization is done using the function random.choices.
+    The same 'seed' and 'songs_dictionary' always give the same order.
 
-    The function random.choices picks with replacement an element
-    from a list with a proability 'p'. In our case we are picking
-    from the ids of the songs and the probabilities are the number of
-    plays that song has. The more plays/reproductions the less probable is
-    for that song to be picked first.
+    The songs are picked one at a time with a proability 'p'. In our case
+    the probabilities come from the number of plays that song has. The more
+    plays/reproductions the less probable is for that song to be picked first.
 
     We also take into account the frequency in which the artists of the songs
     play. In this case an artist cannot be repeated in the last 'repeat_artist'
-    songs.
+    songs. An artist with more than one of every 'repeat_artist' songs of the
+    library can't be spaced that much, so its songs are spread evenly in the
+    whole order. Only when all the songs left are of recently played artists
+    one of them is picked anyway.
+
+    The songs are chosen by 'iter_random_songs', which gives them one by one.
     
     Parameters
     ----------
@@ -74,6 +341,14 @@ def random_all_songs(songs_dictionary, repeat_artist):
     repeat_artist : int
         Interval of songs in which an artist cannto be repeated.
 
+    seed : int
+        Seed of the random generator. If None a different order is
+        returned every time.
+
+    artist_index : dict
+        The ids of the songs of every artist, check 'iter_random_songs'. If
+        None it is built from 'songs_dictionary'
+
     Returns
     -------
     list
@@ -81,9 +356,49 @@ def random_all_songs(songs_dictionary, repeat_artist):
         at the beginning of the list are played first.
     '''
     logger = logging.getLogger('spotify')
+    logger.info('Randomizing all songs!')
+    randomized_ids = list(iter_random_songs(songs_dictionary, repeat_artist,
+                                            seed=seed,
+                                            artist_index=artist_index))
+    logger.info('Finished randomization, returning randomized songs!')
+    return randomized_ids
+
+
+def iter_random_songs(songs_dictionary, repeat_artist, seed=None,
+                      artist_index=None):
+    '''
+    Gives the randomized ids of 'random_all_songs' one by one, as soon as
+    each song is chosen. The first songs can be used before the whole
+    library is randomized.
+
+    Parameters
+    ----------
+    songs_dictionary : dict
+        A dictionary containing the songs that we want to randomize.
+        The keys of this dictionary are the ids of the songs.
+    repeat_artist : int
+        Interval of songs in which an artist cannto be repeated.
+    seed : int
+        Seed of the random generator. If None a different order is
+        returned every time.
+    artist_index : dict
+        The ids of the songs of every artist, e.g. the one stored with the
+        library, check 'load_library'. The songs that are not in
+        'songs_dictionary' are left out and the songs that are not in the
+        index are grouped by their first artist. If None it is built from
+        'songs_dictionary'
+
+    Yields
+    ------
+    string
+        The id of the next song of the random order
+    '''
+    random_generator = Random(seed)
 
     # Get the ids and weights for each song
     id_song_list = list(songs_dictionary.keys())
+    if len(id_song_list) == 0:
+        return
     number_plays = [songs_dictionary[id_song]['no_of_plays']
                     for id_song in id_song_list]
     song_weights_unorm = [float(play) for play in number_plays]
@@ -95,7 +410,6 @@ def random_all_songs(songs_dictionary, repeat_artist):
         # Songs with more plays have more weight
         song_weights = [1 - weight/max_weight for weight in song_weights_unorm]
 
-    logger.info('Randomizing all songs!')
     # Making sure all weights > 0
     for i in range(len(song_weights)):
         # If the weight is <= 0 give a very small weight but not 0
@@ -103,83 +417,630 @@ def random_all_songs(songs_dictionary, repeat_artist):
             song_weights[i] = 1e-5
         assert song_weights[i] > 0
 
-    randomized_ids = []
-    # Get a dictionary with the position of every id_song in the list
-    # This is done as a hasing dictionary to then access quickly to position
-    positions = {id_song: i for i, id_song in enumerate(id_song_list)}
+    # The songs are grouped by artist. An artist is chosen first, by the
+    # weights of its songs, and then one of its songs, so the artists in the
+    # recently played artists are left out by giving them weight zero.
+    # The weights are integers to keep the sums of the trees exact
+    song_weights = [max(1, round(weight*1e6)) for weight in song_weights]
+    if artist_index is None:
+        artist_index = build_artist_index(songs_dictionary)
+    song_positions = {id_song: position
+                      for position, id_song in enumerate(id_song_list)}
+    # Every song is in the group of the first artist of the index that has it
+    group_refs = {}
+    group_positions = []
+    grouped = [False]*len(id_song_list)
+    # Songs of every artist, to know how close its songs must be
+    artist_songs = {}
+    for artist, artist_ids in artist_index.items():
+        positions = [song_positions[id_song] for id_song in artist_ids
+                     if id_song in song_positions]
+        if len(positions) == 0:
+            continue
+        artist_songs[artist] = len(positions)
+        positions = [position for position in positions
+                     if not grouped[position]]
+        if len(positions) == 0:
+            continue
+        group_refs[artist] = len(group_positions)
+        group_positions.append(positions)
+        for position in positions:
+            grouped[position] = True
+    # Songs that are not in the index, e.g. added after it was stored
+    for position, id_song in enumerate(id_song_list):
+        if grouped[position]:
+            continue
+        song_artists = songs_dictionary[id_song]['artists']
+        for artist in song_artists:
+            artist_songs[artist] = artist_songs.get(artist, 0) + 1
+        artist = next(iter(song_artists), None)
+        if artist not in group_refs:
+            group_refs[artist] = len(group_positions)
+            group_positions.append([])
+        group_positions[group_refs[artist]].append(position)
+    song_trees = [WeightTree([song_weights[position] for position in positions])
+                  for positions in group_positions]
+    artist_tree = WeightTree([song_tree.total for song_tree in song_trees])
+    remaining_songs = dict(artist_songs)
+
+    # Position from which every recently played artist can play again. An
+    # artist with more songs than one of every 'repeat_artist' can't be
+    # spaced, so its songs are spread evenly in the whole order instead of
+    # being pushed to the end of it
+    free_at = {}
+    releases = []
+    # Artists that must play as soon as they are free to keep their pace
+    crowded_artists = []
+    # Songs skipped because one of their other artists was recently played.
+    # Their weight is zero until the next song is picked
+    blocked_songs = []
+
+    artist_of_group = list(group_refs)
+
+    def is_recent(artist, position):
+        return free_at.get(artist, 0) > position
+
+    def add_song_weight(group, index, weight, position):
+        song_trees[group].add(index, weight)
+        # The weight of a recently played artist stays zero
+        if not is_recent(artist_of_group[group], position):
+            artist_tree.add(group, weight)
+
+    def is_blocked(group, index, position):
+        return any(is_recent(artist, position) for artist in songs_dictionary[
+                    id_song_list[group_positions[group][index]]]['artists'])
 
-    recently_played_artists = []
     # Until we have picked all the available songs
-    while len(randomized_ids) != len(id_song_list):
-        # Choose one song
-        chosen_id = choices(id_song_list, song_weights, k=1)[0]
-        # Make sure that song hasn't been picked before
-        if chosen_id not in randomized_ids:
-            # Get the artists of the song
-            chosen_artists = list(songs_dictionary[chosen_id]['artists'].keys())
+    for order_position in range(len(id_song_list)):
+        # The artists that are not recent anymore can be picked again
+        while len(releases) > 0 and releases[0][0] <= order_position:
+            _, artist = heapq.heappop(releases)
+            if free_at[artist] == order_position and artist in group_refs:
+                artist_group = group_refs[artist]
+                artist_tree.add(artist_group, song_trees[artist_group].total)
 
-            # Make sure the artists are not in the recently played artists
-            for artist in chosen_artists:
-                # If they are continue and choose another song
-                if artist in recently_played_artists:
-                    continue
+        group = None
+        # An artist that can't be spaced plays as soon as it is free
+        while len(crowded_artists) > 0 and \
+                crowded_artists[0][0] <= order_position:
+            _, artist = crowded_artists[0]
+            artist_group = group_refs[artist]
+            if free_at[artist] > order_position or \
+                    song_trees[artist_group].total == 0:
+                # Outdated, the artist played again or has no songs left
+                heapq.heappop(crowded_artists)
+                continue
+            index = song_trees[artist_group].choose(random_generator)
+            if not is_blocked(artist_group, index, order_position):
+                heapq.heappop(crowded_artists)
+                group = artist_group
+            # Otherwise it is tried again with the next song
+            break
 
-            # The song and artists are ok. Add the artsits to recently played
-            recently_played_artists += chosen_artists
+        while group is None:
+            if artist_tree.total > 0:
+                group = artist_tree.choose(random_generator)
+                index = song_trees[group].choose(random_generator)
+            else:
+                # Only songs of recently played artists are left. One of
+                # them is picked anyway
+                for blocked_group, blocked_index in blocked_songs:
+                    add_song_weight(blocked_group, blocked_index, song_weights[
+                        group_positions[blocked_group][blocked_index]],
+                        order_position)
+                blocked_songs = []
+                group = random_generator.choices(
+                            range(len(song_trees)),
+                            [song_tree.total for song_tree in song_trees],
+                            k=1)[0]
+                index = song_trees[group].choose(random_generator)
+                break
+            # The first artist is not recently played, check the others
+            if not is_blocked(group, index, order_position):
+                break
+            # Choose another song
+            add_song_weight(group, index,
+                            -song_weights[group_positions[group][index]],
+                            order_position)
+            blocked_songs.append((group, index))
+            group = None
 
-            # Shorten the recently played artist list.
-            # Only check the last repeat_artist
-            recently_played_artists = recently_played_artists[-repeat_artist:]
+        # The skipped songs can be picked again with other recent artists
+        for blocked_group, blocked_index in blocked_songs:
+            add_song_weight(blocked_group, blocked_index, song_weights[
+                group_positions[blocked_group][blocked_index]], order_position)
+        blocked_songs = []
 
-            # Add the id to the list of ids
-            randomized_ids.append(chosen_id)
+        # Set the weight to zero so in the next iteration is not picked
+        position = group_positions[group][index]
+        add_song_weight(group, index, -song_weights[position], order_position)
+        chosen_id = id_song_list[position]
 
-            # Set the weight to zero so in the next iteration is not picked
-            song_weights[positions[chosen_id]] = 0
+        # The song and artists are ok. The artists are recently played until
+        # 'repeat_artist' songs later, or less if they can't be spaced
+        positions_left = len(id_song_list) - order_position - 1
+        for artist in songs_dictionary[chosen_id]['artists']:
+            remaining_songs[artist] -= 1
+            if remaining_songs[artist] == 0:
+                continue
+            spacing = min(repeat_artist,
+                          len(id_song_list)//artist_songs[artist] - 1)
+            spacing = max(spacing, 0)
+            was_recent = is_recent(artist, order_position)
+            free_at[artist] = order_position + spacing + 1
+            heapq.heappush(releases, (free_at[artist], artist))
+            if artist not in group_refs:
+                continue
+            # Its songs left only fit if it plays as soon as it is free
+            if remaining_songs[artist]*(spacing + 1) >= positions_left:
+                heapq.heappush(crowded_artists, (free_at[artist], artist))
+            if not was_recent:
+                artist_group = group_refs[artist]
+                artist_tree.add(artist_group, -song_trees[artist_group].total)
 
-    logger.info('Finished randomization, returning randomized songs!')
-    return randomized_ids
+        yield chosen_id
 
 
-def configure_logger(log_level, log_file):
+def select_by_duration(songs_dictionary, ids_to_play, target_ms,
+                       tolerance_ms):
+    '''
+    Selects songs of 'ids_to_play', in their order, whose total duration is
+    'target_ms' +- 'tolerance_ms'. The order of 'random_all_songs' already
+    puts first the songs with less plays and spaces the artists, so the
+    selection tries to keep it:
+    1. Greedy: the songs are taken in order, skipping the ones that would go
+       over the target, until the total is within the tolerance.
+    2. Repair: if the total is still short, a selected song is replaced by a
+       longer one that was not selected. Starting from the last selected
+       songs (the least priority) the replacement with the right duration is
+       found with a binary search over the sorted durations.
+    The songs without 'duration_ms' (stored by old versions) are skipped.
+
+    Parameters
+    ----------
+    songs_dictionary : dict
+        Saved songs. The keys of this dictionary are the ids of the songs.
+    ids_to_play : list
+        Randomized ids of the songs
+    target_ms : int
+        Total duration of the selected songs in milliseconds
+    tolerance_ms : int
+        Accepted difference between the total duration and 'target_ms'
+
+    Returns
+    -------
+    list
+        Ids of the selected songs in the order of 'ids_to_play'
+    int
+        Total duration of the selected songs in milliseconds
+    '''
+    logger = logging.getLogger('spotify')
+    min_ms = target_ms - tolerance_ms
+    max_ms = target_ms + tolerance_ms
+
+    # Greedy over the order. Only the start of the order is usually read
+    selected = []
+    total_ms = 0
+    number_without_duration = 0
+    for position, id_song in enumerate(ids_to_play):
+        duration_ms = songs_dictionary[id_song].get('duration_ms')
+        if duration_ms is None:
+            number_without_duration += 1
+        elif total_ms + duration_ms <= max_ms:
+            selected.append((position, id_song, duration_ms))
+            total_ms += duration_ms
+            if total_ms >= min_ms:
+                break
+    if number_without_duration > 0:
+        logger.warning('Songs without duration, skipped: %d' % (
+                            number_without_duration, ))
+
+    # Repair: swap a selected song for a longer one
+    if total_ms < min_ms:
+        selected_ids = {id_song for _, id_song, _ in selected}
+        candidates = sorted(
+            (songs_dictionary[id_song]['duration_ms'], position, id_song)
+            for position, id_song in enumerate(ids_to_play)
+            if id_song not in selected_ids and
+            songs_dictionary[id_song].get('duration_ms') is not None
+        )
+        candidate_durations = [candidate[0] for candidate in candidates]
+        for index in range(len(selected) - 1, -1, -1):
+            rest_ms = total_ms - selected[index][2]
+            candidate = bisect_left(candidate_durations, min_ms - rest_ms)
+            if candidate < len(candidates) and \
+                    rest_ms + candidate_durations[candidate] <= max_ms:
+                duration_ms, position, id_song = candidates[candidate]
+                logger.debug('Replacing song %s by %s to fill the time' % (
+                                selected[index][1], id_song))
+                selected[index] = (position, id_song, duration_ms)
+                total_ms = rest_ms + duration_ms
+                break
+
+    if total_ms < min_ms:
+        logger.warning('Could not fill the target duration. Selected: %d s'
+                       % (total_ms/1000, ))
+    # Back to the order of 'ids_to_play'
+    selected.sort()
+    return [id_song for _, id_song, _ in selected], total_ms
+
+
+def relink_key(song):
+    '''
+    Normalized metadata that identifies a song even if Spotify changes its id
+    (relinking): name, ids of the artists and album name.
+    The duration is not part of the key because songs stored by old versions
+    of the script don't have it, check 'same_duration'.
+
+    Parameters
+    ----------
+    song : dict
+        A song of the saved songs
+
+    Returns
+    -------
+    tuple
+        Hashable key of the song
+    '''
+    return (song['name'].strip().casefold(),
+            tuple(sorted(song['artists'])),
+            song['album'].strip().casefold())
+
+
+def same_duration(song, other_song):
+    '''
+    Checks if two songs have the same duration, allowing a difference of
+    RELINK_DURATION_TOLERANCE_MS. Songs without duration are accepted.
+    '''
+    if 'duration_ms' not in song or 'duration_ms' not in other_song:
+        return True
+    difference = abs(song['duration_ms'] - other_song['duration_ms'])
+    return difference <= RELINK_DURATION_TOLERANCE_MS
+
+
+def same_metadata(song, other_song):
+    '''
+    Checks if two songs have exactly the same name, artists and album. Unlike
+    'relink_key', a change of letter case or spaces is a difference.
+    '''
+    return song['name'] == other_song['name'] and \
+        song['artists'] == other_song['artists'] and \
+        song['album'] == other_song['album'] and \
+        song['album_id'] == other_song['album_id']
+
+
+def diff_saved_songs(last_saved_songs, new_saved_songs):
+    '''
+    Classifies the differences between two versions of the saved songs:
+    - added: songs only in 'new_saved_songs'
+    - removed: songs only in 'last_saved_songs'
+    - relinked: songs whose id changed but with the same 'relink_key' and
+      duration. Spotify does this when it replaces the version of a song
+    - metadata_changed: songs with the same id but different name, artists or
+      album, check 'same_metadata'. A relinked song can also have different
+      metadata, e.g. a name that only changed its letter case
+
+    The ids missing from the new songs are indexed by their 'relink_key' in a
+    dictionary, so every new id is matched in constant time and the whole
+    diff is done in one pass over each version.
+
+    Parameters
+    ----------
+    last_saved_songs : dict
+        Saved songs in our library before the last update
+    new_saved_songs : dict
+        Saved songs in our library after the last update
+
+    Returns
+    -------
+    dict
+        With the keys 'added' and 'removed' (lists of ids), 'relinked'
+        (dictionary from old id to new id) and 'metadata_changed' (list of ids)
+    '''
+    metadata_changed = []
+    # Index of the songs that are not in the new version by their metadata
+    missing_index = {}
+    for id_song, song in last_saved_songs.items():
+        new_song = new_saved_songs.get(id_song)
+        if new_song is None:
+            missing_index.setdefault(relink_key(song), []).append(id_song)
+        elif not same_metadata(song, new_song):
+            metadata_changed.append(id_song)
+
+    added = []
+    relinked = {}
+    for id_song, song in new_saved_songs.items():
+        if id_song in last_saved_songs:
+            continue
+        candidates = missing_index.get(relink_key(song), [])
+        match = None
+        for old_id in candidates:
+            if same_duration(last_saved_songs[old_id], song):
+                match = old_id
+                break
+        if match is None:
+            added.append(id_song)
+        else:
+            candidates.remove(match)
+            relinked[match] = id_song
+
+    removed = [id_song for candidates in missing_index.values()
+               for id_song in candidates]
+    return {
+        'added': added,
+        'removed': removed,
+        'relinked': relinked,
+        'metadata_changed': metadata_changed
+    }
+
+
+def build_tempo_index(audio_features):
+    '''
+    Builds an index of the songs sorted by tempo so that the songs in a range
+    of BPM can be found with a binary search, check 'filter_by_tempo'.
+
+    Parameters
+    ----------
+    audio_features : dict
+        Audio features of the songs. The keys are the ids of the songs. The
+        songs without features (None) are not in the index.
+
+    Returns
+    -------
+    dict
+        Index with two lists of the same length: 'tempos' sorted in ascending
+        order and the 'ids' of the songs with those tempos.
+    '''
+    sorted_songs = sorted(
+        (features['tempo'], id_song)
+        for id_song, features in audio_features.items()
+        if features is not None and features.get('tempo') is not None
+    )
+    return {
+        'tempos': [tempo for tempo, _ in sorted_songs],
+        'ids': [id_song for _, id_song in sorted_songs]
+    }
+
+
+def filter_by_tempo(tempo_index, min_bpm, max_bpm):
+    '''
+    Gets the ids of the songs with a tempo between 'min_bpm' and 'max_bpm'
+    (both included).
+
+    Parameters
+    ----------
+    tempo_index : dict
+        Index built by 'build_tempo_index'
+    min_bpm : float
+        Minimum tempo in beats per minute
+    max_bpm : float
+        Maximum tempo in beats per minute
+
+    Returns
+    -------
+    list
+        Ids of the songs sorted by tempo
+    '''
+    start = bisect_left(tempo_index['tempos'], min_bpm)
+    end = bisect_right(tempo_index['tempos'], max_bpm)
+    return tempo_index['ids'][start:end]
+
+
+class RateLimiter:
+    '''
+    Token bucket limiting the number of operations per second.
+    Up to 'requests_per_second' operations can happen in a burst, after that
+    'acquire' blocks until the bucket refills.
+
+    Parameters
+    ----------
+    requests_per_second : float
+        Maximum sustained number of operations per second
+    '''
+
+    def __init__(self, requests_per_second):
+        if requests_per_second <= 0:
+            raise ValueError('The requests per second must be positive')
+        self.rate = float(requests_per_second)
+        self.capacity = max(self.rate, 1.0)
+        self.tokens = self.capacity
+        self.last_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        '''
+        Waits until an operation is allowed by the budget.
+        '''
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity,
+                              self.tokens + (now - self.last_time)*self.rate)
+            self.last_time = now
+            # Take the token now. If the bucket is empty wait for it to refill
+            self.tokens -= 1
+            wait_time = -self.tokens/self.rate if self.tokens < 0 else 0
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+
+class TTLCache:
+    '''
+    Cache of values that expire 'ttl' seconds after they were fetched.
+    Calls for the same key that arrive while the value is being fetched wait
+    for that fetch instead of sending their own (single-flight).
+
+    Parameters
+    ----------
+    ttl : float
+        Seconds during which a fetched value is reused. If <= 0 nothing is
+        cached, but concurrent calls are still coalesced.
+    '''
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.values = {}
+        self.in_flight = {}
+        # Incremented by 'invalidate' so older fetches are not cached
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, fetch):
+        '''
+        Returns the cached value of 'key' or calls 'fetch()' to get it.
+        '''
+        with self.lock:
+            cached = self.values.get(key)
+            if cached is not None and time.monotonic() < cached[0]:
+                return cached[1]
+            flight = self.in_flight.get(key)
+            leader = flight is None
+            if leader:
+                flight = {'event': threading.Event(), 'done': False,
+                          'value': None, 'generation': self.generation}
+                self.in_flight[key] = flight
+
+        if not leader:
+            flight['event'].wait()
+            if flight['done']:
+                return flight['value']
+            # The fetch of the other call failed. Try again
+            return self.get(key, fetch)
+
+        try:
+            flight['value'] = fetch()
+            flight['done'] = True
+            with self.lock:
+                if self.ttl > 0 and flight['generation'] == self.generation:
+                    self.values[key] = (time.monotonic() + self.ttl,
+                                        flight['value'])
+            return flight['value']
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+            flight['event'].set()
+
+    def invalidate(self):
+        '''
+        Forgets all the cached values.
+        '''
+        with self.lock:
+            self.values = {}
+            self.generation += 1
+
+
+def rotate_log_file(log_file, max_bytes=LOG_MAX_BYTES,
+                    backup_count=LOG_BACKUP_COUNT):
+    '''
+    Rotates the log file if it is bigger than 'max_bytes' in the same way that
+    logging.handlers.RotatingFileHandler does: 'log_file' is renamed to
+    'log_file.1', 'log_file.1' to 'log_file.2' and so on.
+
+    Parameters
+    ----------
+    log_file : string
+        Name of the file to log
+    max_bytes : int
+        Size in bytes at which the file is rotated
+    backup_count : int
+        Number of old log files that are kept
+    '''
+    if not os.path.isfile(log_file) or os.path.getsize(log_file) < max_bytes:
+        return
+    for i in range(backup_count - 1, 0, -1):
+        old_file = '%s.%d' % (log_file, i)
+        if os.path.exists(old_file):
+            os.replace(old_file, '%s.%d' % (log_file, i + 1))
+    os.replace(log_file, '%s.1' % (log_file, ))
+
+
+def configure_logger(log_level, log_file, long_running=False):
     '''
     Configures a logger with the name 'spotify'.
     The logger is going to log to console and to a file.
 
+    The log file is rotated when it gets bigger than LOG_MAX_BYTES. A normal
+    run of the script is short, so the size is only checked once at startup.
+    This avoids importing logging.handlers, which is slow. A long-running
+    process (e.g. the daemon) rotates the file while logging.
+
     Parameters
     ----------
     log_level : string
         The level in whcih the logger is going to be configured
     log_file : string
         Name of the file to log
+    long_running : bool
+        Wether the process that logs is going to keep running
     '''
     str_format = '%(asctime)s %(filename)17s %(funcName)22s %(levelname)7s: %(message)s'
-    log_config = { 
-        'version': 1,
-        'formatters': { 
-            'standard': { 
-                'format': str_format,
-                'datefmt': '%d/%m/%Y %H:%M:%S'
-            },
-        },
-        'handlers': { 
-            'console': { 
-                'formatter': 'standard',
-                'class': 'logging.StreamHandler',
-            },
-            'file': {
-                'formatter': 'standard',
-                'class': 'logging.handlers.RotatingFileHandler',
-                'filename': log_file,
-                'maxBytes': 100e6,
-                'backupCount': 3
-            }
-        },
-        'loggers': { 
-            'spotify': { 
-                'handlers': ['console', 'file'],
-                'level': log_level
-            }
-        } 
-    }
-    logging.config.dictConfig(log_config)
+    formatter = logging.Formatter(str_format, datefmt='%d/%m/%Y %H:%M:%S')
+
+    if long_running:
+        from logging.handlers import RotatingFileHandler
+        file_handler = RotatingFileHandler(log_file,
+                                           maxBytes=LOG_MAX_BYTES,
+                                           backupCount=LOG_BACKUP_COUNT)
+    else:
+        rotate_log_file(log_file)
+        # The file is only opened when the first message is logged
+        file_handler = logging.FileHandler(log_file, delay=True)
+    console_handler = logging.StreamHandler()
+
+    logger = logging.getLogger('spotify')
+    # Configuring again the logger replaces the old handlers
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+        handler.close()
+    for handler in (console_handler, file_handler):
+        handler.setFormatter(formatter)
+        logger.addHandler(handler)
+    logger.setLevel(log_level)
+
+
+class WeightTree:
+    '''
+    Fenwick tree of integer weights. An element is chosen with a probability
+    proportional to its weight, and a weight is changed, in log(n) steps
+    instead of going through all the weights.
+
+    Parameters
+    ----------
+    weights : list
+        The weights of the elements, integers >= 0
+    '''
+
+    def __init__(self, weights):
+        self.size = len(weights)
+        self.total = sum(weights)
+        self.tree = [0] + list(weights)
+        for i in range(1, self.size + 1):
+            parent = i + (i & -i)
+            if parent <= self.size:
+                self.tree[parent] += self.tree[i]
+        self.top_step = 1 << max(self.size.bit_length() - 1, 0)
+
+    def add(self, position, weight):
+        '''
+        Adds 'weight' (it can be negative) to the element at 'position'.
+        '''
+        self.total += weight
+        i = position + 1
+        while i <= self.size:
+            self.tree[i] += weight
+            i += i & -i
+
+    def choose(self, random_generator):
+        '''
+        Position of an element chosen at random by weight. The total weight
+        must be > 0.
+        '''
+        value = random_generator.randrange(self.total)
+        position = 0
+        step = self.top_step
+        while step > 0:
+            if position + step <= self.size and \
+                    self.tree[position + step] <= value:
+                position += step
+                value -= self.tree[position]
+            step >>= 1
+        return position